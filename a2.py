@@ -20,11 +20,258 @@ Copyright (c) 2023 Danny Heap and Jacqueline Smith
 This file contains the WasteWrangler class and some simple testing functions.
 """
 
+import bisect
+import csv
 import datetime as dt
+import functools
+import io
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from time import monotonic, sleep
 import psycopg2 as pg
+import psycopg2.errors as pg_errors
 import psycopg2.extensions as pg_ext
 import psycopg2.extras as pg_extras
-from typing import Optional, TextIO
+import psycopg2.pool as pg_pool
+import psycopg2.sql as pg_sql
+from typing import Callable, Iterator, Optional, TextIO, TypeVar
+
+import migrations
+from metrics import (InstrumentedConnection, MetricsSink, explain_analyze,
+                     instrumented)
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+# The statements that WasteWrangler runs on its hot paths. They are kept at
+# module level so that migrations.check_index_usage can verify that they use
+# the indexes added by the migrations.
+
+SCHEDULE_TRIP_SQL = """
+    with requested as (
+        select rID, wasteType,
+               %(time)s::timestamp as start_time,
+               %(time)s::timestamp
+                   + interval '1 hour' * length / 5 as end_time
+        from Route
+        where rID = %(rid)s
+          and not exists (
+              select * from Trip
+              where rID = %(rid)s
+                and date(tTime) = date(%(time)s::timestamp))
+    ), slot as (
+        -- the whole trip must fit within working hours
+        select * from requested
+        where start_time::time >= '08:00'
+          and end_time <= date(start_time) + time '16:00'
+    ), first_facility as (
+        select fc.first_fID as fID
+        from FacilityChoice fc join slot s on fc.wasteType = s.wasteType
+    ), busy_trip as (
+        -- trips within 30 minutes of this one, i.e. whose busy interval
+        -- overlaps the one this trip would have
+        select tr.tID, tr.eID1, tr.eID2
+        from Trip tr, slot s
+        where tr.busy && tsrange(s.start_time,
+                                 s.end_time + interval '30 minutes')
+    ), free_truck as (
+        select t.tID, t.truckType, t.capacity
+        from Truck t
+             join TruckType tt on t.truckType = tt.truckType
+             join slot s on tt.wasteType = s.wasteType
+        where not exists (select * from busy_trip b where b.tID = t.tID)
+          and not exists (
+              select * from Maintenance m
+              where m.tID = t.tID and m.mDate = date(s.start_time))
+    ), free_driver as (
+        select e.eID, e.hireDate
+        from Employee e, slot s
+        where e.hireDate <= date(s.start_time)
+          and exists (select * from Driver d where d.eID = e.eID)
+          and not exists (
+              select * from busy_trip b where e.eID in (b.eID1, b.eID2))
+    ), pick as (
+        -- the most experienced available driver, paired with the
+        -- next most experienced one such that at least one of them
+        -- can drive the truck
+        select t.tID, d1.eID as first, d2.eID as second
+        from free_truck t
+             cross join lateral (
+                 select d.eID, exists (
+                            select * from Driver q
+                            where q.eID = d.eID
+                              and q.truckType = t.truckType
+                        ) as qualified
+                 from free_driver d
+                 order by d.hireDate, d.eID
+                 limit 1) d1
+             cross join lateral (
+                 select d.eID
+                 from free_driver d
+                 where d.eID <> d1.eID
+                   and (d1.qualified or exists (
+                            select * from Driver q
+                            where q.eID = d.eID
+                              and q.truckType = t.truckType))
+                 order by d.hireDate, d.eID
+                 limit 1) d2
+        order by t.capacity desc, t.tID
+        limit 1
+    )
+    insert into Trip
+    select s.rID, p.tID, s.start_time, null,
+           greatest(p.first, p.second), least(p.first, p.second),
+           f.fID
+    from slot s, pick p, first_facility f
+    returning tID, eID1, eID2;
+"""
+
+WORKMATE_SPHERE_SQL = """
+    with recursive sphere(eid) as (
+        select %(eid)s::int
+        union
+        -- one branch per driver column, so that each can use its index
+        select t.other
+        from sphere s cross join lateral (
+            select eID2 from Trip where eID1 = s.eid
+            union all
+            select eID1 from Trip where eID2 = s.eid) t(other)
+    )
+    select eid from sphere where eid <> %(eid)s;
+"""
+
+REROUTE_WASTE_SQL = """
+    with request(idx, fid, first_day, last_day) as (
+        values %s
+    ), replacement as (
+        -- the facility with the lowest fID (other than fid)
+        -- that takes the same waste type as fid
+        select req.*, (
+            select case when fc.first_fID = f.fID then fc.second_fID
+                        else fc.first_fID end
+            from Facility f join FacilityChoice fc
+                 on f.wasteType = fc.wasteType
+            where f.fID = req.fid) as new_fid
+        from request req
+    ), target as (
+        -- each trip once, for the first request that covers it, as
+        -- requests may overlap
+        select distinct on (t.rID, t.tTime) t.rID, t.tTime, r.idx, r.new_fid
+        from Trip t join replacement r on t.fID = r.fid
+        where r.new_fid is not null
+          and t.tTime >= r.first_day
+          and t.tTime < r.last_day + 1
+        order by t.rID, t.tTime, r.idx
+    )
+    update Trip
+    set fID = tg.new_fid
+    from target tg
+    where Trip.rID = tg.rID and Trip.tTime = tg.tTime
+    returning tg.idx;
+"""
+
+DAY_TRIPS_SQL = """
+    select tr.rID, tr.tID, tr.tTime, tr.eID1, tr.eID2, r.length
+    from Trip tr join Route r on tr.rID = r.rID
+    where tr.tTime >= %(first)s::date
+      and tr.tTime < %(last)s::date + 1
+      and date(tr.tTime) = any(%(days)s::date[]);
+"""
+
+DAY_MAINTENANCE_SQL = """
+    select tID, eID, mDate from Maintenance
+    where mDate = any(%s::date[]);
+"""
+
+DRIVERS_SQL = """
+    select e.eID, e.hireDate, array_agg(d.truckType)
+    from Employee e join Driver d on e.eID = d.eID
+    group by e.eID, e.hireDate
+    order by e.hireDate asc, e.eID asc;
+"""
+
+TRUCK_ROUTES_SQL = """
+    select r.rID, r.length, fc.first_fID
+    from Route r
+         join TruckType tt on r.wasteType = tt.wasteType
+         join FacilityChoice fc on r.wasteType = fc.wasteType
+    where tt.truckType = %s
+    order by r.rID;
+"""
+
+FREE_ROUTES_SQL = """
+    select r.rID, r.length, fc.first_fID
+    from Route r
+         join TruckType tt on r.wasteType = tt.wasteType
+         join FacilityChoice fc on r.wasteType = fc.wasteType
+    where tt.truckType = %(truck_type)s
+      and not exists (select * from Trip t
+                      where t.rID = r.rID
+                        and t.tTime >= %(day)s::date
+                        and t.tTime < %(day)s::date + 1)
+    order by r.rID;
+"""
+
+FUTURE_MAINTENANCE_SQL = """
+    select tID, eID, mDate from Maintenance
+    where mDate > %s;
+"""
+
+FUTURE_TRIPS_SQL = """
+    select tr.rID, tr.tID, tr.tTime, tr.eID1, tr.eID2, r.length
+    from Trip tr join Route r on tr.rID = r.rID
+    where tr.tTime >= %(date)s::date + 1
+      and tr.tID = any(%(tids)s::int[]);
+"""
+
+TRUCK_INFO_SQL = """
+    select truckType, capacity from Truck where tID = %s;
+"""
+
+# The statements with which the methods that schedule trips take and give
+# back a lock on each of a list of days; see WasteWrangler._lock_days.
+LOCK_DAYS_SQL = """
+    select pg_advisory_lock(%s, key) from unnest(%s::int[]) key;
+"""
+
+UNLOCK_DAYS_SQL = """
+    select pg_advisory_unlock(%s, key) from unnest(%s::int[]) key;
+"""
+
+# The statements with which FacilityChoice is brought up to date with the
+# changes to Facility that migration 6 logs in FacilityChange; see
+# WasteWrangler.refresh_facility_choice.
+FACILITY_CHANGED_SQL = """
+    select exists (select * from FacilityChange);
+"""
+
+REFRESH_FACILITY_CHOICE_SQL = """
+    delete from FacilityChange;
+    refresh materialized view concurrently FacilityChoice;
+"""
+
+# The statements above by the name under which execute_prepared prepares
+# them on the server.
+PREPARED_STATEMENTS = {
+    "schedule_trip": SCHEDULE_TRIP_SQL,
+    "workmate_sphere": WORKMATE_SPHERE_SQL,
+    "day_trips": DAY_TRIPS_SQL,
+    "day_maintenance": DAY_MAINTENANCE_SQL,
+    "drivers": DRIVERS_SQL,
+    "truck_routes": TRUCK_ROUTES_SQL,
+    "free_routes": FREE_ROUTES_SQL,
+    "future_maintenance": FUTURE_MAINTENANCE_SQL,
+    "future_trips": FUTURE_TRIPS_SQL,
+    "truck_info": TRUCK_INFO_SQL,
+}
 
 
 class WasteWrangler:
@@ -34,25 +281,112 @@ class WasteWrangler:
     === Instance Attributes ===
     connection: connection to a PostgreSQL database of a waste management
     service.
+    pool: pool of connections to the same database, or None if this
+    WasteWrangler was not connected in pooled mode.
+    workmate_index: index of the workmate spheres of all drivers, or None if
+    build_workmate_index has not been called.
+    serializable: whether the methods that schedule trips run at the
+    SERIALIZABLE isolation level, rather than READ COMMITTED.
+    reference_cache: cache of the rows read from Route, Facility, TruckType
+    and Truck, or None if enable_reference_cache has not been called.
+    metrics: the sink that every call of a public method that works with the
+    database reports its wall time, statements, rows fetched, commits and
+    rollbacks to, or None (the default) to record nothing.
+
+    === Private Attributes ===
+    _retry_counts: the number of times that a scheduling call was retried
+        after losing a race with a concurrent one ("retries"), the number
+        of calls that gave up after MAX_RETRIES retries ("exhausted"), and the
+        number of calls of any method that found the pool exhausted for
+        POOL_TIMEOUT seconds ("pool_timeouts").
+    _retry_lock: lock that guards _retry_counts.
+    _connect_params: the parameters that the last successful call to connect
+        was made with, for opening further connections.
+    _pool_slots: semaphore with one slot per connection that <pool> may
+        hold, or None if not connected in pooled mode.
+    _facility_check_at: the monotonic time after which the next leased
+        connection is used to check whether FacilityChoice must be refreshed.
 
     Representation invariants:
     - The database to which connection is established conforms to the schema
       in waste_wrangler_schema.ddl.
+    - At most one of <connection> and <pool> is not None.
     """
     connection: Optional[pg_ext.connection]
+    pool: Optional[pg_pool.ThreadedConnectionPool]
+    workmate_index: Optional['WorkmateIndex']
+    serializable: bool
+    reference_cache: Optional['ReferenceCache']
+    metrics: Optional[MetricsSink]
+    _retry_counts: dict[str, int]
+    _retry_lock: threading.Lock
+    _connect_params: dict[str, str]
+    _pool_slots: Optional[threading.BoundedSemaphore]
+    _facility_check_at: float
+
+    # The number of qualifications file entries that update_technicians
+    # stages and applies at a time.
+    QUALIFICATIONS_CHUNK = 10000
+
+    # The errors with which a scheduling call loses a race with a concurrent
+    # one, so that making it again can succeed. A constraint violation is not
+    # one of them: the calls that schedule trips on the same day are
+    # serialized by _lock_days, so a violation is a real conflict.
+    RETRYABLE_ERRORS = (pg_errors.SerializationFailure,
+                        pg_errors.DeadlockDetected)
+
+    # The class of the advisory locks that _lock_days takes on each day.
+    DAY_LOCK = 343
+
+    # The number of times that a scheduling call that lost a race is retried,
+    # and the upper bound of the random delay before the first retry, in
+    # seconds; the bound doubles with each retry.
+    MAX_RETRIES = 5
+    RETRY_DELAY = 0.01
+
+    # The number of seconds that a call waits for a connection when every
+    # connection of the pool is leased, before it gives up.
+    POOL_TIMEOUT = 30.0
+
+    # The number of seconds between the checks, made when a method call
+    # leases a connection, of whether Facility has changed since FacilityChoice
+    # was last refreshed, i.e. how long FacilityChoice may lag behind Facility.
+    FACILITY_CHOICE_INTERVAL = 1.0
 
     def __init__(self) -> None:
         """Initialize this WasteWrangler instance, with no database connection
         yet.
         """
         self.connection = None
-
-    def connect(self, dbname: str, username: str, password: str) -> bool:
+        self.pool = None
+        self.workmate_index = None
+        self.serializable = False
+        self.reference_cache = None
+        self.metrics = None
+        self._retry_counts = {"retries": 0, "exhausted": 0,
+                              "pool_timeouts": 0}
+        self._retry_lock = threading.Lock()
+        self._connect_params = {}
+        self._pool_slots = None
+        self._facility_check_at = 0.0
+
+    def connect(self, dbname: str, username: str, password: str,
+                min_connections: int = 0, max_connections: int = 0) -> bool:
         """Establish a connection to the database <dbname> using the
         username <username> and password <password>, and assign it to the
         instance attribute <connection>. In addition, set the search path
         to waste_wrangler.
 
+        If <max_connections> is positive, connect in pooled mode instead:
+        open a pool holding between <min_connections> and <max_connections>
+        connections and assign it to the instance attribute <pool>. Each method
+        call then leases its own connection from the pool, so calls made from
+        different threads run in parallel.
+
+        Log a warning if any of the migrations in migrations.py has not been
+        applied to the database, since the methods rely on the tables and
+        triggers that these add.
+
         Return True if the connection was made successfully, False otherwise.
         I.e., do NOT throw an error if making the connection fails.
 
@@ -62,12 +396,45 @@ class WasteWrangler:
         >>> # In this example, the connection cannot be made.
         >>> ww.connect("invalid", "nonsense", "incorrect")
         False
+        >>> # Pooled mode, keeping 2 to 10 connections open.
+        >>> ww.connect("csc343h-marinat", "marinat", "", 2, 10)
+        True
         """
+        params = {"dbname": dbname, "user": username, "password": password,
+                  "options": "-c search_path=waste_wrangler",
+                  "connection_factory": PreparedConnection}
         try:
-            self.connection = pg.connect(
-                dbname=dbname, user=username, password=password,
-                options="-c search_path=waste_wrangler"
-            )
+            if max_connections > 0:
+                pool = pg_pool.ThreadedConnectionPool(
+                    min_connections, max_connections, **params
+                )
+                try:
+                    # make sure the database is reachable even if
+                    # <min_connections> is 0
+                    connection = pool.getconn()
+                    try:
+                        self._check_migrations(connection)
+                    finally:
+                        pool.putconn(connection)
+                except pg.Error:
+                    pool.closeall()
+                    raise
+                # only one mode is ever open, so that calls don't keep using
+                # the connection(s) of an earlier call to connect
+                self._close_connections()
+                self.pool = pool
+                self._pool_slots = threading.BoundedSemaphore(max_connections)
+            else:
+                connection = pg.connect(**params)
+                try:
+                    self._check_migrations(connection)
+                except pg.Error:
+                    connection.close()
+                    raise
+                self._close_connections()
+                self.connection = connection
+            self._connect_params = params
+            self._facility_check_at = 0.0
             return True
         except pg.Error:
             return False
@@ -85,12 +452,14 @@ class WasteWrangler:
         True
         """
         try:
-            if self.connection and not self.connection.closed:
-                self.connection.close()
+            self._close_connections()
+            if self.reference_cache:
+                self.reference_cache.close()
             return True
         except pg.Error:
             return False
 
+    @instrumented
     def schedule_trip(self, rid: int, time: dt.datetime) -> bool:
         """Schedule a truck and two employees to the route identified
         with <rid> at the given time stamp <time> to pick up an
@@ -137,14 +506,43 @@ class WasteWrangler:
         tests could use any valid value for <time>.
         """
         try:
-            # TODO: implement this method
-            pass
+            return self._retry([time.date()], self._try_schedule_trip, rid,
+                               time)
         except pg.Error as ex:
             # You may find it helpful to uncomment this line while debugging,
             # as it will show you all the details of the error that occurred:
             # raise ex
             return False
 
+    @instrumented
+    def schedule_trip_many(self, requests: list[tuple[int, dt.datetime]]) \
+            -> list[bool]:
+        """Schedule a trip for each (rid, time) pair in <requests>, in the
+        order given, following the same rules as schedule_trip. A trip
+        accepted earlier in <requests> makes its truck and drivers unavailable
+        to the later ones, exactly as if schedule_trip had been called once per
+        pair.
+
+        The relevant routes, trucks, drivers and facilities are read once, the
+        existing trips and maintenance are loaded once into a DayAvailability
+        per requested day, and all accepted trips are written with a single
+        insert and a single commit.
+
+        Return a list with one entry per pair in <requests>, which is True iff
+        the trip for that pair was scheduled.
+
+        This method should NOT throw an error. If an error occurs, no changes
+        are made to the database and every entry of the result is False.
+        """
+        if not requests:
+            return []
+        try:
+            return self._retry([time.date() for _, time in requests],
+                               self._try_schedule_trip_many, requests)
+        except pg.Error:
+            return [False] * len(requests)
+
+    @instrumented
     def schedule_trips(self, tid: int, date: dt.date) -> int:
         """Schedule the truck identified with <tid> for trips on <date> using
         the following approach:
@@ -170,6 +568,9 @@ class WasteWrangler:
                assumption that <tid> will travel an average of 5 kph.
                Make sure that the last trip will not end after 4 p.m.
 
+        A truck that already has a trip or maintenance on <date> is not free
+        to start at 8 a.m., so no trips are scheduled for it on that day.
+
         Return the number of trips that were scheduled successfully.
 
         Your method should NOT raise an error.
@@ -177,151 +578,78 @@ class WasteWrangler:
         While a realistic use case will provide a <date> in the near future, our
         tests could use any valid value for <date>.
         """
-        # TODO: implement this method
-
-        cursor = self.connection.cursor()
-
-        cursor.execute("drop view if exists allDriverTrips cascade;")
-        cursor.execute("drop view if exists allDrivers cascade;")
-        cursor.execute("drop view if exists allAvailableDrivers cascade;")
-        cursor.execute("drop view if exists driverExperience cascade;")
-
-        cursor.execute("select * \
-                       from Truck natural join TruckType \
-                       where Truck.tid = %s;", [tid]) #get all wastetype the given truck can carry 
-        truck_wastetype = cursor.fetchall()
-        #print("Trucktype relation: ", truck_wastetype)
-        truck_type = truck_wastetype[0][0]
-        #print("Trucktype: ", truck_type)
-
-        #iterate over each wastetype that the truck can carry, find routes where there's no trips in given day of that wastetype 
-        #allRoute should have all the Route IDs that do not have any trips involving the wastypes of our truck
-        allRoutes = list()
-        for row in range(len(truck_wastetype)):
-            waste = truck_wastetype[row][3]
-            #print(waste)
-            cursor.execute("select distinct t1.rid \
-                            from Trip natural join Route t1 \
-                            where t1.rid not in (select t2.rid \
-                                             from Trip natural join Route t2 \
-                                             where date(trip.ttime) = %s and t2.wastetype = %s) \
-                            and t1.wastetype = %s \
-                            order by t1.rid asc;", (date.date(), waste, waste))
-            if cursor.rowcount != 0:
-                subRoute = cursor.fetchall()
-                allRoutes.extend(subRoute)
-        
-        all_distinct_routes = list(dict.fromkeys(allRoutes))
-        #print(all_distinct_routes)
-        #no available routes 
-        """
-        if len(all_distinct_routes) == 0:
-            return 0 
-        """
-
-        #Step2: Starting from 8 a.m., find the earliest available pair of drivers of whom at least one can drive the
-        #given truck and both are available for the day. Break ties by choosing lower eIDs.
-
-        #this creates a view called <allDriverTrips> that contains all the driver who are booked to a trip on a given date 
-        cursor.execute(" create view allDriverTrips as \
-                        (select distinct eid \
-                         from Driver join Trip on Driver.eid = Trip.eid1 \
-                         where date(trip.ttime) = %s) \
-                         UNION \
-                        (select distinct eid \
-                         from Driver join Trip on Driver.eid = Trip.eid2 \
-                         where date(trip.ttime) = %s);", [date.date(), date.date()])
-        
-        #obtain all the drivers who do not have a booked trip on that day, creates a view called <allDrivers>
-        cursor.execute("create view allDrivers as \
-                        select distinct(eid) \
-                        from Driver;")
-
-        #Keep all the drivers that do not have a trip booked: all_remaining_drivers = allDrivers - allDriverTrips
-        #creates a view called all_remaining_drivers
-        cursor.execute("create view allAvailableDrivers as \
-                        (select * from allDrivers) \
-                        EXCEPT \
-                        (select * from allDriverTrips);")
-        
-        #from the available drivers, create a view consisting of their hiredate, eID, and the trucktype they can drive
-        #ordered from descending order so we have the drivers hired longest at the top of the table, and break ties by choosing lower eid
-        #<eID, hiredate, trucktype>
-        cursor.execute("create view driverExperience as \
-                       select allAvailableDrivers.eid, Employee.hiredate, Driver.trucktype \
-                       from allAvailableDrivers natural join Driver natural join Employee \
-                       order by Employee.hiredate asc, allAvailableDrivers.eid asc;")
-        
-        #create a self join, and since it is already ordered based on longest experience, we can select the first tuple where it satisfies:
-        # eid1 != eid2 and one of eid1 or eid2 can drive required trucktype 
-        cursor.execute("select t1.eid, t2.eid \
-                        from driverExperience t1, driverExperience t2 \
-                        where not t1.eid = t2.eid \
-                        and (t1.trucktype = %s or t2.trucktype = %s);",[truck_type, truck_type])
-        #no available drivers
-       
-        if cursor.rowcount == 0:
+        #schedule_trips has been called with both dates and datetimes
+        if isinstance(date, dt.datetime):
+            date = date.date()
+        try:
+            return self._retry([date], self._try_schedule_trips, tid, date)
+        except pg.Error as ex:
+            # You may find it helpful to uncomment this line while debugging,
+            # as it will show you all the details of the error that occurred:
+            # raise ex
             return 0
-        
-        driver1, driver2 = cursor.fetchone()[0], cursor.fetchone()[1]
-
-        #loop over the routes, and scheduling trips based on ascending rIDs. First trip assumes start at 8am, adds (route.length / 5km/hr)
-        trips_scheduled = 0
-        start_time = dt.datetime.combine(date, dt.time(8,0)) # 2023-05-03 08:00:00
-        current_time = start_time
-        end_time = dt.datetime.combine(date, dt.time(16,0))
-
-        for route in range(len(all_distinct_routes)):
-            if current_time < end_time:
-                #print(all_distinct_routes[route])
-                rid = all_distinct_routes[route][0]
-                #print("rid:", rid)
-                cursor.execute("select wastetype, length \
-                                from Route \
-                                where rID = %s;", [rid])
-                
-                #covnert to hour + minutes, update time, then insert into trips , then update trips_scheduled
-                #ALSO NEED FID VALUE (get from wastype from route it )
-
-                #obtain the length and wastetype of the route
-                route_tuple = cursor.fetchone()
-                route_waste = route_tuple[0]
-                route_length = route_tuple[1] 
-                
-
-                #get the lowest fid that can collect the waste of the route
-                cursor.execute("select fid \
-                                from Facility \
-                                where wastetype = %s \
-                                order by fid asc;", [route_waste])
-                fid_tuple = cursor.fetchone()
-                fid = fid_tuple[0]
-
-                #insert into trips relation: 
-                cursor.execute("insert into trip values \
-                                (%s, %s, %s, NULL, %s, %s, %s);", [rid, tid, current_time, driver1, driver2, fid])
-                #print("inserted into trips: (%s, %s, %s, NULL, %s, %s, %s)",rid, tid, current_time, driver1, driver2, fid)
-                
-                #update time; update number of trips scheduled 
-                current_time = current_time + dt.timedelta(hours=float(route_length/5)) #time it takes to finish the route
-                current_time = current_time + dt.timedelta(hours=0.5) #time between trips 
-                trips_scheduled = trips_scheduled + 1
 
-            else:
-                break
-
-        cursor.execute("drop view if exists allDriverTrips cascade;")
-        cursor.execute("drop view if exists allDrivers cascade;")
-        cursor.execute("drop view if exists allAvailableDrivers cascade;")
-        cursor.execute("drop view if exists driverExperience cascade;")
-
-        #commit newly inserted 
-        if trips_scheduled > 0:
-            self.connection.commit()
+    @instrumented
+    def schedule_trips_range(self, tid: int, start: dt.date,
+                             end: dt.date) -> int:
+        """Schedule the truck identified with <tid> for trips on every day
+        from <start> to <end> inclusive, following the same approach as
+        schedule_trips on each day in turn.
+
+        The truck, the routes it can carry, the drivers, and the trips and
+        maintenance already booked over the whole range are read once, every
+        day is planned in memory, and all the trips are written with a single
+        insert and a single commit. No trips are scheduled on a day on which
+        the truck already has a trip or maintenance.
+
+        Return the number of trips that were scheduled successfully. This
+        method should NOT raise an error; if an error occurs, no changes are
+        made to the database and 0 is returned.
+        """
+        if isinstance(start, dt.datetime):
+            start = start.date()
+        if isinstance(end, dt.datetime):
+            end = end.date()
+        if start > end:
+            return 0
+        try:
+            return self._retry([start + dt.timedelta(days=i)
+                                for i in range((end - start).days + 1)],
+                               self._try_schedule_trips_range, tid, start, end)
+        except pg.Error:
+            return 0
 
-        return trips_scheduled
-    
+    @instrumented
+    def schedule_fleet(self, date: dt.date, tids: Optional[list[int]] = None,
+                       workers: int = 0) -> int:
+        """Schedule every truck in <tids> (or every truck, if <tids> is None)
+        for trips on <date>, with the same outcome as calling schedule_trips
+        for each of them in ascending order of tID.
+
+        Trucks interact in two ways only: trucks whose types carry a common
+        waste type compete for the same routes, and all trucks compete for
+        the same drivers. The trucks are therefore split into partitions that
+        share no waste type, the routes of each partition are assigned on its
+        own (on a pool of <workers> processes, if <workers> is positive), and
+        the driver pairs are then allocated from one shared availability, in
+        ascending order of tID, to the trucks that have trips. A truck left
+        without a pair gets no trips, and its partition is planned again
+        without it, so that its routes go to the next trucks.
+
+        Everything is read once and all trips are written with a single
+        insert and a single commit. Return the number of trips that were
+        scheduled. This method should NOT raise an error; if an error occurs,
+        no changes are made to the database and 0 is returned.
+        """
+        if isinstance(date, dt.datetime):
+            date = date.date()
+        try:
+            return self._retry([date], self._try_schedule_fleet, date, tids,
+                               workers)
+        except pg.Error:
+            return 0
 
+    @instrumented
     def update_technicians(self, qualifications_file: TextIO) -> int:
         """Given the open file <qualifications_file> that follows the format
         described on the handout, update the database to reflect that the
@@ -345,62 +673,62 @@ class WasteWrangler:
         Hint: We have provided a helper _read_qualifications_file that you
             might find helpful for completing this method.
         """
-        # TODO: implement this method
-        employee_list = self._read_qualifications_file(qualifications_file)
-        cursor = self.connection.cursor()
-        employee_added = 0
-
-        for employee in employee_list:
-            employee_name = employee[0] + " " + employee[1]
-
-            #check if employee name is correct and exists in employee relation
-            cursor.execute("select eid \
-                            from employee \
-                            where name = %s;", [employee_name])
-            if cursor.rowcount == 0: #doesn't have this employee
-                continue
-            
-            #check if employee is a driver
-            name = cursor.fetchone() 
-            eid = name[0]
-            cursor.execute("select * \
-                            from driver \
-                            where eid = %s;", [eid])
-            if cursor.rowcount != 0: #employee exists in driver relation
-                continue
-            
-            #check if trucktype is correct 
-            truck_type = employee[2]
-            cursor.execute("select * \
-                            from trucktype \
-                            where trucktype = %s;", [truck_type])
-            if cursor.rowcount == 0: #incorrect trucktype
-                continue
-
-            #check if employee is already working on the given truck
-            cursor.execute("select * \
-                            from technician \
-                            where eid = %s \
-                            and trucktype = %s;", [eid, truck_type])
-            if cursor.rowcount != 0: #returns non-empty row, means employee already working on given type
-                continue
-
-            cursor.execute("insert into technician values \
-                            (%s,%s);", [eid, truck_type])
-            employee_added = employee_added + 1
-
-        if employee_added > 0:
-            self.connection.commit()
-
-        return employee_added
-    """
+        entries = self._iter_qualifications_file(qualifications_file)
+        try:
+            with self._lease() as connection:
+                cursor = connection.cursor()
+
+                # stream the file into a staging table one chunk at a time,
+                # applying every validity rule to each chunk with one
+                # set-based insert, so that memory use stays flat
+                cursor.execute("""
+                    create temp table qualification_stage (
+                        name text,
+                        truckType text
+                    ) on commit drop;
+                """)
+                employee_added = 0
+                chunk = list(itertools.islice(entries,
+                                              self.QUALIFICATIONS_CHUNK))
+                while chunk:
+                    staged = io.StringIO()
+                    writer = csv.writer(staged)
+                    for fname, lname, truck_type in chunk:
+                        writer.writerow([fname + " " + lname, truck_type])
+                    staged.seek(0)
+                    cursor.copy_expert(
+                        "copy qualification_stage from stdin "
+                        "with (format csv);", staged)
+
+                    # the employee must exist and not be a driver, and the
+                    # truck type must exist; entries the technician already
+                    # has (in the database, or earlier in the file) are
+                    # skipped by the conflict clause
+                    cursor.execute("""
+                        insert into Technician
+                        select e.eID, s.truckType
+                        from qualification_stage s
+                             join Employee e on e.name = s.name
+                        where exists (select * from TruckType tt
+                                      where tt.truckType = s.truckType)
+                          and not exists (select * from Driver d
+                                          where d.eID = e.eID)
+                        on conflict do nothing;
+                    """)
+                    employee_added = employee_added + cursor.rowcount
+                    cursor.execute("truncate qualification_stage;")
+                    chunk = list(itertools.islice(entries,
+                                                  self.QUALIFICATIONS_CHUNK))
+
+                connection.commit()
+                return employee_added
         except pg.Error as ex:
             # You may find it helpful to uncomment this line while debugging,
             # as it will show you all the details of the error that occurred:
             # raise ex
             return 0
-    """
 
+    @instrumented
     def workmate_sphere(self, eid: int) -> list[int]:
         """Return the workmate sphere of the driver identified by <eid>, as a
         list of eIDs.
@@ -417,16 +745,88 @@ class WasteWrangler:
 
         Your method should NOT return an error. If an error occurs, your method
         should simply return an empty list.
+
+        If build_workmate_index has been called, the sphere is read from
+        <workmate_index> without querying the database.
         """
+        if self.workmate_index is not None:
+            return self.workmate_index.sphere(eid)
         try:
-            # TODO: implement this method
-            pass
+            with self._lease() as connection:
+                cursor = connection.cursor()
+                # walk the co-driver graph inside the database, so that the
+                # whole connected component is returned in a single round
+                # trip; union (rather than union all) stops the walk at
+                # employees already seen
+                execute_prepared(cursor, "workmate_sphere", {"eid": eid})
+                return [row[0] for row in cursor.fetchall()]
         except pg.Error as ex:
             # You may find it helpful to uncomment this line while debugging,
             # as it will show you all the details of the error that occurred:
             # raise ex
             return []
 
+    @instrumented
+    def build_workmate_index(self) -> bool:
+        """Build <workmate_index> from every pair of drivers in Trip. From then
+        on, workmate_sphere is answered from the index, and the trips scheduled
+        through this WasteWrangler keep it up to date.
+
+        Trips inserted by other clients are not reflected in the index until
+        it is built again.
+
+        Return True iff the index was built. This method should NOT throw an
+        error.
+        """
+        try:
+            with self._lease() as connection:
+                cursor = connection.cursor()
+                self.workmate_index = WorkmateIndex.load(cursor)
+                return True
+        except pg.Error:
+            return False
+
+    def enable_reference_cache(self, ttl: float = 300.0,
+                               max_entries: int = 10000,
+                               listen: bool = False) -> bool:
+        """Serve the lookups that the schedulers make in Route, Facility,
+        TruckType and Truck from <reference_cache>, a new ReferenceCache that
+        keeps up to <max_entries> results for at most <ttl> seconds each.
+
+        If <listen> is True, a separate connection also listens for the
+        notifications that migration 3 sends whenever one of these tables
+        changes, so that changes made by any client are seen on the next
+        lookup rather than after <ttl> seconds.
+
+        Return True iff the cache was enabled. This method should NOT throw an
+        error.
+        """
+        cache = ReferenceCache(ttl, max_entries)
+        if listen:
+            try:
+                cache.listen(pg.connect(**self._connect_params))
+            except pg.Error:
+                return False
+        if self.reference_cache:
+            self.reference_cache.close()
+        self.reference_cache = cache
+        return True
+
+    def retry_counts(self) -> dict[str, int]:
+        """Return the number of times that the methods that schedule trips
+        were retried after losing a race with a concurrent call ("retries"),
+        and the number of calls that gave up after MAX_RETRIES retries and
+        returned a failure ("exhausted").
+
+        Also return the number of calls of any method that returned a failure
+        because no pooled connection became available within POOL_TIMEOUT
+        seconds ("pool_timeouts"), which would otherwise look just like
+        having nothing to schedule.
+        """
+        with self._retry_lock:
+            return dict(self._retry_counts)
+
+    @instrumented
     def schedule_maintenance(self, date: dt.date) -> int:
         """For each truck whose most recent maintenance before <date> happened
         over 90 days before <date>, and for which there is no scheduled
@@ -454,109 +854,71 @@ class WasteWrangler:
         """
         #find all trucks that last had maintenance before date - 90
         cutoff_date = date + dt.timedelta(days=-90)
-        cursor = self.connection.cursor()
-
-        cursor.execute("drop view if exists within_90_days cascade;")
-        cursor.execute("drop view if exists not_within_90_days cascade;")
-
-        #first find all trucks that had maintenance within 90 days, then later subtract this from maintenance to find all trucks
-        #that did not have maintenance within 90 days
-        cursor.execute("create view within_90_days as \
-                        select t1.tid \
-                        from truck t1 \
-                        where exists (select t2.tid \
-                                      from maintenance t2 \
-                                      where t1.tid = t2.tid \
-                                      and t2.mdate >= %s);", [cutoff_date])
-        
-        cursor.execute("create view not_within_90_days as \
-                        (select tid from truck) \
-                        EXCEPT \
-                        (select tid from within_90_days);")
-        
-        cursor.execute("select tid \
-                        from not_within_90_days \
-                        order by tid asc;")
-        trucks_need_maintenance = list()
-        if cursor.rowcount != 0:
-            trucks_need_maintenance = cursor.fetchall()
-        
-        latest_date = date + dt.timedelta(days=10)
-        trucks_maintenanced = 0
-        
-        for truck in trucks_need_maintenance:
-
-            tid = truck[0]
-            cursor.execute("select trucktype \
-                            from truck \
-                            where tid = %s;", [tid])
-            truck_tuple = cursor.fetchone()
-            truck_type = truck_tuple[0]
-
-            #see if there is a scheduled maintenance in the next 10 days
-            cursor.execute("select * \
-                            from maintenance \
-                            where tid = %s \
-                            and mdate between %s and %s;", [tid, date, latest_date])
-            if cursor.rowcount != 0:
-                continue
-
-            #if we get here, it means that there is no upcoming scheduled maintenance
-            maintenance_date = date + dt.timedelta(days=1)
-            technician_found = False
-
-            while(technician_found == False):
-                cursor.execute("drop view if exists scheduled_technicians cascade;")
-                cursor.execute("drop view if exists available_technicians cascade;")
-
-                #create a view to find all booked technicians, then we subtract this from all technicians
-                cursor.execute("create view scheduled_technicians as \
-                                select distinct eid from maintenance \
-                                where mdate = %s;", [maintenance_date])
-            
-                cursor.execute("create view available_technicians as \
-                                (select distinct eid from technician) \
-                                 except \
-                                (select * from scheduled_technicians);")
-            
-                cursor.execute("select distinct available_technicians.eid  \
-                                from available_technicians join technician on available_technicians.eid = technician.eid \
-                                where trucktype = %s \
-                                order by available_technicians.eid asc;", [truck_type])
-                
-                #if no available technicians available, see if there is availability next day
-                if cursor.rowcount == 0:
-                    maintenance_date = maintenance_date + dt.timedelta(days=1)
-                    continue
-                else:
-                    technician_found = True
-
-            #get the first tuple since it is sorted in ascending order already 
-            technician_tuple = cursor.fetchone()
-            technician_eid = technician_tuple[0]
-
-            cursor.execute("insert into maintenance values \
-                            (%s,%s,%s);", [tid, technician_eid, maintenance_date])
-            print("inserted: (%s,%s,%s)",tid, technician_eid, maintenance_date)
-
-            trucks_maintenanced = trucks_maintenanced + 1
-        
-        if trucks_maintenanced > 0:
-            self.connection.commit()
-        
-        return trucks_maintenanced
-
-        """
         try:
-            # TODO: implement this method
-            pass
+            with self._lease() as connection:
+                cursor = connection.cursor()
+
+                #find all trucks (and their trucktype) that did not have maintenance within 90 days, as an anti-join.
+                #Since date - 90 < date, this also leaves out every truck with maintenance scheduled up to 10 days
+                #after date.
+                cursor.execute("select t1.tid, t1.trucktype \
+                                from truck t1 \
+                                where not exists (select t2.tid \
+                                                  from maintenance t2 \
+                                                  where t1.tid = t2.tid \
+                                                  and t2.mdate >= %s) \
+                                order by t1.tid asc;", [cutoff_date])
+                trucks_need_maintenance = cursor.fetchall()
+
+                #find the qualified technicians of each trucktype once, in ascending order of eid
+                cursor.execute("select trucktype, eid \
+                                from technician \
+                                order by eid asc;")
+                qualified_technicians = dict()
+                for truck_type, eid in cursor.fetchall():
+                    qualified_technicians.setdefault(truck_type, []).append(eid)
+
+                #load which technicians are booked on every day after date once
+                execute_prepared(cursor, "future_maintenance", [date])
+                availability = dict()
+                for tid, eid, mdate in cursor.fetchall():
+                    if mdate not in availability:
+                        availability[mdate] = DayAvailability(mdate)
+                    availability[mdate].book_maintenance(tid, eid)
+
+                #and the trips of the trucks that need maintenance, which
+                #can't be maintained on a day they have a trip
+                execute_prepared(cursor, "future_trips", {
+                    "date": date,
+                    "tids": [tid for tid, _ in trucks_need_maintenance]})
+                for rid, tid, start, eid1, eid2, length in cursor.fetchall():
+                    if start.date() not in availability:
+                        availability[start.date()] = \
+                            DayAvailability(start.date())
+                    availability[start.date()].book_trip(
+                        rid, tid, eid1, eid2, start, trip_end(start, length))
+
+                #assign every truck in memory, then insert all of them at once
+                maintenance = self._plan_maintenance(
+                    trucks_need_maintenance, qualified_technicians,
+                    availability, date + dt.timedelta(days=1))
+                if maintenance:
+                    pg_extras.execute_values(
+                        cursor, "insert into maintenance values %s;",
+                        maintenance, page_size=len(maintenance))
+                    connection.commit()
+                for tid, technician_eid, maintenance_date in maintenance:
+                    logger.debug("inserted: (%s,%s,%s)", tid, technician_eid,
+                                 maintenance_date)
+
+                return len(maintenance)
         except pg.Error as ex:
             # You may find it helpful to uncomment this line while debugging,
             # as it will show you all the details of the error that occurred:
             # raise ex
             return 0
-        """
 
+    @instrumented
     def reroute_waste(self, fid: int, date: dt.date) -> int:
         """Reroute the trips to <fid> on day <date> to another facility that
         takes the same type of waste. If there are many such facilities, pick
@@ -575,16 +937,807 @@ class WasteWrangler:
 
         Assume this happens before any of the trips have reached <fid>.
         """
+        return self.reroute_waste_many([(fid, date, date)])[0]
+
+    @instrumented
+    def reroute_waste_many(self, reroutes: list[tuple[int, dt.date, dt.date]]) \
+            -> list[int]:
+        """For each (fid, first_day, last_day) in <reroutes>, reroute the trips
+        to <fid> from <first_day> to <last_day> inclusive to another facility,
+        as in reroute_waste.
+
+        All facilities are rerouted with a single UPDATE, and the trips are
+        selected with half-open timestamp ranges, so that an index on Trip's
+        fID and tTime can be used.
+
+        Return a list with the number of re-routed trips for each entry of
+        <reroutes>, in the same order. Entries may overlap: a trip covered by
+        more than one entry is re-routed once, and counted for the first of
+        them.
+
+        Your method should NOT return an error. If an error occurs, no trips
+        are re-routed and every count is 0.
+        """
+        if not reroutes:
+            return []
+        try:
+            with self._lease() as connection:
+                cursor = connection.cursor()
+                rerouted = pg_extras.execute_values(
+                    cursor, REROUTE_WASTE_SQL,
+                    [(i, fid, first_day, last_day)
+                     for i, (fid, first_day, last_day) in enumerate(reroutes)],
+                    template="(%s, %s, %s::date, %s::date)",
+                    page_size=len(reroutes), fetch=True)
+                connection.commit()
+
+                counts = [0] * len(reroutes)
+                for (i,) in rerouted:
+                    counts[i] = counts[i] + 1
+                return counts
+        except pg.Error:
+            return [0] * len(reroutes)
+
+    def explain(self, name: str, params: dict | list) -> list[str]:
+        """Run the statement PREPARED_STATEMENTS[<name>] with <params> under
+        EXPLAIN (ANALYZE, BUFFERS), and return the lines of its plan, with the
+        actual time and buffer usage of each node.
+
+        The statement is run inside a transaction that is rolled back, so
+        even statements that change the database leave it as it was.
+
+        Return an empty list if an error occurs. This method should NOT throw
+        an error.
+        """
         try:
-            # TODO: implement this method
-            pass
+            with self._lease() as connection:
+                return explain_analyze(connection.cursor(),
+                                       PREPARED_STATEMENTS[name], params)
+        except (pg.Error, KeyError):
+            return []
+
+    @instrumented
+    def refresh_facility_choice(self) -> bool:
+        """Refresh FacilityChoice if Facility has changed since it was last
+        refreshed, and commit.
+
+        This is also done every FACILITY_CHOICE_INTERVAL seconds by the first
+        method call to lease a connection, so it only needs to be called to
+        see a change to Facility sooner than that.
+
+        Return True iff FacilityChoice reflects every change to Facility that
+        was committed before the call. This method should NOT throw an error.
+        """
+        try:
+            with self._lease() as connection:
+                self._refresh_facility_choice(connection)
+                return True
+        except pg.Error:
+            return False
+
+    # =========================== Helper methods ============================= #
+
+    @contextmanager
+    def _lease(self) -> Iterator[pg_ext.connection]:
+        """Helper for the public methods. Yield the connection that a single
+        method call should use.
+
+        Without a pool, this is simply <connection>. In pooled mode, a
+        connection is checked out of <pool> and health-checked by re-applying
+        the search path; a connection that fails the check is discarded and
+        replaced by a fresh one, and the connection is given back to the pool
+        when the call is done. Either way, any transaction the call left open
+        is rolled back.
+
+        If every connection of the pool is leased, wait up to POOL_TIMEOUT
+        seconds for one to be given back, then raise pg_pool.PoolError and
+        count the timeout in retry_counts.
+        """
+        # read the attributes once: a concurrent connect or disconnect
+        # replaces them, and the connection must go back to the pool (and
+        # the slot to the semaphore) it came from
+        pool, slots, connection = self.pool, self._pool_slots, self.connection
+        if pool is None:
+            if connection is None:
+                raise pg.InterfaceError("not connected")
+            try:
+                self._check_facility_choice(connection)
+                yield connection
+            finally:
+                # leave no transaction open for the next call
+                if not connection.closed and \
+                        connection.get_transaction_status() != \
+                        pg_ext.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            return
+
+        # the pool itself raises rather than waits once every connection is
+        # leased, so calls wait for one of its slots first
+        if not slots.acquire(timeout=self.POOL_TIMEOUT):
+            with self._retry_lock:
+                self._retry_counts["pool_timeouts"] += 1
+            logger.warning("no pooled connection became available in %ss",
+                           self.POOL_TIMEOUT)
+            raise pg_pool.PoolError("connection pool exhausted")
+        try:
+            connection = self._checkout(pool)
+            try:
+                self._check_facility_choice(connection)
+                yield connection
+            finally:
+                broken = bool(connection.closed)
+                if not broken and connection.get_transaction_status() != \
+                        pg_ext.TRANSACTION_STATUS_IDLE:
+                    try:
+                        connection.rollback()
+                    except pg.Error:
+                        broken = True
+                if not pool.closed:
+                    pool.putconn(connection, close=broken)
+        finally:
+            slots.release()
+
+    def _close_connections(self) -> None:
+        """Helper for connect and disconnect. Close <connection> and <pool>,
+        whichever is open, and set both to None.
+        """
+        connection, pool = self.connection, self.pool
+        self.connection, self.pool, self._pool_slots = None, None, None
+        if connection and not connection.closed:
+            connection.close()
+        if pool and not pool.closed:
+            pool.closeall()
+
+    @staticmethod
+    def _check_migrations(connection: pg_ext.connection) -> None:
+        """Helper for connect. Use <connection> to log a warning for each
+        migration in migrations.py that has not been applied to its
+        database, and leave no transaction open.
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute("select version from schema_migrations;")
+            applied = {row[0] for row in cursor.fetchall()}
+        except pg_errors.UndefinedTable:
+            # no migration was ever applied
+            applied = set()
+        finally:
+            connection.rollback()
+            cursor.close()
+        for version, description in migrations.missing(applied):
+            logger.warning("migration %s (%s) has not been applied; run "
+                           "migrations.migrate", version, description)
+
+    @staticmethod
+    def _checkout(pool: pg_pool.ThreadedConnectionPool) -> pg_ext.connection:
+        """Helper for _lease. Return a healthy connection from <pool> with the
+        search path set to waste_wrangler.
+
+        Raise pg.Error if no healthy connection can be obtained.
+        """
+        for attempt in range(2):
+            connection = pool.getconn()
+            try:
+                # autocommit, so that the check is a single round trip and
+                # leaves no transaction open
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute("set search_path to waste_wrangler;")
+                connection.autocommit = False
+                return connection
+            except pg.Error:
+                pool.putconn(connection, close=True)
+                if attempt == 1:
+                    raise
+
+    def _check_facility_choice(self, connection: pg_ext.connection) -> None:
+        """Helper for _lease. Unless it was done less than
+        FACILITY_CHOICE_INTERVAL seconds ago, use <connection> to refresh
+        FacilityChoice if Facility has changed since it was last refreshed.
+
+        A failed refresh is logged and rolled back rather than raised, as the
+        call that leased <connection> can still go ahead with the view as it
+        is.
+        """
+        now = monotonic()
+        if now < self._facility_check_at:
+            return
+        # concurrent calls may both get here, which only costs a second check
+        self._facility_check_at = now + self.FACILITY_CHOICE_INTERVAL
+        try:
+            self._refresh_facility_choice(connection)
         except pg.Error as ex:
-            # You may find it helpful to uncomment this line while debugging,
-            # as it will show you all the details of the error that occurred:
-            # raise ex
+            logger.warning("could not refresh FacilityChoice: %s", ex)
+            if not connection.closed:
+                connection.rollback()
+
+    @staticmethod
+    def _refresh_facility_choice(connection: pg_ext.connection) -> None:
+        """Helper for refresh_facility_choice and _check_facility_choice. Use
+        <connection> to refresh FacilityChoice and empty FacilityChange if the
+        latter logs any change to Facility, and commit; otherwise, leave no
+        transaction open.
+
+        Raise pg.Error if the refresh fails.
+        """
+        cursor = connection.cursor()
+        cursor.execute(FACILITY_CHANGED_SQL)
+        changed = cursor.fetchone()[0]
+        if changed:
+            # the refresh starts after the delete, so it sees every change
+            # whose row is deleted; later changes leave their rows behind
+            # for the next refresh
+            cursor.execute(REFRESH_FACILITY_CHOICE_SQL)
+            connection.commit()
+        else:
+            connection.rollback()
+
+    def _retry(self, days: list[dt.date], attempt: Callable[..., T],
+               *args: object) -> T:
+        """Helper for the methods that schedule trips. Return
+        attempt(connection, *args), where connection is leased for the call,
+        and each of <days> that the attempt schedules trips on is locked by
+        _lock_days while it runs.
+
+        If the attempt loses a race with a concurrent caller, i.e. it fails
+        with one of RETRYABLE_ERRORS, it is rolled back and made again with
+        a fresh transaction, after a random delay that doubles with each
+        retry, up to MAX_RETRIES times. If <serializable> is True, every
+        attempt runs at the SERIALIZABLE isolation level.
+
+        Raise pg.Error if the last attempt fails, or on any other error.
+        """
+        for retry in range(self.MAX_RETRIES + 1):
+            try:
+                with self._lease() as connection, \
+                        self._lock_days(connection, days):
+                    # neither leaves a transaction open, so the isolation
+                    # level can still be set
+                    if self.serializable:
+                        with connection.cursor() as cursor:
+                            cursor.execute("set transaction isolation level "
+                                           "serializable;")
+                    return attempt(connection, *args)
+            except self.RETRYABLE_ERRORS:
+                with self._retry_lock:
+                    if retry == self.MAX_RETRIES:
+                        self._retry_counts["exhausted"] += 1
+                        raise
+                    self._retry_counts["retries"] += 1
+            # full jitter, so that the callers that collided spread out
+            sleep(random.uniform(0, self.RETRY_DELAY * 2 ** retry))
+
+    @contextmanager
+    def _lock_days(self, connection: pg_ext.connection,
+                   days: list[dt.date]) -> Iterator[None]:
+        """Helper for _retry. Hold a lock on each of <days> in the session of
+        <connection> while the block runs.
+
+        Calls that schedule trips on the same day thus take turns, and each
+        reads the trips that the one before it committed. The locks are taken
+        before the block's transaction begins, so that even at the SERIALIZABLE
+        isolation level its snapshot is taken once they are held; that level
+        alone doesn't see two calls that pick the same driver as a conflict,
+        as they only read Trip and collide in TripDriver. The days are locked
+        in ascending order, so that calls that lock several days can't
+        deadlock.
+        """
+        keys = [(day - dt.date(2000, 1, 1)).days for day in sorted(set(days))]
+        # autocommit, so that no transaction is left open
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(LOCK_DAYS_SQL, [self.DAY_LOCK, keys])
+        finally:
+            connection.autocommit = False
+        try:
+            yield
+        finally:
+            try:
+                connection.rollback()
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute(UNLOCK_DAYS_SQL, [self.DAY_LOCK, keys])
+                connection.autocommit = False
+            except pg.Error:
+                # the locks are released with the session, which mustn't
+                # go back to the pool holding them
+                connection.close()
+
+    def _try_schedule_trip(self, connection: pg_ext.connection, rid: int,
+                           time: dt.datetime) -> bool:
+        """Helper for schedule_trip. Make one attempt at scheduling the trip
+        using <connection>.
+        """
+        cursor = connection.cursor()
+        # pick the truck, the drivers and the facility and insert the
+        # trip in one statement; nothing is inserted if any is missing
+        execute_prepared(cursor, "schedule_trip", {"rid": rid, "time": time})
+        trip = cursor.fetchone()
+        if trip is None:
+            connection.rollback()
+            return False
+        connection.commit()
+        self._record_workmates([trip[1:]])
+        return True
+
+    def _try_schedule_trip_many(self, connection: pg_ext.connection,
+                                requests: list[tuple[int, dt.datetime]]) \
+            -> list[bool]:
+        """Helper for schedule_trip_many. Make one attempt at scheduling the
+        trips using <connection>.
+        """
+        results = [False] * len(requests)
+        days = sorted({time.date() for _, time in requests})
+        cursor = connection.cursor()
+        routes, facilities, trucks, drivers = \
+            self._load_trip_resources(cursor, [r for r, _ in requests])
+
+        availability = DayAvailability.load(cursor, days)
+
+        rows = []
+        for i, (rid, time) in enumerate(requests):
+            day = availability[time.date()]
+            if rid not in routes or day.route_scheduled(rid):
+                continue
+            waste_type, length = routes[rid]
+            end = trip_end(time, length)
+            if time.time() < dt.time(8, 0) or \
+                    end > dt.datetime.combine(time.date(),
+                                              dt.time(16, 0)):
+                continue
+            if waste_type not in facilities:
+                continue
+            choice = self._pick_truck_and_drivers(
+                trucks.get(waste_type, []), drivers, day, time, end)
+            if choice is None:
+                continue
+            tid, eid1, eid2 = choice
+            day.book_trip(rid, tid, eid1, eid2, time, end)
+            rows.append((rid, tid, time, eid1, eid2,
+                         facilities[waste_type]))
+            results[i] = True
+
+        if rows:
+            pg_extras.execute_values(
+                cursor, "insert into Trip values %s;", rows,
+                template="(%s, %s, %s, NULL, %s, %s, %s)",
+                page_size=len(rows))
+            connection.commit()
+            self._record_workmates([row[3:5] for row in rows])
+        return results
+
+    def _try_schedule_trips(self, connection: pg_ext.connection, tid: int,
+                            date: dt.date) -> int:
+        """Helper for schedule_trips. Make one attempt at scheduling the
+        trips using <connection>.
+        """
+        cursor = connection.cursor()
+
+        #get the trucktype of the given truck (from the reference cache, if enabled); there is nothing to schedule
+        #for a truck that doesn't exist
+        truck = self._truck_info(cursor, tid)
+        if truck is None:
             return 0
+        truck_type = truck[0]
+
+        #find the routes of a wastetype the truck can carry that have no trip on the given day, as one anti-join
+        #(which also picks up routes that never had a trip), along with their length and the lowest fid that can
+        #collect their waste, in ascending order of rid
+        execute_prepared(cursor, "free_routes",
+                         {"truck_type": truck_type, "day": date})
+        routes = cursor.fetchall()
+
+        #plan the day by the same rules as the other schedulers: a truck that already has a trip or maintenance that
+        #day gets none, the drivers are walked once in order of hiredate then eid to find the pair, and the trips
+        #follow each other 30 minutes apart from 8 a.m. for as long as the next one ends by 4 p.m.
+        day = DayAvailability.load(cursor, [date])[date]
+        rows = self._plan_truck_day(tid, truck_type, routes,
+                                    self._load_drivers(cursor), day)
+
+        #insert all trips at once, then commit
+        if rows:
+            pg_extras.execute_values(
+                cursor, "insert into Trip values %s;", rows,
+                template="(%s, %s, %s, NULL, %s, %s, %s)",
+                page_size=len(rows))
+            connection.commit()
+            self._record_workmates([rows[0][3:5]])
+
+        return len(rows)
+
+    def _try_schedule_trips_range(self, connection: pg_ext.connection,
+                                  tid: int, start: dt.date,
+                                  end: dt.date) -> int:
+        """Helper for schedule_trips_range. Make one attempt at scheduling
+        the trips using <connection>.
+        """
+        cursor = connection.cursor()
+        truck = self._truck_info(cursor, tid)
+        if truck is None:
+            return 0
+        truck_type = truck[0]
+        routes = self._truck_routes(cursor, truck_type)
+        drivers = self._load_drivers(cursor)
+        days = [start + dt.timedelta(days=i)
+                for i in range((end - start).days + 1)]
+        availability = DayAvailability.load(cursor, days)
+
+        rows = []
+        for day in days:
+            rows.extend(self._plan_truck_day(tid, truck_type, routes, drivers,
+                                             availability[day]))
+        if rows:
+            pg_extras.execute_values(
+                cursor, "insert into Trip values %s;", rows,
+                template="(%s, %s, %s, NULL, %s, %s, %s)",
+                page_size=len(rows))
+            connection.commit()
+            self._record_workmates([row[3:5] for row in rows])
+        return len(rows)
+
+    def _try_schedule_fleet(self, connection: pg_ext.connection,
+                            date: dt.date, tids: Optional[list[int]],
+                            workers: int) -> int:
+        """Helper for schedule_fleet. Make one attempt at scheduling the
+        trips using <connection>.
+        """
+        cursor = connection.cursor()
+        if tids is None:
+            cursor.execute("select tID, truckType from Truck order by tID;")
+        else:
+            cursor.execute("""
+                select tID, truckType from Truck
+                where tID = any(%s)
+                order by tID;
+            """, [list(tids)])
+        trucks = cursor.fetchall()
+        routes = {}
+        for truck_type in {truck_type for _, truck_type in trucks}:
+            routes[truck_type] = self._truck_routes(cursor, truck_type)
+        drivers = self._load_drivers(cursor)
+        day = DayAvailability.load(cursor, [date])[date]
+
+        # only the routes that are still free can be assigned
+        routes = {truck_type: [route for route in type_routes
+                               if not day.route_scheduled(route[0])]
+                  for truck_type, type_routes in routes.items()}
+        partitions = self._partition_truck_types(routes)
+        trucks = [(tid, truck_type) for tid, truck_type in trucks
+                  if not day.truck_booked(tid)]
+
+        excluded = set()
+        plans = {}
+        pairs = {}
+        dirty = set(range(len(partitions)))
+        executor = ProcessPoolExecutor(workers) \
+            if workers > 0 and len(partitions) > 1 else None
+        try:
+            while dirty:
+                # plan the routes of the partitions that changed
+                jobs = [(date,
+                         [truck for truck in trucks
+                          if truck[1] in partitions[i]
+                          and truck[0] not in excluded],
+                         {truck_type: routes[truck_type]
+                          for truck_type in partitions[i]})
+                        for i in sorted(dirty)]
+                if executor is None:
+                    results = [self._plan_partition(*job) for job in jobs]
+                else:
+                    results = executor.map(self._plan_partition, *zip(*jobs))
+                for result in results:
+                    plans.update(result)
+                dirty = set()
+
+                # allocate the driver pairs in ascending order of tID
+                assigned = set()
+                pairs = {}
+                for tid, truck_type in trucks:
+                    if tid in excluded or not plans.get(tid):
+                        continue
+                    pair = self._pick_day_drivers(
+                        [driver for driver in drivers
+                         if driver[0] not in assigned], day, truck_type)
+                    if pair is None:
+                        excluded.add(tid)
+                        plans[tid] = []
+                        dirty.update(i for i, partition in enumerate(partitions)
+                                     if truck_type in partition)
+                        break
+                    pairs[tid] = pair
+                    assigned.update(pair)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        rows = []
+        for tid, (eid1, eid2) in pairs.items():
+            for rid, start, end, fid in plans[tid]:
+                day.book_trip(rid, tid, eid1, eid2, start, end)
+                rows.append((rid, tid, start, eid1, eid2, fid))
+        if rows:
+            pg_extras.execute_values(
+                cursor, "insert into Trip values %s;", rows,
+                template="(%s, %s, %s, NULL, %s, %s, %s)",
+                page_size=len(rows))
+            connection.commit()
+            self._record_workmates([row[3:5] for row in rows])
+        return len(rows)
+
+    def _record_workmates(self, pairs: list[tuple[int, int]]) -> None:
+        """Helper for the methods that schedule trips. Add the driver <pairs>
+        of newly committed trips to <workmate_index>, if there is one.
+        """
+        if self.workmate_index is not None:
+            for eid1, eid2 in pairs:
+                self.workmate_index.add_pair(eid1, eid2)
+
+    def _reference(self, cursor: pg_ext.cursor, name: str,
+                   tables: tuple[str, ...], params: list) -> list[tuple]:
+        """Helper for the reference lookups. Return the rows of the prepared
+        statement <name> with <params>, which reads only <tables>, from
+        <reference_cache> if the cache is enabled, and using <cursor>
+        otherwise.
+        """
+        def load() -> list[tuple]:
+            execute_prepared(cursor, name, params)
+            return cursor.fetchall()
+
+        if self.reference_cache is None:
+            return load()
+        return self.reference_cache.get((name, *params), tables, load)
+
+    def _truck_info(self, cursor: pg_ext.cursor, tid: int) \
+            -> Optional[tuple[str, float]]:
+        """Helper for the methods that schedule trips. Return the truckType
+        and capacity of truck <tid>, or None if there is no such truck.
+        """
+        rows = self._reference(cursor, "truck_info", ("truck",), [tid])
+        return rows[0] if rows else None
+
+    def _truck_routes(self, cursor: pg_ext.cursor, truck_type: str) \
+            -> list[tuple[int, float, int]]:
+        """Helper for the methods that schedule a truck for a whole day.
+        Return the (rID, length, fID) of every route that trucks of
+        <truck_type> can carry, with the lowest fID that takes its waste, in
+        ascending order of rID.
+        """
+        return self._reference(cursor, "truck_routes",
+                               ("route", "facility", "trucktype"),
+                               [truck_type])
 
-    # =========================== Helper methods ============================= #
+    @staticmethod
+    def _load_trip_resources(cursor: pg_ext.cursor, rids: list[int]) \
+            -> tuple[dict[int, tuple[str, float]], dict[str, int],
+                     dict[str, list[tuple[int, str]]],
+                     list[tuple[int, dt.date, set[str]]]]:
+        """Helper for schedule_trip_many. Use <cursor> to read everything that
+        is needed to pick a truck, drivers and a facility for the routes
+        <rids>, and return it as a tuple of:
+            * The wastetype and length of each valid route in <rids>, by rID.
+            * The lowest fID of a facility for each wastetype.
+            * The trucks that can carry each wastetype, as (tID, truckType)
+              pairs ordered by capacity desc, then tID asc.
+            * Every driver, as (eID, hireDate, truck types they can drive)
+              ordered by hireDate asc, then eID asc.
+        """
+        cursor.execute("""
+            select rID, wasteType, length from Route where rID = any(%s);
+        """, [list(set(rids))])
+        routes = {rid: (waste_type, length)
+                  for rid, waste_type, length in cursor.fetchall()}
+
+        cursor.execute("""
+            select wasteType, first_fID from FacilityChoice;
+        """)
+        facilities = dict(cursor.fetchall())
+
+        cursor.execute("""
+            select tt.wasteType, t.tID, t.truckType
+            from Truck t join TruckType tt on t.truckType = tt.truckType
+            order by t.capacity desc, t.tID asc;
+        """)
+        trucks = {}
+        for waste_type, tid, truck_type in cursor.fetchall():
+            trucks.setdefault(waste_type, []).append((tid, truck_type))
+
+        return routes, facilities, trucks, WasteWrangler._load_drivers(cursor)
+
+    @staticmethod
+    def _load_drivers(cursor: pg_ext.cursor) \
+            -> list[tuple[int, dt.date, set[str]]]:
+        """Helper for the methods that schedule trips. Use <cursor> to read
+        every driver, as (eID, hireDate, truck types they can drive) ordered by
+        hireDate asc, then eID asc.
+        """
+        execute_prepared(cursor, "drivers", [])
+        return [(eid, hire_date, set(truck_types))
+                for eid, hire_date, truck_types in cursor.fetchall()]
+
+    @staticmethod
+    def _pick_truck_and_drivers(
+            trucks: list[tuple[int, str]],
+            drivers: list[tuple[int, dt.date, set[str]]],
+            day: 'DayAvailability', start: dt.datetime, end: dt.datetime) \
+            -> Optional[tuple[int, int, int]]:
+        """Helper for schedule_trip_many. Pick a truck from <trucks> and a pair
+        of drivers from <drivers> for a trip from <start> to <end>, using the
+        same priorities as schedule_trip, and return (tID, eID1, eID2) with
+        eID1 >= eID2. Return None if no truck has an available pair.
+
+        <trucks> and <drivers> are ordered by priority, and <day> holds what
+        is already booked on the day of the trip.
+        """
+        available = [(eid, truck_types) for eid, hire_date, truck_types
+                     in drivers
+                     if hire_date <= start.date()
+                     and day.driver_free(eid, start, end)]
+        if len(available) < 2:
+            return None
+        for tid, truck_type in trucks:
+            if not day.truck_free(tid, start, end):
+                continue
+            first, first_types = available[0]
+            for second, second_types in available[1:]:
+                if truck_type in first_types or truck_type in second_types:
+                    return tid, max(first, second), min(first, second)
+        return None
+
+    @staticmethod
+    def _pick_day_drivers(drivers: list[tuple[int, dt.date, set[str]]],
+                          day: 'DayAvailability', truck_type: str) \
+            -> Optional[tuple[int, int]]:
+        """Helper for _plan_truck_day. Return the pair (eID1, eID2), with
+        eID1 >= eID2, of the most experienced driver in <drivers> that has no
+        trip on <day>, and the next most experienced such driver for which at
+        least one of the two can drive <truck_type>. Return None if there is
+        no such pair.
+
+        <drivers> is ordered by priority. It is walked once, and only up to
+        the second driver of the pair.
+        """
+        first, first_types = None, set()
+        for eid, hire_date, truck_types in drivers:
+            if hire_date > day.day or day.driver_has_trip(eid):
+                continue
+            if first is None:
+                first, first_types = eid, truck_types
+            elif truck_type in first_types or truck_type in truck_types:
+                return max(first, eid), min(first, eid)
+        return None
+
+    @staticmethod
+    def _plan_truck_day(tid: int, truck_type: str,
+                        routes: list[tuple[int, float, int]],
+                        drivers: list[tuple[int, dt.date, set[str]]],
+                        day: 'DayAvailability') \
+            -> list[tuple[int, int, dt.datetime, int, int, int]]:
+        """Helper for the methods that schedule a truck for a whole day.
+        Plan the trips of truck <tid>, of type <truck_type>, on <day> as
+        described in schedule_trips, and return them as (rID, tID, tTime,
+        eID1, eID2, fID) rows to insert into Trip. <day> is updated with the
+        new trips.
+
+        <routes> holds the (rID, length, fID) of every route that the truck
+        can carry, with the lowest fID that takes its waste, in ascending
+        order of rID; <drivers> is ordered by priority. No trips are planned
+        if the truck already has a trip or maintenance on <day>.
+        """
+        if day.truck_booked(tid):
+            return []
+        pair = WasteWrangler._pick_day_drivers(drivers, day, truck_type)
+        if pair is None:
+            return []
+        eid1, eid2 = pair
+
+        rows = []
+        for rid, start, end, fid in WasteWrangler._plan_truck_routes(
+                day.day, [route for route in routes
+                          if not day.route_scheduled(route[0])]):
+            day.book_trip(rid, tid, eid1, eid2, start, end)
+            rows.append((rid, tid, start, eid1, eid2, fid))
+        return rows
+
+    @staticmethod
+    def _plan_truck_routes(date: dt.date,
+                           routes: list[tuple[int, float, int]]) \
+            -> list[tuple[int, dt.datetime, dt.datetime, int]]:
+        """Helper for the methods that schedule a truck for a whole day.
+        Return the (rID, start, end, fID) of the trips that a truck makes on
+        <date>, taking the (rID, length, fID) <routes> in the order given from
+        8 a.m., 30 minutes apart, until the next trip would end after 4 p.m.
+        """
+        trips = []
+        start = dt.datetime.combine(date, dt.time(8, 0))
+        closing = dt.datetime.combine(date, dt.time(16, 0))
+        for rid, length, fid in routes:
+            end = trip_end(start, length)
+            # the last trip must end by 4 p.m.
+            if end > closing:
+                break
+            trips.append((rid, start, end, fid))
+            start = end + DayAvailability.BUFFER
+        return trips
+
+    @staticmethod
+    def _plan_partition(date: dt.date, trucks: list[tuple[int, str]],
+                        routes: dict[str, list[tuple[int, float, int]]]) \
+            -> dict[int, list[tuple[int, dt.datetime, dt.datetime, int]]]:
+        """Helper for schedule_fleet. Assign the unscheduled <routes> of each
+        truck type to the (tID, truckType) <trucks> on <date>, one truck at a
+        time in the order given, as _plan_truck_routes would if each truck
+        were scheduled on its own, and return the trips of each truck by tID.
+
+        This only reads its arguments, so that the partitions of a fleet can
+        be planned in separate processes.
+        """
+        taken = set()
+        plans = {}
+        for tid, truck_type in trucks:
+            plans[tid] = WasteWrangler._plan_truck_routes(
+                date, [route for route in routes.get(truck_type, [])
+                       if route[0] not in taken])
+            taken.update(trip[0] for trip in plans[tid])
+        return plans
+
+    @staticmethod
+    def _partition_truck_types(
+            routes: dict[str, list[tuple[int, float, int]]]) -> list[set[str]]:
+        """Helper for schedule_fleet. Split the truck types in <routes> into
+        the smallest groups such that no two types in different groups can
+        carry the same route, given the routes that each type can carry.
+        """
+        partitions = []
+        for truck_type, type_routes in routes.items():
+            rids = {route[0] for route in type_routes}
+            merged = ({truck_type}, rids)
+            for partition in partitions[:]:
+                if partition[1] & rids:
+                    partitions.remove(partition)
+                    merged[0].update(partition[0])
+                    merged[1].update(partition[1])
+            partitions.append(merged)
+        return [types for types, _ in partitions]
+
+    @staticmethod
+    def _plan_maintenance(trucks: list[tuple[int, str]],
+                          qualified_technicians: dict[str, list[int]],
+                          availability: dict[dt.date, 'DayAvailability'],
+                          first_day: dt.date) \
+            -> list[tuple[int, int, dt.date]]:
+        """Helper for schedule_maintenance. Assign a technician and a day to
+        each (tID, truckType) in <trucks>, greedily in the order given, and
+        return the (tID, eID, mDate) rows to insert into Maintenance.
+
+        Each truck gets the first day from <first_day> onwards on which it has
+        no trip or maintenance and one of the <qualified_technicians> of its
+        truck type is free, according to <availability>, and the qualified
+        technician with the lowest eID that is free on that day. Trucks that no technician is qualified for are
+        skipped. <availability> is updated with the new assignments.
+
+        Pre-condition: each list in <qualified_technicians> is in ascending
+        order.
+        """
+        maintenance = []
+        for tid, truck_type in trucks:
+            if truck_type not in qualified_technicians:
+                continue
+            day = first_day
+            technician_eid = None
+            while technician_eid is None:
+                if day not in availability:
+                    availability[day] = DayAvailability(day)
+                if not availability[day].truck_booked(tid):
+                    for eid in qualified_technicians[truck_type]:
+                        if availability[day].technician_free(eid):
+                            technician_eid = eid
+                            break
+                if technician_eid is None:
+                    day = day + dt.timedelta(days=1)
+            availability[day].book_maintenance(tid, technician_eid)
+            maintenance.append((tid, technician_eid, day))
+        return maintenance
 
     @staticmethod
     def _read_qualifications_file(file: TextIO) -> list[list[str, str, str]]:
@@ -600,25 +1753,436 @@ class WasteWrangler:
         Pre-condition:
             <file> follows the format given on the A2 handout.
         """
-        result = []
-        employee_info = []
+        return [list(entry) for entry in
+                WasteWrangler._iter_qualifications_file(file)]
+
+    @staticmethod
+    def _iter_qualifications_file(file: TextIO) -> Iterator[tuple[str, str,
+                                                                  str]]:
+        """Helper for update_technicians. Like _read_qualifications_file, but
+        yield the (first name, last name, truck type) of each entry in <file>
+        as it is read, so that only one entry is held in memory at a time.
+
+        Pre-condition:
+            <file> follows the format given on the A2 handout.
+        """
+        fname, lname = None, None
         for idx, line in enumerate(file):
             if idx % 2 == 0:
-                info = line.strip().split(' ')[-2:]
-                fname, lname = info
-                employee_info.extend([fname, lname])
+                fname, lname = line.strip().split(' ')[-2:]
             else:
-                employee_info.append(line.strip())
-                result.append(employee_info)
-                employee_info = []
+                yield fname, lname, line.strip()
 
+
+class ReferenceCache:
+    """An in-process cache of query results over the reference tables Route,
+    Facility, TruckType and Truck, which change far less often than they are
+    read.
+
+    Each result is kept for at most <ttl> seconds, and the least recently
+    used results are evicted beyond <max_entries>. A result is also dropped as
+    soon as one of the tables it was read from is invalidated, either
+    explicitly or by a notification on CHANNEL.
+
+    === Instance Attributes ===
+    ttl: the number of seconds for which a result is kept.
+    max_entries: the largest number of results kept at once.
+
+    === Private Attributes ===
+    _entries: the cached results by key, as (expiry time, tables read,
+        result), from least to most recently used.
+    _listener: connection that listens on CHANNEL, or None.
+    _lock: lock that guards _entries and _listener.
+    """
+    ttl: float
+    max_entries: int
+    _entries: OrderedDict[tuple, tuple[float, tuple[str, ...], object]]
+    _listener: Optional[pg_ext.connection]
+    _lock: threading.Lock
+
+    # The channel on which migration 3 notifies changes to the reference
+    # tables, with the (lowercase) name of the table as payload.
+    CHANNEL = "waste_wrangler_reference"
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 10000) -> None:
+        """Initialize an empty cache."""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, tables: tuple[str, ...],
+            load: Callable[[], object]) -> object:
+        """Return the result cached under <key>, or call <load> to compute it
+        from <tables> and cache it if there is none.
+        """
+        with self._lock:
+            self._drain()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                return entry[2]
+        result = load()
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, tables, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
         return result
 
+    def invalidate(self, table: Optional[str] = None) -> None:
+        """Drop every result read from <table>, or every result if <table> is
+        None.
+        """
+        with self._lock:
+            self._invalidate(table)
+
+    def listen(self, connection: pg_ext.connection) -> None:
+        """Invalidate the tables notified on CHANNEL from now on, using
+        <connection>, which this cache then owns.
+        """
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"listen {self.CHANNEL};")
+        with self._lock:
+            self._listener = connection
+
+    def close(self) -> None:
+        """Stop listening for notifications, and drop every result."""
+        with self._lock:
+            if self._listener is not None and not self._listener.closed:
+                self._listener.close()
+            self._listener = None
+            self._invalidate(None)
+
+    def _invalidate(self, table: Optional[str]) -> None:
+        """Like invalidate.
+
+        Pre-condition: _lock is held by the caller.
+        """
+        if table is None:
+            self._entries.clear()
+            return
+        for key in [key for key, (_, tables, _) in self._entries.items()
+                    if table in tables]:
+            del self._entries[key]
+
+    def _drain(self) -> None:
+        """Apply the notifications received on <_listener> since the last
+        call, without blocking. If the connection is lost, drop every result
+        and fall back to expiry alone.
+
+        Pre-condition: _lock is held by the caller.
+        """
+        if self._listener is None:
+            return
+        try:
+            self._listener.poll()
+        except pg.Error:
+            self._listener = None
+            self._invalidate(None)
+            return
+        for notify in self._listener.notifies:
+            self._invalidate(notify.payload)
+        self._listener.notifies.clear()
+
+
+class WorkmateIndex:
+    """The connected components of the co-driver graph, i.e. the graph whose
+    vertices are employees and which has an edge between every two employees
+    that have been on a trip together, kept as a union-find.
+
+    Once loaded, the index is updated incrementally by adding the pair of
+    drivers of every new trip, so that a workmate sphere can be read without
+    walking the graph.
+
+    === Private Attributes ===
+    _parent: the parent of each employee in the union-find forest, by eID.
+    _members: the employees in the component of each root of the forest.
+    _lock: lock that guards the forest against concurrent updates.
+
+    Representation invariants:
+    - Every eID in _parent is in exactly one set of _members, namely the one
+      of its root.
+    """
+    _parent: dict[int, int]
+    _members: dict[int, set[int]]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        """Initialize an empty index."""
+        self._parent = {}
+        self._members = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, cursor: pg_ext.cursor) -> 'WorkmateIndex':
+        """Use <cursor> to read every pair of drivers from Trip, and return
+        an index of the components they form.
+        """
+        index = cls()
+        cursor.execute("select distinct eID1, eID2 from Trip;")
+        for eid1, eid2 in cursor.fetchall():
+            index.add_pair(eid1, eid2)
+        return index
+
+    def add_pair(self, eid1: int, eid2: int) -> None:
+        """Record that <eid1> and <eid2> have been on a trip together."""
+        with self._lock:
+            root1, root2 = self._find(eid1), self._find(eid2)
+            if root1 == root2:
+                return
+            # union by size: hang the smaller component under the larger one
+            if len(self._members[root1]) < len(self._members[root2]):
+                root1, root2 = root2, root1
+            self._parent[root2] = root1
+            self._members[root1].update(self._members.pop(root2))
+
+    def sphere(self, eid: int) -> list[int]:
+        """Return the eIDs of the employees in the same component as <eid>,
+        excluding <eid> itself.
+        """
+        with self._lock:
+            if eid not in self._parent:
+                return []
+            return [other for other in self._members[self._find(eid)]
+                    if other != eid]
+
+    def _find(self, eid: int) -> int:
+        """Return the root of the component of <eid>, adding <eid> as a
+        component of its own if it is not in the index yet.
+
+        Pre-condition: _lock is held by the caller.
+        """
+        if eid not in self._parent:
+            self._parent[eid] = eid
+            self._members[eid] = {eid}
+            return eid
+        root = eid
+        while self._parent[root] != root:
+            root = self._parent[root]
+        # path compression
+        while self._parent[eid] != root:
+            self._parent[eid], eid = root, self._parent[eid]
+        return root
+
+
+class DayAvailability:
+    """The trips and maintenance booked on a single day, indexed so that the
+    availability of a truck, driver or technician can be checked without
+    querying the database.
+
+    === Instance Attributes ===
+    day: the day that this availability is for.
+
+    === Private Attributes ===
+    _truck_trips: the start and end times of the trips of each truck on <day>,
+        by tID, as two lists sorted in ascending order.
+    _driver_trips: the start and end times of the trips of each driver on
+        <day>, by eID, as two lists sorted in ascending order.
+    _routes: the rIDs of the routes that have a trip on <day>.
+    _maintained_trucks: the tIDs of the trucks that have maintenance on <day>.
+    _busy_technicians: the eIDs of the technicians that maintain a truck on
+        <day>.
+
+    Representation invariants:
+    - The trips of a single truck or driver do not overlap, so that both the
+      start and the end times of its trips are sorted.
+    """
+    day: dt.date
+    _truck_trips: dict[int, tuple[list[dt.datetime], list[dt.datetime]]]
+    _driver_trips: dict[int, tuple[list[dt.datetime], list[dt.datetime]]]
+    _routes: set[int]
+    _maintained_trucks: set[int]
+    _busy_technicians: set[int]
+
+    # The time that trucks and drivers need between two trips.
+    BUFFER = dt.timedelta(minutes=30)
+
+    def __init__(self, day: dt.date) -> None:
+        """Initialize the availability of <day>, with nothing booked yet."""
+        self.day = day
+        self._truck_trips = {}
+        self._driver_trips = {}
+        self._routes = set()
+        self._maintained_trucks = set()
+        self._busy_technicians = set()
+
+    @classmethod
+    def load(cls, cursor: pg_ext.cursor, days: list[dt.date]) \
+            -> dict[dt.date, 'DayAvailability']:
+        """Use <cursor> to read the trips and maintenance booked on <days>,
+        and return the availability of each of these days, by day.
+
+        This issues one query for Trip (joined to Route for the end times) and
+        one for Maintenance, regardless of the number of days.
+        """
+        availability = {day: cls(day) for day in days}
+        execute_prepared(cursor, "day_trips", {"first": min(days),
+                                               "last": max(days),
+                                               "days": list(days)})
+        for rid, tid, start, eid1, eid2, length in cursor.fetchall():
+            availability[start.date()].book_trip(
+                rid, tid, eid1, eid2, start, trip_end(start, length))
+
+        execute_prepared(cursor, "day_maintenance", [list(days)])
+        for tid, eid, day in cursor.fetchall():
+            availability[day].book_maintenance(tid, eid)
+        return availability
+
+    def book_trip(self, rid: int, tid: int, eid1: int, eid2: int,
+                  start: dt.datetime, end: dt.datetime) -> None:
+        """Record that truck <tid> and drivers <eid1> and <eid2> are on a trip
+        on route <rid> from <start> to <end>.
+        """
+        self._routes.add(rid)
+        for trips, key in [(self._truck_trips, tid),
+                           (self._driver_trips, eid1),
+                           (self._driver_trips, eid2)]:
+            starts, ends = trips.setdefault(key, ([], []))
+            i = bisect.bisect_right(starts, start)
+            starts.insert(i, start)
+            ends.insert(i, end)
+
+    def book_maintenance(self, tid: int, eid: int) -> None:
+        """Record that technician <eid> maintains truck <tid> on this day."""
+        self._maintained_trucks.add(tid)
+        self._busy_technicians.add(eid)
+
+    def route_scheduled(self, rid: int) -> bool:
+        """Return True iff route <rid> already has a trip on this day."""
+        return rid in self._routes
+
+    def truck_free(self, tid: int, start: dt.datetime,
+                   end: dt.datetime) -> bool:
+        """Return True iff truck <tid> has no maintenance on this day, and no
+        trip within BUFFER of a trip from <start> to <end>.
+        """
+        return tid not in self._maintained_trucks and \
+            self._free(self._truck_trips, tid, start, end)
+
+    def driver_free(self, eid: int, start: dt.datetime,
+                    end: dt.datetime) -> bool:
+        """Return True iff driver <eid> has no trip within BUFFER of a trip
+        from <start> to <end>.
+        """
+        return self._free(self._driver_trips, eid, start, end)
+
+    def driver_has_trip(self, eid: int) -> bool:
+        """Return True iff driver <eid> has any trip on this day."""
+        return eid in self._driver_trips
+
+    def truck_booked(self, tid: int) -> bool:
+        """Return True iff truck <tid> has any trip or maintenance on this
+        day.
+        """
+        return tid in self._truck_trips or tid in self._maintained_trucks
+
+    def technician_free(self, eid: int) -> bool:
+        """Return True iff technician <eid> maintains no truck on this day."""
+        return eid not in self._busy_technicians
+
+    def _free(self, trips: dict[int, tuple[list[dt.datetime],
+                                           list[dt.datetime]]],
+              key: int, start: dt.datetime, end: dt.datetime) -> bool:
+        """Return True iff none of the trips of <key> in <trips> is within
+        BUFFER of a trip from <start> to <end>, in O(log n) time.
+        """
+        if key not in trips:
+            return True
+        starts, ends = trips[key]
+        # the trips in starts[:i] start before the new trip (plus the buffer)
+        # ends; since they don't overlap, only the last one can still be
+        # running when the new trip (minus the buffer) starts
+        i = bisect.bisect_left(starts, end + self.BUFFER)
+        return i == 0 or ends[i - 1] <= start - self.BUFFER
+
+
+class PreparedConnection(InstrumentedConnection):
+    """A connection that keeps track of the statements in
+    PREPARED_STATEMENTS that have been prepared in its session, so that
+    execute_prepared prepares each of them once per connection.
+
+    === Instance Attributes ===
+    prepared: the names of the statements prepared in this session.
+    """
+    prepared: set[str]
+
+    def __init__(self, *args: object, **kwargs: object) -> None:
+        """Initialize a new connection, with no statements prepared yet."""
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def execute_prepared(cursor: pg_ext.cursor, name: str,
+                     params: dict | list) -> None:
+    """Use <cursor> to execute the statement PREPARED_STATEMENTS[<name>] with
+    <params>, which are given as for cursor.execute.
+
+    If the connection of <cursor> is a PreparedConnection, the statement is
+    prepared on the server the first time it is executed on that connection,
+    and executed by name with bound parameters from then on, so that it is
+    parsed and planned once per session rather than on every call. Other
+    connections execute the text of the statement as usual.
+    """
+    connection = cursor.connection
+    if not isinstance(connection, PreparedConnection):
+        cursor.execute(PREPARED_STATEMENTS[name], params)
+        return
+    statement, keys = _server_statement(PREPARED_STATEMENTS[name])
+    if name not in connection.prepared:
+        cursor.execute(f"prepare {name} as {statement}")
+        connection.prepared.add(name)
+    if not keys:
+        cursor.execute(f"execute {name};")
+        return
+    if isinstance(params, dict):
+        params = [params[key] for key in keys]
+    cursor.execute(f"execute {name} ({', '.join(['%s'] * len(keys))});",
+                   params)
+
+
+@functools.cache
+def _server_statement(statement: str) -> tuple[str, list[str | int]]:
+    """Helper for execute_prepared. Return <statement> with its %(key)s and
+    %s placeholders replaced by the $1, $2, ... of a server-side prepared
+    statement, and the key (or, for %s, the position) of each parameter in
+    order.
+    """
+    keys = []
+
+    def number(match: re.Match) -> str:
+        key = match.group(1)
+        if key is None:
+            # every %s is a parameter of its own
+            key = len(keys)
+        if key not in keys:
+            keys.append(key)
+        return f"${keys.index(key) + 1}"
+
+    return re.sub(r"%\((\w+)\)s|%s", number, statement), keys
+
+
+def trip_end(start: dt.datetime, length: float) -> dt.datetime:
+    """Return the end time of a trip that starts at <start> on a route of
+    <length> kilometers, assuming that trucks travel at an average of 5 kph.
+    """
+    return start + dt.timedelta(hours=length / 5)
+
 
 def setup(dbname: str, username: str, password: str, file_path: str) -> None:
     """Set up the testing environment for the database <dbname> using the
     username <username> and password <password> by importing the schema file
-    and the file containing the data at <file_path>.
+    and the file containing the data at <file_path>, and then applying the
+    migrations in migrations.py.
+
+    If <file_path> is a directory, it holds one CSV file per table instead,
+    named after the table in lower case (e.g. trip.csv) and starting with a
+    header of column names, as written by datagen.write_csv. These are loaded
+    with COPY, in foreign key order, and the secondary indexes and
+    constraints are built once the data is in rather than row by row; the
+    tables are analyzed at the end.
     """
     connection, cursor, schema_file, data_file = None, None, None, None
     try:
@@ -632,10 +2196,18 @@ def setup(dbname: str, username: str, password: str, file_path: str) -> None:
         schema_file = open("./waste_wrangler_schema.sql", "r")
         cursor.execute(schema_file.read())
 
-        data_file = open(file_path, "r")
-        cursor.execute(data_file.read())
+        if os.path.isdir(file_path):
+            _copy_data(cursor, file_path)
+        else:
+            data_file = open(file_path, "r")
+            cursor.execute(data_file.read())
 
-        connection.commit()
+        # bring the schema up to date (and commit)
+        migrations.migrate(connection)
+
+        if os.path.isdir(file_path):
+            cursor.execute("analyze;")
+            connection.commit()
     except Exception as ex:
         connection.rollback()
         raise Exception(f"Couldn't set up environment for tests: \n{ex}")
@@ -650,6 +2222,99 @@ def setup(dbname: str, username: str, password: str, file_path: str) -> None:
             data_file.close()
 
 
+def _copy_data(cursor: pg_ext.cursor, directory: str) -> None:
+    """Helper for setup. Use <cursor> to load the CSV file of each table of
+    the search path in <directory>, if there is one, with COPY.
+
+    The foreign keys, unique and exclusion constraints, and the indexes that
+    back no constraint are dropped first and recreated after the last table
+    is loaded, so that each is checked or built once over all of the data.
+    Primary keys are kept, since the foreign keys need them.
+    """
+    tables = _foreign_key_order(cursor)
+    cursor.execute("""
+        select conrelid::regclass::text, conname, contype,
+               pg_get_constraintdef(oid)
+        from pg_constraint
+        where connamespace = current_schema()::regnamespace
+          and contype in ('f', 'u', 'x')
+        order by contype = 'f' desc, conname;
+    """)
+    constraints = cursor.fetchall()
+    cursor.execute("""
+        select c.relname, pg_get_indexdef(i.indexrelid)
+        from pg_index i
+             join pg_class c on c.oid = i.indexrelid
+        where c.relnamespace = current_schema()::regnamespace
+          and not exists (select * from pg_constraint k
+                          where k.conindid = i.indexrelid
+                            and k.contype in ('p', 'u', 'x'))
+        order by c.relname;
+    """)
+    indexes = cursor.fetchall()
+
+    # drop the foreign keys before the constraints whose indexes they may use
+    for table, name, _, _ in constraints:
+        cursor.execute(pg_sql.SQL("alter table {} drop constraint {};").format(
+            pg_sql.Identifier(table), pg_sql.Identifier(name)))
+    for name, _ in indexes:
+        cursor.execute(pg_sql.SQL("drop index {};").format(
+            pg_sql.Identifier(name)))
+
+    for table in tables:
+        path = os.path.join(directory, table + ".csv")
+        if not os.path.isfile(path):
+            continue
+        with open(path, "r", newline="") as file:
+            columns = next(csv.reader([file.readline()]))
+            cursor.copy_expert(
+                pg_sql.SQL("copy {} ({}) from stdin with (format csv);")
+                .format(pg_sql.Identifier(table),
+                        pg_sql.SQL(", ").join(map(pg_sql.Identifier, columns))),
+                file)
+
+    for _, indexdef in indexes:
+        cursor.execute(indexdef)
+    for table, name, _, definition in reversed(constraints):
+        cursor.execute(pg_sql.SQL("alter table {} add constraint {} {};")
+                       .format(pg_sql.Identifier(table),
+                               pg_sql.Identifier(name),
+                               pg_sql.SQL(definition)))
+
+
+def _foreign_key_order(cursor: pg_ext.cursor) -> list[str]:
+    """Helper for _copy_data. Use <cursor> to return the names of the tables
+    of the search path, ordered so that every table comes after the tables
+    that its foreign keys refer to, and by name otherwise.
+
+    Must be called before the foreign keys are dropped.
+    """
+    cursor.execute("""
+        select c.relname, array_remove(array_agg(r.relname), null)
+        from pg_class c
+             left join pg_constraint k on k.conrelid = c.oid
+                                      and k.contype = 'f'
+                                      and k.confrelid <> c.oid
+             left join pg_class r on r.oid = k.confrelid
+        where c.relnamespace = current_schema()::regnamespace
+          and c.relkind = 'r'
+        group by c.relname;
+    """)
+    references = {table: set(referenced)
+                  for table, referenced in cursor.fetchall()}
+    order = []
+    while references:
+        ready = sorted(table for table, referenced in references.items()
+                       if not referenced & references.keys())
+        if not ready:
+            # a cycle of foreign keys; they are dropped during the load anyway
+            ready = sorted(references)
+        order.extend(ready)
+        for table in ready:
+            del references[table]
+    return order
+
+
 def test_preliminary() -> None:
     """Test preliminary aspects of the A2 methods."""
     ww = WasteWrangler()
@@ -751,6 +2416,71 @@ def test_preliminary() -> None:
         reroute_waste = ww.reroute_waste(1, dt.date(2023, 5, 3))
         assert reroute_waste == 1, \
             f"[Reroute Waste] Expected 1. Got {reroute_waste}"
+
+        # ----------------- Testing schedule_trip_many ------------------------#
+
+        # The second trip is on the same route on the same day as the first,
+        # so it is refused as schedule_trip would refuse it.
+        scheduled_trips = ww.schedule_trip_many([
+            (1, dt.datetime(2023, 5, 8, 8, 0)),
+            (1, dt.datetime(2023, 5, 8, 13, 0)),
+            (1, dt.datetime(2023, 5, 9, 8, 0))])
+        assert scheduled_trips == [True, False, True], \
+            f"[Schedule Trip Many] Expected [True, False, True], " \
+            f"Got {scheduled_trips}"
+
+        scheduled_trips = ww.schedule_trip_many([])
+        assert scheduled_trips == [], \
+            f"[Schedule Trip Many] Expected [], Got {scheduled_trips}"
+
+        # ------------------- Testing schedule_fleet --------------------------#
+
+        scheduled_trips = ww.schedule_fleet(dt.date(2023, 5, 12))
+        assert scheduled_trips == 1, \
+            f"[Schedule Fleet] Expected 1, Got {scheduled_trips}"
+
+        # The only route is now scheduled on that day
+        scheduled_trips = ww.schedule_fleet(dt.date(2023, 5, 12))
+        assert scheduled_trips == 0, \
+            f"[Schedule Fleet] Expected 0, Got {scheduled_trips}"
+
+        # ---------------- Testing build_workmate_index -----------------------#
+
+        built = ww.build_workmate_index()
+        assert built, f"[Build Workmate Index] Expected True, Got {built}"
+
+        workmate_sphere = ww.workmate_sphere(2023)
+        assert len(workmate_sphere) == 0, \
+            f"[Workmate Sphere] Expected [], Got {workmate_sphere}"
+
+        workmate_sphere = ww.workmate_sphere(3)
+        assert set(workmate_sphere) == {1, 2}, \
+            f"[Workmate Sphere] Expected {{1, 2}}, Got {workmate_sphere}"
+
+        # ----------------- Testing reroute_waste_many ------------------------#
+
+        # Facility 1 takes two trips from 5/8 to 5/9 and one from 5/10 to
+        # 5/12, and facility 2 takes none
+        reroute_waste = ww.reroute_waste_many([
+            (1, dt.date(2023, 5, 8), dt.date(2023, 5, 9)),
+            (1, dt.date(2023, 5, 10), dt.date(2023, 5, 12)),
+            (2, dt.date(2023, 5, 10), dt.date(2023, 5, 12))])
+        assert reroute_waste == [2, 1, 0], \
+            f"[Reroute Waste Many] Expected [2, 1, 0]. Got {reroute_waste}"
+
+        # ---------------- Testing schedule_trips_range -----------------------#
+
+        # Route 1 already has a trip on May 9, so only May 10 and 11 are left.
+        scheduled_trips = ww.schedule_trips_range(2, dt.date(2023, 5, 9),
+                                                  dt.date(2023, 5, 11))
+        assert scheduled_trips == 2, \
+            f"[Schedule Trips Range] Expected 2, Got {scheduled_trips}"
+
+        # This truck doesn't exist in our instance
+        scheduled_trips = ww.schedule_trips_range(2023, dt.date(2023, 5, 9),
+                                                  dt.date(2023, 5, 11))
+        assert scheduled_trips == 0, \
+            f"[Schedule Trips Range] Expected 0, Got {scheduled_trips}"
     finally:
         if qf and not qf.closed:
             qf.close()
@@ -0,0 +1,506 @@
+"""CSC343 Assignment 2
+
+=== Module Description ===
+
+This file contains the AsyncWasteWrangler class, an asyncio counterpart of
+a2.WasteWrangler for callers that run on an event loop.
+"""
+
+import asyncio
+import datetime as dt
+import logging
+import random
+from contextlib import asynccontextmanager
+from time import monotonic
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from typing import AsyncIterator, Awaitable, Callable, Optional, TextIO, \
+    TypeVar
+
+import migrations
+from a2 import (DAY_MAINTENANCE_SQL, DAY_TRIPS_SQL, DRIVERS_SQL,
+                FACILITY_CHANGED_SQL, FUTURE_MAINTENANCE_SQL, FUTURE_TRIPS_SQL,
+                LOCK_DAYS_SQL, REFRESH_FACILITY_CHOICE_SQL, REROUTE_WASTE_SQL,
+                SCHEDULE_TRIP_SQL, TRUCK_ROUTES_SQL, UNLOCK_DAYS_SQL,
+                WORKMATE_SPHERE_SQL, DayAvailability, WasteWrangler, trip_end)
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWasteWrangler:
+    """A class that can work with data conforming to the schema in
+    waste_wrangler_schema.ddl, like WasteWrangler, but whose methods are
+    coroutines that never block the event loop on database I/O.
+
+    Every method call leases its own connection from a pool, so many calls
+    can be in flight at once from a single event loop; calls beyond the size
+    of the pool wait for a connection to be given back.
+
+    The methods follow the same rules, and have the same return values, as
+    the WasteWrangler methods of the same name, and likewise never raise.
+    Their fixed statements are prepared on the server the first time that
+    each connection runs them, as with a2.execute_prepared.
+
+    === Instance Attributes ===
+    pool: pool of connections to a PostgreSQL database of a waste management
+    service, or None if not connected.
+
+    === Private Attributes ===
+    _facility_check_at: the monotonic time after which the next leased
+        connection is used to check whether FacilityChoice must be refreshed,
+        every WasteWrangler.FACILITY_CHOICE_INTERVAL seconds.
+
+    Representation invariants:
+    - The database to which pool connects conforms to the schema in
+      waste_wrangler_schema.ddl.
+    """
+    pool: Optional[AsyncConnectionPool]
+    _facility_check_at: float
+
+    # The errors with which a scheduling call loses a race with a concurrent
+    # one, as in WasteWrangler.RETRYABLE_ERRORS. The calls are retried as
+    # often, and take the same locks on the days they schedule, as those of
+    # WasteWrangler.
+    RETRYABLE_ERRORS = (psycopg.errors.SerializationFailure,
+                        psycopg.errors.DeadlockDetected)
+
+    def __init__(self) -> None:
+        """Initialize this AsyncWasteWrangler instance, with no database
+        connection yet.
+        """
+        self.pool = None
+        self._facility_check_at = 0.0
+
+    async def connect(self, dbname: str, username: str, password: str,
+                      min_connections: int = 1,
+                      max_connections: int = 10) -> bool:
+        """Open a pool holding between <min_connections> and
+        <max_connections> connections to the database <dbname>, using the
+        username <username> and password <password>, and assign it to the
+        instance attribute <pool>. The search path of every connection is
+        waste_wrangler.
+
+        Any pool opened by an earlier call is closed first. Log a warning if
+        any of the migrations in migrations.py has not been applied to the
+        database, as WasteWrangler.connect does.
+
+        Return True if the database could be reached, False otherwise.
+        I.e., do NOT throw an error if making the connection fails.
+
+        >>> ww = AsyncWasteWrangler()
+        >>> await ww.connect("csc343h-marinat", "marinat", "")
+        True
+        >>> await ww.connect("invalid", "nonsense", "incorrect")
+        False
+        """
+        kwargs = {"dbname": dbname, "user": username, "password": password,
+                  "options": "-c search_path=waste_wrangler"}
+        await self.disconnect()
+        self.pool = None
+        try:
+            # connect once up front, since the pool keeps retrying in the
+            # background rather than failing
+            connection = await psycopg.AsyncConnection.connect(**kwargs)
+            try:
+                await self._check_migrations(connection)
+            finally:
+                await connection.close()
+
+            self.pool = AsyncConnectionPool(
+                kwargs=kwargs,
+                min_size=min_connections, max_size=max_connections,
+                check=AsyncConnectionPool.check_connection, open=False)
+            await self.pool.open()
+            self._facility_check_at = 0.0
+            return True
+        except psycopg.Error:
+            self.pool = None
+            return False
+
+    async def disconnect(self) -> bool:
+        """Close this AsyncWasteWrangler's pool of connections, waiting for
+        the calls in flight to give theirs back.
+
+        Return True if closing the pool was successful, False otherwise.
+        I.e., do NOT throw an error if closing the pool failed.
+        """
+        try:
+            if self.pool and not self.pool.closed:
+                await self.pool.close()
+            return True
+        except psycopg.Error:
+            return False
+
+    async def schedule_trip(self, rid: int, time: dt.datetime) -> bool:
+        """Schedule a truck and two employees to the route identified
+        with <rid> at the given time stamp <time>, as in
+        WasteWrangler.schedule_trip.
+
+        Return True iff a trip has been scheduled successfully for the given
+        route. No changes are made to the database if scheduling fails.
+        """
+        try:
+            return await self._retry([time.date()], self._try_schedule_trip,
+                                     rid, time)
+        except psycopg.Error:
+            return False
+
+    async def schedule_trips(self, tid: int, date: dt.date) -> int:
+        """Schedule the truck identified with <tid> for trips on <date>, as
+        in WasteWrangler.schedule_trips_range for that single day.
+
+        Return the number of trips that were scheduled successfully.
+        """
+        if isinstance(date, dt.datetime):
+            date = date.date()
+        try:
+            return await self._retry([date], self._try_schedule_trips, tid,
+                                     date)
+        except psycopg.Error:
+            return 0
+
+    async def update_technicians(self, qualifications_file: TextIO) -> int:
+        """Given the open file <qualifications_file> that follows the format
+        described on the handout, record the technicians' new truck types, as
+        in WasteWrangler.update_technicians.
+
+        Return the number of valid entries, which are the ones applied.
+        """
+        entries = WasteWrangler._iter_qualifications_file(qualifications_file)
+        try:
+            async with self._lease() as connection:
+                cursor = connection.cursor()
+                await cursor.execute("""
+                    create temp table qualification_stage (
+                        name text,
+                        truckType text
+                    ) on commit drop;
+                """)
+                async with cursor.copy(
+                        "copy qualification_stage from stdin;") as copy:
+                    for fname, lname, truck_type in entries:
+                        await copy.write_row((fname + " " + lname, truck_type))
+
+                await cursor.execute("""
+                    insert into Technician
+                    select e.eID, s.truckType
+                    from qualification_stage s
+                         join Employee e on e.name = s.name
+                    where exists (select * from TruckType tt
+                                  where tt.truckType = s.truckType)
+                      and not exists (select * from Driver d
+                                      where d.eID = e.eID)
+                    on conflict do nothing;
+                """)
+                employee_added = cursor.rowcount
+                await connection.commit()
+                return employee_added
+        except psycopg.Error:
+            return 0
+
+    async def workmate_sphere(self, eid: int) -> list[int]:
+        """Return the workmate sphere of the driver identified by <eid>, as a
+        list of eIDs, as in WasteWrangler.workmate_sphere.
+
+        Return an empty list if an error occurs.
+        """
+        try:
+            async with self._lease() as connection:
+                cursor = connection.cursor()
+                await cursor.execute(WORKMATE_SPHERE_SQL, {"eid": eid},
+                                     prepare=True)
+                return [row[0] for row in await cursor.fetchall()]
+        except psycopg.Error:
+            return []
+
+    async def schedule_maintenance(self, date: dt.date) -> int:
+        """Schedule maintenance for every truck that is due for it, as in
+        WasteWrangler.schedule_maintenance.
+
+        Return the number of trucks that were successfully scheduled for
+        maintenance.
+        """
+        cutoff_date = date + dt.timedelta(days=-90)
+        try:
+            async with self._lease() as connection:
+                cursor = connection.cursor()
+                await cursor.execute("""
+                    select t1.tID, t1.truckType
+                    from Truck t1
+                    where not exists (select * from Maintenance t2
+                                      where t2.tID = t1.tID
+                                        and t2.mDate >= %s)
+                    order by t1.tID;
+                """, [cutoff_date])
+                trucks = await cursor.fetchall()
+
+                await cursor.execute("""
+                    select truckType, eID from Technician order by eID;
+                """)
+                qualified_technicians = {}
+                for truck_type, eid in await cursor.fetchall():
+                    qualified_technicians.setdefault(truck_type, []).append(eid)
+
+                await cursor.execute(FUTURE_MAINTENANCE_SQL, [date],
+                                     prepare=True)
+                availability = {}
+                for tid, eid, mdate in await cursor.fetchall():
+                    if mdate not in availability:
+                        availability[mdate] = DayAvailability(mdate)
+                    availability[mdate].book_maintenance(tid, eid)
+
+                await cursor.execute(FUTURE_TRIPS_SQL, {
+                    "date": date,
+                    "tids": [tid for tid, _ in trucks]}, prepare=True)
+                for rid, tid, start, eid1, eid2, length in \
+                        await cursor.fetchall():
+                    if start.date() not in availability:
+                        availability[start.date()] = \
+                            DayAvailability(start.date())
+                    availability[start.date()].book_trip(
+                        rid, tid, eid1, eid2, start, trip_end(start, length))
+
+                maintenance = WasteWrangler._plan_maintenance(
+                    trucks, qualified_technicians, availability,
+                    date + dt.timedelta(days=1))
+                if maintenance:
+                    await cursor.executemany("""
+                        insert into Maintenance values (%s, %s, %s);
+                    """, maintenance)
+                    await connection.commit()
+                return len(maintenance)
+        except psycopg.Error:
+            return 0
+
+    async def reroute_waste(self, fid: int, date: dt.date) -> int:
+        """Reroute the trips to <fid> on day <date> to another facility that
+        takes the same type of waste, as in WasteWrangler.reroute_waste.
+
+        Return the number of re-routed trips, or 0 if an error occurs.
+        """
+        try:
+            async with self._lease() as connection:
+                cursor = connection.cursor()
+                await cursor.execute(
+                    REROUTE_WASTE_SQL.replace(
+                        "%s", "(0, %s, %s::date, %s::date)"),
+                    [fid, date, date])
+                rerouted = cursor.rowcount
+                await connection.commit()
+                return rerouted
+        except psycopg.Error:
+            return 0
+
+    async def refresh_facility_choice(self) -> bool:
+        """Refresh FacilityChoice if Facility has changed since it was last
+        refreshed, as in WasteWrangler.refresh_facility_choice.
+
+        Return True iff FacilityChoice reflects every change to Facility that
+        was committed before the call.
+        """
+        try:
+            async with self._lease() as connection:
+                await self._refresh_facility_choice(connection)
+                return True
+        except psycopg.Error:
+            return False
+
+    # =========================== Helper methods ============================= #
+
+    @asynccontextmanager
+    async def _lease(self) -> AsyncIterator[psycopg.AsyncConnection]:
+        """Helper for the public methods. Yield a connection from <pool> for
+        a single method call, and give it back when the call is done.
+
+        Whatever transaction the call leaves open is rolled back, so that
+        only explicit commits take effect.
+
+        Raise psycopg.Error if not connected, or if no connection becomes
+        available in time.
+        """
+        if self.pool is None:
+            raise psycopg.InterfaceError("not connected")
+        async with self.pool.connection() as connection:
+            try:
+                await self._check_facility_choice(connection)
+                yield connection
+            finally:
+                if connection.info.transaction_status != \
+                        psycopg.pq.TransactionStatus.IDLE:
+                    await connection.rollback()
+
+    async def _check_facility_choice(
+            self, connection: psycopg.AsyncConnection) -> None:
+        """Helper for _lease. Unless it was done less than
+        WasteWrangler.FACILITY_CHOICE_INTERVAL seconds ago, use <connection>
+        to refresh FacilityChoice if Facility has changed since it was last
+        refreshed, logging rather than raising a failure.
+        """
+        now = monotonic()
+        if now < self._facility_check_at:
+            return
+        self._facility_check_at = now + WasteWrangler.FACILITY_CHOICE_INTERVAL
+        try:
+            await self._refresh_facility_choice(connection)
+        except psycopg.Error as ex:
+            logger.warning("could not refresh FacilityChoice: %s", ex)
+            if not connection.closed:
+                await connection.rollback()
+
+    @staticmethod
+    async def _refresh_facility_choice(
+            connection: psycopg.AsyncConnection) -> None:
+        """Helper for refresh_facility_choice and _check_facility_choice. Use
+        <connection> to refresh FacilityChoice and empty FacilityChange if the
+        latter logs any change to Facility, as in
+        WasteWrangler._refresh_facility_choice.
+        """
+        cursor = connection.cursor()
+        await cursor.execute(FACILITY_CHANGED_SQL)
+        if (await cursor.fetchone())[0]:
+            await cursor.execute(REFRESH_FACILITY_CHOICE_SQL)
+            await connection.commit()
+        else:
+            await connection.rollback()
+
+    @staticmethod
+    async def _check_migrations(connection: psycopg.AsyncConnection) -> None:
+        """Helper for connect. Use <connection> to log a warning for each
+        migration in migrations.py that has not been applied to its database.
+        """
+        cursor = connection.cursor()
+        try:
+            await cursor.execute("select version from schema_migrations;")
+            applied = {row[0] for row in await cursor.fetchall()}
+        except psycopg.errors.UndefinedTable:
+            # no migration was ever applied
+            applied = set()
+        finally:
+            await connection.rollback()
+        for version, description in migrations.missing(applied):
+            logger.warning("migration %s (%s) has not been applied; run "
+                           "migrations.migrate", version, description)
+
+    async def _try_schedule_trip(self, connection: psycopg.AsyncConnection,
+                                 rid: int, time: dt.datetime) -> bool:
+        """Helper for schedule_trip. Make one attempt at scheduling the trip
+        using <connection>.
+        """
+        cursor = connection.cursor()
+        await cursor.execute(SCHEDULE_TRIP_SQL, {"rid": rid, "time": time},
+                             prepare=True)
+        if await cursor.fetchone() is None:
+            await connection.rollback()
+            return False
+        await connection.commit()
+        return True
+
+    async def _try_schedule_trips(self, connection: psycopg.AsyncConnection,
+                                  tid: int, date: dt.date) -> int:
+        """Helper for schedule_trips. Make one attempt at scheduling the
+        trips using <connection>.
+        """
+        cursor = connection.cursor()
+        await cursor.execute("""
+            select truckType from Truck where tID = %s;
+        """, [tid])
+        truck = await cursor.fetchone()
+        if truck is None:
+            return 0
+        truck_type = truck[0]
+
+        await cursor.execute(TRUCK_ROUTES_SQL, [truck_type], prepare=True)
+        routes = await cursor.fetchall()
+        await cursor.execute(DRIVERS_SQL, prepare=True)
+        drivers = [(eid, hire_date, set(truck_types))
+                   for eid, hire_date, truck_types
+                   in await cursor.fetchall()]
+        day = (await self._load_availability(cursor, [date]))[date]
+
+        rows = WasteWrangler._plan_truck_day(tid, truck_type, routes, drivers,
+                                             day)
+        if rows:
+            await cursor.executemany("""
+                insert into Trip values (%s, %s, %s, NULL, %s, %s, %s);
+            """, rows)
+            await connection.commit()
+        return len(rows)
+
+    async def _retry(self, days: list[dt.date],
+                     attempt: Callable[..., Awaitable[T]],
+                     *args: object) -> T:
+        """Helper for the methods that schedule trips. Like
+        WasteWrangler._retry, return await attempt(connection, *args), where
+        connection is leased for the call and each of <days> is locked by
+        _lock_days while the attempt runs.
+
+        If the attempt fails with one of RETRYABLE_ERRORS, it is made again
+        with a fresh transaction, after a random delay that doubles with each
+        retry, up to WasteWrangler.MAX_RETRIES times.
+
+        Raise psycopg.Error if the last attempt fails, or on any other error.
+        """
+        for retry in range(WasteWrangler.MAX_RETRIES + 1):
+            try:
+                async with self._lease() as connection, \
+                        self._lock_days(connection, days):
+                    return await attempt(connection, *args)
+            except self.RETRYABLE_ERRORS:
+                if retry == WasteWrangler.MAX_RETRIES:
+                    raise
+            # full jitter, so that the callers that collided spread out
+            await asyncio.sleep(random.uniform(
+                0, WasteWrangler.RETRY_DELAY * 2 ** retry))
+
+    @asynccontextmanager
+    async def _lock_days(self, connection: psycopg.AsyncConnection,
+                         days: list[dt.date]) -> AsyncIterator[None]:
+        """Helper for _retry. Hold a lock on each of <days> in the session of
+        <connection> while the block runs, as WasteWrangler._lock_days does;
+        the locks are the same, so that the calls of both classes that
+        schedule trips on the same day take turns.
+        """
+        keys = [(day - dt.date(2000, 1, 1)).days for day in sorted(set(days))]
+        # autocommit, so that no transaction is left open
+        await connection.set_autocommit(True)
+        try:
+            await connection.execute(LOCK_DAYS_SQL,
+                                     [WasteWrangler.DAY_LOCK, keys])
+        finally:
+            await connection.set_autocommit(False)
+        try:
+            yield
+        finally:
+            try:
+                await connection.rollback()
+                await connection.set_autocommit(True)
+                await connection.execute(UNLOCK_DAYS_SQL,
+                                         [WasteWrangler.DAY_LOCK, keys])
+                await connection.set_autocommit(False)
+            except psycopg.Error:
+                # the locks are released with the session, which mustn't
+                # go back to the pool holding them
+                await connection.close()
+
+    @staticmethod
+    async def _load_availability(cursor: psycopg.AsyncCursor,
+                                 days: list[dt.date]) \
+            -> dict[dt.date, DayAvailability]:
+        """Helper for the methods that schedule trips. Like
+        DayAvailability.load, but through the async <cursor>.
+        """
+        availability = {day: DayAvailability(day) for day in days}
+        await cursor.execute(DAY_TRIPS_SQL, {"first": min(days),
+                                             "last": max(days),
+                                             "days": list(days)},
+                             prepare=True)
+        for rid, tid, start, eid1, eid2, length in await cursor.fetchall():
+            availability[start.date()].book_trip(
+                rid, tid, eid1, eid2, start, trip_end(start, length))
+
+        await cursor.execute(DAY_MAINTENANCE_SQL, [list(days)], prepare=True)
+        for tid, eid, day in await cursor.fetchall():
+            availability[day].book_maintenance(tid, eid)
+        return availability
@@ -0,0 +1,254 @@
+"""CSC343 Assignment 2
+
+=== Module Description ===
+
+This file contains a benchmark of the WasteWrangler methods. For each scale,
+it loads data made by datagen.py into a throwaway database, runs a fixed
+workload of method calls, and reports the wall time, statements and rows of
+each method as JSON, so that runs can be compared with each other.
+
+Run it from the command line against a local PostgreSQL server, e.g.
+    python benchmark.py --user postgres --scales small,medium \\
+        --output results.json
+
+The server is found as libpq finds it (e.g. through PGHOST and PGPORT), and
+the user must be allowed to create databases.
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+from time import perf_counter
+import psycopg2 as pg
+import psycopg2.sql as pg_sql
+
+import a2
+import datagen
+from metrics import CallSample, MetricsSink
+
+# The datagen.generate arguments of each scale.
+SCALES = {
+    "small": {"employees": 100, "trucks": 30, "routes": 50, "stops": 5,
+              "days": 30},
+    "medium": {"employees": 1000, "trucks": 200, "routes": 300, "stops": 10,
+               "days": 60},
+    "large": {"employees": 5000, "trucks": 1000, "routes": 1500, "stops": 10,
+              "days": 90},
+}
+
+
+class SampleSink(MetricsSink):
+    """A sink that keeps the sample of every call.
+
+    === Instance Attributes ===
+    samples: the samples of the calls, by method name, in the order the calls
+        were made.
+    """
+    samples: dict[str, list[CallSample]]
+
+    def __init__(self) -> None:
+        """Initialize a sink with no samples."""
+        self.samples = {}
+
+    def record(self, sample: CallSample) -> None:
+        """Keep <sample>."""
+        self.samples.setdefault(sample.method, []).append(sample)
+
+
+def run_scale(scale: str, params: dict[str, int], dbname: str, username: str,
+              password: str, repeat: int, seed: int) -> dict[str, object]:
+    """Load data of <scale>, generated with <params> and <seed>, into the
+    database <dbname>, replacing whatever it held, and run the workload with
+    <repeat> calls of each method that takes per-entity arguments.
+
+    Return the results of the scale, as a JSON-compatible dict.
+    """
+    end = dt.date(2023, 5, 1)
+    tables = datagen.generate(**params, end=end, seed=seed)
+    with tempfile.TemporaryDirectory() as directory:
+        data_path = os.path.join(directory, "data.sql")
+        with open(data_path, "w") as file:
+            datagen.write_sql(tables, file)
+        start = perf_counter()
+        a2.setup(dbname, username, password, data_path)
+        load_seconds = perf_counter() - start
+
+        qualifications_path = os.path.join(directory, "qualifications.txt")
+        with open(qualifications_path, "w") as file:
+            datagen.write_qualifications(tables, file, params["employees"],
+                                         seed)
+
+        ww = a2.WasteWrangler()
+        if not ww.connect(dbname, username, password):
+            raise RuntimeError(f"couldn't connect to {dbname}")
+        try:
+            ww.metrics = SampleSink()
+            _run_workload(ww, tables, end, repeat, seed, qualifications_path)
+            samples = ww.metrics.samples
+        finally:
+            ww.disconnect()
+
+    return {
+        "scale": scale,
+        "params": params,
+        "rows": {table: len(rows) for table, rows in tables.items()},
+        "load_seconds": load_seconds,
+        "methods": {method: _summarize(method_samples)
+                    for method, method_samples in sorted(samples.items())},
+    }
+
+
+def main() -> None:
+    """Run the benchmark with the options given on the command line, and
+    write its results as JSON to --output, or to standard output.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--user", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default="")
+    parser.add_argument("--scales", default="small,medium",
+                        help="comma-separated names among "
+                             + ", ".join(SCALES))
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="calls of each per-entity method per scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--keep", action="store_true",
+                        help="don't drop the database afterwards")
+    args = parser.parse_args()
+
+    scales = args.scales.split(",")
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown:
+        parser.error(f"unknown scales: {', '.join(unknown)}")
+
+    # a2.setup reads the schema from the current directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    dbname = f"ww_bench_{os.getpid()}"
+    server_version = _create_database(dbname, args.user, args.password)
+    try:
+        results = {
+            "started": dt.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "server_version": server_version,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "scales": [run_scale(scale, SCALES[scale], dbname, args.user,
+                                 args.password, args.repeat, args.seed)
+                       for scale in scales],
+        }
+    finally:
+        if not args.keep:
+            _drop_database(dbname, args.user, args.password)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+# ============================ Helper functions ============================== #
+
+def _run_workload(ww: a2.WasteWrangler, tables: dict[str, list[tuple]],
+                  end: dt.date, repeat: int, seed: int,
+                  qualifications_path: str) -> None:
+    """Helper for run_scale. Call each method of <ww> on the data <tables>,
+    whose trip history ends on <end>. New trips are scheduled on days after
+    <end>, each method on days of its own, so that the calls of one method
+    don't change the work that another one has to do.
+    """
+    rng = random.Random(seed)
+    rids = [row[0] for row in tables["Route"]]
+    tids = [row[0] for row in tables["Truck"]]
+    drivers = sorted({row[0] for row in tables["Driver"]})
+    fids = [row[0] for row in tables["Facility"]]
+
+    def day(offset: int) -> dt.date:
+        return end + dt.timedelta(days=offset)
+
+    for rid in rng.sample(rids, min(repeat, len(rids))):
+        ww.schedule_trip(rid, dt.datetime.combine(day(1), dt.time(8, 0)))
+    for tid in rng.sample(tids, min(repeat, len(tids))):
+        ww.schedule_trips(tid, dt.datetime.combine(day(2), dt.time(8, 0)))
+    for tid in rng.sample(tids, min(repeat, len(tids))):
+        ww.schedule_trips_range(tid, day(3), day(9))
+    ww.schedule_fleet(day(10))
+    for eid in rng.sample(drivers, min(repeat, len(drivers))):
+        ww.workmate_sphere(eid)
+    ww.build_workmate_index()
+    with open(qualifications_path) as file:
+        ww.update_technicians(file)
+    ww.schedule_maintenance(end)
+    for _ in range(repeat):
+        ww.reroute_waste(rng.choice(fids), day(-rng.randint(1, 30)))
+
+
+def _summarize(samples: list[CallSample]) -> dict[str, float]:
+    """Helper for run_scale. Return the summary of the calls of one method
+    with <samples>.
+    """
+    seconds = sorted(sample.seconds for sample in samples)
+    return {
+        "calls": len(samples),
+        "total_seconds": sum(seconds),
+        "mean_seconds": statistics.fmean(seconds),
+        "median_seconds": statistics.median(seconds),
+        "p95_seconds": seconds[min(len(seconds) - 1,
+                                   int(0.95 * len(seconds)))],
+        "max_seconds": seconds[-1],
+        "statements": sum(sample.statements for sample in samples),
+        "rows": sum(sample.rows for sample in samples),
+        "commits": sum(sample.commits for sample in samples),
+        "rollbacks": sum(sample.rollbacks for sample in samples),
+    }
+
+
+def _create_database(dbname: str, username: str, password: str) -> str:
+    """Helper for main. Create the empty database <dbname>, and return the
+    version of the server.
+    """
+    connection = _admin_connection(username, password)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(pg_sql.SQL("create database {} template template0 "
+                                   "encoding 'UTF8';")
+                       .format(pg_sql.Identifier(dbname)))
+        cursor.execute("show server_version;")
+        return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def _drop_database(dbname: str, username: str, password: str) -> None:
+    """Helper for main. Drop the database <dbname>, if it exists."""
+    connection = _admin_connection(username, password)
+    try:
+        connection.cursor().execute(
+            pg_sql.SQL("drop database if exists {};")
+            .format(pg_sql.Identifier(dbname)))
+    finally:
+        connection.close()
+
+
+def _admin_connection(username: str, password: str) \
+        -> pg.extensions.connection:
+    """Helper for _create_database and _drop_database. Return an autocommit
+    connection to the database postgres, since CREATE and DROP DATABASE can't
+    run inside a transaction.
+    """
+    connection = pg.connect(dbname="postgres", user=username,
+                            password=password)
+    connection.autocommit = True
+    return connection
+
+
+if __name__ == '__main__':
+    main()
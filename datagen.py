@@ -0,0 +1,366 @@
+"""CSC343 Assignment 2
+
+=== Module Description ===
+
+This file contains a generator of synthetic data for the schema in
+waste_wrangler_schema.sql, at any scale, written either as SQL insert
+statements (like waste_wrangler_data.sql) or as one CSV file per table.
+
+The generated data satisfies every constraint of the schema and of the
+migrations, and every assumption stated in the comments of the schema: no
+truck or driver is double-booked, each trip's truck carries its route's
+waste, at least one of its drivers can drive it, both were hired by the day
+of the trip, and its truck had maintenance in the 100 days before it.
+
+Run it from the command line, e.g.
+    python datagen.py --employees 2000 --trucks 400 --routes 600 --days 60 \\
+        --format csv --output bench_data
+"""
+
+import argparse
+import csv
+import datetime as dt
+import os
+import random
+from typing import Callable, TextIO
+
+# The tables of the schema, in an order in which they can be loaded without
+# violating a foreign key.
+TABLES = ["WasteType", "TruckType", "Truck", "Facility", "Employee", "Driver",
+          "Technician", "Maintenance", "Route", "Stop", "Trip"]
+
+# The columns of each table, in the order of the schema.
+COLUMNS = {
+    "WasteType": ["wasteType"],
+    "TruckType": ["truckType", "wasteType"],
+    "Truck": ["tID", "truckType", "capacity"],
+    "Facility": ["fID", "address", "wasteType"],
+    "Employee": ["eID", "name", "hireDate"],
+    "Driver": ["eID", "truckType"],
+    "Technician": ["eID", "truckType"],
+    "Maintenance": ["tID", "eID", "mDate"],
+    "Route": ["rID", "wasteType", "length"],
+    "Stop": ["address", "rID", "assistance"],
+    "Trip": ["rID", "tID", "tTime", "volume", "eID1", "eID2", "fID"],
+}
+
+# The waste types that each truck type can carry, as in
+# waste_wrangler_data.sql.
+TRUCK_TYPES = {
+    "A": ["plastic recycling", "paper recycling"],
+    "B": ["plastic recycling"],
+    "C": ["compost", "landfill"],
+    "D": ["large items", "electronic waste"],
+    "E": ["aluminum containers", "electronic waste"],
+}
+
+FIRST_NAMES = ["Ada", "Bao", "Chen", "Dara", "Emeka", "Farah", "Gus", "Hana",
+               "Ivan", "Juno", "Kofi", "Lena", "Milo", "Nia", "Omar", "Pia",
+               "Quinn", "Ravi", "Sana", "Tomas", "Uma", "Vera", "Wen", "Yuki"]
+
+STREETS = ["Bloor", "College", "Dundas", "Queen", "King", "Spadina", "Bathurst",
+           "Yonge", "Jarvis", "Parliament", "Ossington", "Dufferin"]
+
+# The earliest start of a trip; trips start on the hour or half hour, and end
+# by 16:00.
+FIRST_START = dt.time(8, 0)
+
+# Every truck has maintenance at least this often, in days, so that it has
+# had maintenance in the 100 days before each of its trips.
+MAINTENANCE_INTERVAL = 60
+
+
+def generate(employees: int = 100, trucks: int = 30, routes: int = 50,
+             stops: int = 10, days: int = 30,
+             technician_density: float = 0.25, facilities: int = 2,
+             trip_density: float = 0.8, end: dt.date = dt.date(2023, 5, 1),
+             seed: int = 0) -> dict[str, list[tuple]]:
+    """Return synthetic rows for every table in TABLES, as a dict from the
+    name of the table to its rows, with columns as in COLUMNS.
+
+    There are <employees> employees, a fraction <technician_density> of whom
+    are technicians and the rest drivers, <trucks> trucks, <routes> routes
+    of <stops> stops each, and <facilities> facilities per waste type. The
+    trip history covers the <days> days before <end>; on each day a fraction
+    of about <trip_density> of the routes gets a trip, as far as free trucks
+    and drivers allow. The same arguments, including <seed>, always give the
+    same rows.
+    """
+    rng = random.Random(seed)
+    first_day = end - dt.timedelta(days=days)
+    waste_types = sorted({waste for wastes in TRUCK_TYPES.values()
+                          for waste in wastes})
+    tables = {table: [] for table in TABLES}
+
+    tables["WasteType"] = [(waste,) for waste in waste_types]
+    tables["TruckType"] = [(truck_type, waste)
+                           for truck_type, wastes in TRUCK_TYPES.items()
+                           for waste in wastes]
+
+    truck_types = sorted(TRUCK_TYPES)
+    tables["Truck"] = [(tid, rng.choice(truck_types),
+                        float(rng.randint(10, 40)))
+                       for tid in range(1, trucks + 1)]
+
+    fid = 0
+    for waste in waste_types:
+        for _ in range(facilities):
+            fid = fid + 1
+            tables["Facility"].append((fid, _address(rng), waste))
+
+    # everyone has been hired by the first day of history, except for a few
+    # drivers hired during it, so that hire dates matter
+    technician_count = round(employees * technician_density)
+    for eid in range(1, employees + 1):
+        if eid > technician_count and rng.random() < 0.05:
+            hire_date = first_day + dt.timedelta(days=rng.randrange(days or 1))
+        else:
+            hire_date = first_day - dt.timedelta(days=rng.randint(1, 7000))
+        name = f"{rng.choice(FIRST_NAMES)} Worker{eid}"
+        tables["Employee"].append((eid, name, hire_date))
+        qualified = rng.sample(truck_types, rng.randint(1, 3))
+        table = "Technician" if eid <= technician_count else "Driver"
+        tables[table].extend((eid, truck_type)
+                             for truck_type in sorted(qualified))
+
+    tables["Maintenance"] = _maintenance(rng, tables, first_day, end)
+
+    for rid in range(1, routes + 1):
+        tables["Route"].append((rid, rng.choice(waste_types),
+                                float(rng.randint(5, 35))))
+        tables["Stop"].extend((f"{n} {_address(rng)}", rid, rng.random() < 0.1)
+                              for n in range(1, stops + 1))
+
+    tables["Trip"] = _trips(rng, tables, first_day, end, trip_density)
+    return tables
+
+
+def write_sql(tables: dict[str, list[tuple]], file: TextIO,
+              batch: int = 1000) -> None:
+    """Write <tables> to the open file <file> as insert statements of up to
+    <batch> rows each, in the order of TABLES, so that the file can be given
+    to a2.setup like waste_wrangler_data.sql.
+    """
+    for table in TABLES:
+        rows = tables[table]
+        for i in range(0, len(rows), batch):
+            values = ",\n".join(
+                "(" + ", ".join(_sql_literal(value) for value in row) + ")"
+                for row in rows[i:i + batch])
+            file.write(f"insert into {table.lower()} values\n{values};\n")
+
+
+def write_csv(tables: dict[str, list[tuple]], directory: str) -> None:
+    """Write each of <tables> to the CSV file <table>.csv, named in lower
+    case, in <directory>, which is created if it doesn't exist. Each file
+    starts with a header of the columns in COLUMNS.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for table in TABLES:
+        path = os.path.join(directory, table.lower() + ".csv")
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow([column.lower() for column in COLUMNS[table]])
+            writer.writerows(tables[table])
+
+
+def write_qualifications(tables: dict[str, list[tuple]], file: TextIO,
+                         entries: int, seed: int = 0) -> None:
+    """Write <entries> entries to the open file <file>, in the format of
+    qualifications.txt, for a2.WasteWrangler.update_technicians. Most are
+    valid new qualifications of technicians; the others name a driver, an
+    unknown employee or an unknown truck type.
+    """
+    rng = random.Random(seed)
+    names = {eid: name for eid, name, _ in tables["Employee"]}
+    technicians = sorted({eid for eid, _ in tables["Technician"]})
+    drivers = sorted({eid for eid, _ in tables["Driver"]})
+    truck_types = sorted(TRUCK_TYPES)
+    for _ in range(entries):
+        kind = rng.random()
+        if kind < 0.8 and technicians:
+            name, truck_type = names[rng.choice(technicians)], \
+                rng.choice(truck_types)
+        elif kind < 0.9 and drivers:
+            name, truck_type = names[rng.choice(drivers)], \
+                rng.choice(truck_types)
+        elif kind < 0.95:
+            name, truck_type = "Nobody Nowhere", rng.choice(truck_types)
+        else:
+            name, truck_type = names[rng.randint(1, len(names))], "Z"
+        file.write(f"{name}\n{truck_type}\n")
+
+
+# ============================ Helper functions ============================== #
+
+def _maintenance(rng: random.Random, tables: dict[str, list[tuple]],
+                 first_day: dt.date, end: dt.date) -> list[tuple]:
+    """Helper for generate. Return maintenance rows that give every truck
+    maintenance every MAINTENANCE_INTERVAL days or so, from before
+    <first_day> until <end>, by a qualified technician who maintains no other
+    truck that day. Trucks with no qualified technician get no maintenance.
+    """
+    technicians = {}
+    for eid, truck_type in tables["Technician"]:
+        technicians.setdefault(truck_type, []).append(eid)
+    booked = set()
+    rows = []
+    for tid, truck_type, _ in tables["Truck"]:
+        qualified = technicians.get(truck_type, [])
+        if not qualified:
+            continue
+        day = first_day - dt.timedelta(days=rng.randint(1, 90))
+        while day < end:
+            free = [eid for eid in qualified if (eid, day) not in booked]
+            if free:
+                eid = rng.choice(free)
+                booked.add((eid, day))
+                rows.append((tid, eid, day))
+            day = day + dt.timedelta(
+                days=rng.randint(MAINTENANCE_INTERVAL // 2,
+                                 MAINTENANCE_INTERVAL))
+    return rows
+
+
+def _trips(rng: random.Random, tables: dict[str, list[tuple]],
+           first_day: dt.date, end: dt.date,
+           trip_density: float) -> list[tuple]:
+    """Helper for generate. Return trip rows for every day from <first_day>
+    until <end>, giving about a fraction <trip_density> of the routes a trip
+    each day. Every truck and driver makes at most one trip a day, so none is
+    double-booked, and no truck makes a trip on a day of its maintenance.
+    """
+    # trucks with no qualified technician never had maintenance, so they
+    # make no trips
+    maintained = {tid for tid, _, _ in tables["Maintenance"]}
+    trucks_by_waste = {}
+    capacities = {}
+    for tid, truck_type, capacity in tables["Truck"]:
+        capacities[tid] = capacity
+        if tid in maintained:
+            for waste in TRUCK_TYPES[truck_type]:
+                trucks_by_waste.setdefault(waste, []).append((tid, truck_type))
+    hire_dates = {eid: hire_date for eid, _, hire_date in tables["Employee"]}
+    drivers_by_type = {}
+    for eid, truck_type in tables["Driver"]:
+        drivers_by_type.setdefault(truck_type, []).append(eid)
+    drivers = sorted({eid for eid, _ in tables["Driver"]})
+    facilities = {}
+    for fid, _, waste in tables["Facility"]:
+        facilities.setdefault(waste, fid)
+    in_maintenance = {(tid, mdate) for tid, _, mdate in tables["Maintenance"]}
+
+    rows = []
+    day = first_day
+    while day < end:
+        busy_trucks = set()
+        busy_drivers = set()
+
+        def truck_free(truck: tuple[int, str]) -> bool:
+            return truck[0] not in busy_trucks \
+                and (truck[0], day) not in in_maintenance
+
+        def driver_free(eid: int) -> bool:
+            return eid not in busy_drivers and hire_dates[eid] <= day
+
+        for rid, waste, length in tables["Route"]:
+            if rng.random() >= trip_density:
+                continue
+            truck = _pick(rng, trucks_by_waste.get(waste, []), truck_free)
+            if truck is None:
+                continue
+            tid, truck_type = truck
+            eid1 = _pick(rng, drivers_by_type.get(truck_type, []),
+                         driver_free)
+            if eid1 is None:
+                continue
+            eid2 = _pick(rng, drivers,
+                         lambda eid: eid != eid1 and driver_free(eid))
+            if eid2 is None:
+                continue
+
+            busy_trucks.add(tid)
+            busy_drivers.update([eid1, eid2])
+            # start on the hour or half hour, early enough to end by 16:00
+            latest = int((8 - length / 5) * 2)
+            start = dt.datetime.combine(day, FIRST_START) \
+                + dt.timedelta(minutes=30 * rng.randint(0, max(latest, 0)))
+            volume = round(rng.uniform(0.2, 1.0) * capacities[tid], 1)
+            rows.append((rid, tid, start, volume, max(eid1, eid2),
+                         min(eid1, eid2), facilities[waste]))
+        day = day + dt.timedelta(days=1)
+    return rows
+
+
+def _pick(rng: random.Random, candidates: list,
+          accept: Callable[[object], bool]) -> object:
+    """Helper for _trips. Return a random item of <candidates> for which
+    <accept> is true, or None if there is none.
+
+    A few random items are tried first, so that the whole list is only
+    filtered once most of its items have been taken.
+    """
+    if not candidates:
+        return None
+    for _ in range(10):
+        candidate = rng.choice(candidates)
+        if accept(candidate):
+            return candidate
+    accepted = [candidate for candidate in candidates if accept(candidate)]
+    return rng.choice(accepted) if accepted else None
+
+
+def _address(rng: random.Random) -> str:
+    """Helper for generate. Return a random street address."""
+    return f"{rng.randint(1, 999)} {rng.choice(STREETS)} St"
+
+
+def _sql_literal(value: object) -> str:
+    """Helper for write_sql. Return <value> as an SQL literal."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def main() -> None:
+    """Generate data with the parameters given on the command line, and write
+    it to the file or directory given by --output.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--employees", type=int, default=100)
+    parser.add_argument("--trucks", type=int, default=30)
+    parser.add_argument("--routes", type=int, default=50)
+    parser.add_argument("--stops", type=int, default=10,
+                        help="stops per route")
+    parser.add_argument("--days", type=int, default=30,
+                        help="days of trip history before --end")
+    parser.add_argument("--technician-density", type=float, default=0.25,
+                        help="fraction of employees who are technicians")
+    parser.add_argument("--facilities", type=int, default=2,
+                        help="facilities per waste type")
+    parser.add_argument("--trip-density", type=float, default=0.8,
+                        help="fraction of routes with a trip each day")
+    parser.add_argument("--end", type=dt.date.fromisoformat,
+                        default=dt.date(2023, 5, 1))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["sql", "csv"], default="sql")
+    parser.add_argument("--output", required=True,
+                        help="SQL file, or directory of CSV files")
+    args = parser.parse_args()
+
+    tables = generate(args.employees, args.trucks, args.routes, args.stops,
+                      args.days, args.technician_density, args.facilities,
+                      args.trip_density, args.end, args.seed)
+    if args.format == "csv":
+        write_csv(tables, args.output)
+    else:
+        with open(args.output, "w") as file:
+            write_sql(tables, file)
+
+
+if __name__ == '__main__':
+    main()
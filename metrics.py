@@ -0,0 +1,353 @@
+"""CSC343 Assignment 2
+
+=== Module Description ===
+
+This file contains the instrumentation of the WasteWrangler class: the
+samples recorded for each call of a public method, the sinks that they can
+be sent to, and the connection and cursor classes that count and time the
+SQL statements issued during a call.
+"""
+
+import bisect
+import contextvars
+import functools
+import logging
+import re
+import threading
+from time import perf_counter
+import psycopg2.extensions as pg_ext
+from typing import Callable, Optional
+
+# The upper bounds, in seconds, of the buckets of the statement timing
+# histograms.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float("inf"))
+
+# The sample of the instrumented call that is running in the current thread
+# (or task), if any.
+_current_call = contextvars.ContextVar("current_call", default=None)
+
+
+class CallSample:
+    """What a single call of an instrumented method did.
+
+    === Instance Attributes ===
+    method: the name of the method.
+    seconds: the wall time of the call.
+    statements: the number of SQL statements issued.
+    rows: the number of rows fetched.
+    commits: the number of commits.
+    rollbacks: the number of rollbacks.
+    statement_seconds: the wall time of each statement issued, as
+        (statement label, seconds) pairs in the order they were issued.
+    """
+    method: str
+    seconds: float
+    statements: int
+    rows: int
+    commits: int
+    rollbacks: int
+    statement_seconds: list[tuple[str, float]]
+
+    def __init__(self, method: str) -> None:
+        """Initialize the sample of a call of <method> that has done
+        nothing yet.
+        """
+        self.method = method
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.statement_seconds = []
+
+
+class MetricsSink:
+    """Where the samples of instrumented calls are sent. Subclasses decide
+    what to do with them.
+    """
+
+    def record(self, sample: CallSample) -> None:
+        """Record the sample of a call that has just finished."""
+        raise NotImplementedError
+
+
+class LoggingSink(MetricsSink):
+    """A sink that logs one line per call.
+
+    === Instance Attributes ===
+    logger: the logger that the lines are written to.
+    level: the level at which the lines are logged.
+    """
+    logger: logging.Logger
+    level: int
+
+    def __init__(self, logger: Optional[logging.Logger] = None,
+                 level: int = logging.INFO) -> None:
+        """Initialize a sink that logs to <logger> (or to this module's
+        logger, if <logger> is None) at <level>.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def record(self, sample: CallSample) -> None:
+        """Log <sample>, with its slowest statement."""
+        slowest = max(sample.statement_seconds, key=lambda s: s[1],
+                      default=("-", 0.0))
+        self.logger.log(
+            self.level,
+            "%s: %.3fs, %d statements, %d rows, %d commits, %d rollbacks; "
+            "slowest %s (%.3fs)",
+            sample.method, sample.seconds, sample.statements, sample.rows,
+            sample.commits, sample.rollbacks, slowest[0], slowest[1])
+
+
+class InMemorySink(MetricsSink):
+    """A sink that aggregates the samples in memory, per method and per
+    statement, and can render them in the Prometheus text format.
+
+    === Private Attributes ===
+    _methods: the totals of each method, by name, as a dict with the keys
+        "calls", "seconds", "statements", "rows", "commits" and "rollbacks".
+    _histograms: the timing histogram of each statement, by label, as (the
+        number of statements in each bucket of BUCKETS, the total seconds).
+    _lock: lock that guards _methods and _histograms.
+    """
+    _methods: dict[str, dict[str, float]]
+    _histograms: dict[str, tuple[list[int], float]]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        """Initialize a sink with no samples."""
+        self._methods = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, sample: CallSample) -> None:
+        """Add <sample> to the totals of its method and statements."""
+        with self._lock:
+            totals = self._methods.setdefault(sample.method, {
+                "calls": 0, "seconds": 0.0, "statements": 0, "rows": 0,
+                "commits": 0, "rollbacks": 0})
+            totals["calls"] += 1
+            totals["seconds"] += sample.seconds
+            totals["statements"] += sample.statements
+            totals["rows"] += sample.rows
+            totals["commits"] += sample.commits
+            totals["rollbacks"] += sample.rollbacks
+            for label, seconds in sample.statement_seconds:
+                counts, total = self._histograms.setdefault(
+                    label, ([0] * len(BUCKETS), 0.0))
+                counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+                self._histograms[label] = (counts, total + seconds)
+
+    def methods(self) -> dict[str, dict[str, float]]:
+        """Return a copy of the totals of each method, by name."""
+        with self._lock:
+            return {method: dict(totals)
+                    for method, totals in self._methods.items()}
+
+    def histograms(self) -> dict[str, tuple[list[int], float]]:
+        """Return a copy of the timing histogram of each statement, by
+        label, as (the number of statements in each bucket of BUCKETS, the
+        total seconds).
+        """
+        with self._lock:
+            return {label: (list(counts), total)
+                    for label, (counts, total) in self._histograms.items()}
+
+    def reset(self) -> None:
+        """Drop every sample recorded so far."""
+        with self._lock:
+            self._methods.clear()
+            self._histograms.clear()
+
+    def prometheus_text(self, prefix: str = "wastewrangler") -> str:
+        """Return the totals and histograms in the Prometheus text
+        exposition format, with metric names starting with <prefix>.
+        """
+        lines = []
+        methods = self.methods()
+        for key, kind in [("calls", "counter"), ("seconds", "counter"),
+                          ("statements", "counter"), ("rows", "counter"),
+                          ("commits", "counter"), ("rollbacks", "counter")]:
+            name = f"{prefix}_method_{key}_total"
+            lines.append(f"# TYPE {name} {kind}")
+            for method, totals in sorted(methods.items()):
+                lines.append(f'{name}{{method="{method}"}} {totals[key]}')
+
+        name = f"{prefix}_statement_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for label, (counts, total) in sorted(self.histograms().items()):
+            label = label.replace("\\", "\\\\").replace('"', '\\"')
+            cumulative = 0
+            for bound, count in zip(BUCKETS, counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_bucket{{statement="{label}",le="{le}"}} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{{statement="{label}"}} {total}')
+            lines.append(f'{name}_count{{statement="{label}"}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+
+def instrumented(method: Callable) -> Callable:
+    """Decorate a public method of a class with a <metrics> attribute, so
+    that each call records a CallSample into the sink self.metrics, unless it
+    is None.
+
+    A call made while another instrumented call is running in the same
+    thread (or task) is accounted to the outer call.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        sink = self.metrics
+        if sink is None or _current_call.get() is not None:
+            return method(self, *args, **kwargs)
+        sample = CallSample(method.__name__)
+        token = _current_call.set(sample)
+        start = perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            sample.seconds = perf_counter() - start
+            _current_call.reset(token)
+            sink.record(sample)
+    return wrapper
+
+
+class InstrumentedCursor(pg_ext.cursor):
+    """A cursor that counts and times its statements, and counts the rows
+    fetched through it, into the sample of the running instrumented call.
+    """
+
+    def execute(self, query, vars=None):
+        """Execute <query> with <vars>, as cursor.execute."""
+        sample = _current_call.get()
+        if sample is None:
+            return super().execute(query, vars)
+        start = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _count_statement(sample, query, perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        """Execute <query> once per item of <vars_list>, as
+        cursor.executemany.
+        """
+        sample = _current_call.get()
+        if sample is None:
+            return super().executemany(query, vars_list)
+        start = perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _count_statement(sample, query, perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        """Run the COPY statement <sql> with <file>, as cursor.copy_expert."""
+        sample = _current_call.get()
+        if sample is None:
+            return super().copy_expert(sql, file, size)
+        start = perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _count_statement(sample, sql, perf_counter() - start)
+
+    def fetchone(self):
+        """Return the next row, as cursor.fetchone."""
+        row = super().fetchone()
+        sample = _current_call.get()
+        if sample is not None and row is not None:
+            sample.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        """Return the next rows, as cursor.fetchmany."""
+        rows = super().fetchmany(size) if size is not None \
+            else super().fetchmany()
+        sample = _current_call.get()
+        if sample is not None:
+            sample.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        """Return the remaining rows, as cursor.fetchall."""
+        rows = super().fetchall()
+        sample = _current_call.get()
+        if sample is not None:
+            sample.rows += len(rows)
+        return rows
+
+
+class InstrumentedConnection(pg_ext.connection):
+    """A connection whose cursors are InstrumentedCursors, and whose commits
+    and rollbacks are counted into the sample of the running instrumented
+    call.
+    """
+
+    def __init__(self, *args: object, **kwargs: object) -> None:
+        """Initialize a new connection."""
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+
+    def commit(self) -> None:
+        """Commit the current transaction, as connection.commit."""
+        sample = _current_call.get()
+        if sample is not None:
+            sample.commits += 1
+        super().commit()
+
+    def rollback(self) -> None:
+        """Roll back the current transaction, as connection.rollback."""
+        sample = _current_call.get()
+        if sample is not None:
+            sample.rollbacks += 1
+        super().rollback()
+
+
+def explain_analyze(cursor: pg_ext.cursor, statement: str,
+                    params: dict | list) -> list[str]:
+    """Use <cursor> to run <statement> with <params> under EXPLAIN (ANALYZE,
+    BUFFERS), and return the lines of the plan, with actual times and buffer
+    usage.
+
+    The statement really runs, so the transaction of <cursor> is rolled back
+    afterwards, and any changes that it made are undone.
+    """
+    try:
+        cursor.execute("explain (analyze, buffers) " + statement, params)
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.connection.rollback()
+
+
+def _count_statement(sample: CallSample, query: str | bytes,
+                     seconds: float) -> None:
+    """Helper for InstrumentedCursor. Add a statement of <query> that took
+    <seconds> to <sample>.
+    """
+    sample.statements += 1
+    sample.statement_seconds.append((_statement_label(query), seconds))
+
+
+def _statement_label(query: str | bytes) -> str:
+    """Helper for _count_statement. Return the label under which <query> is
+    timed: the name of the statement for PREPARE and EXECUTE, and its first
+    60 characters otherwise.
+
+    psycopg2.extras.execute_values passes its statements with the rows
+    already rendered in, so everything from the first VALUES on is dropped;
+    this way every call of such a statement gets the same label, rather than
+    one label per set of rows.
+    """
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    match = re.match(r"\s*(?:prepare|execute)\s+(\w+)", query, re.IGNORECASE)
+    if match:
+        return match.group(1)
+    match = re.search(r"\bvalues\b", query, re.IGNORECASE)
+    if match:
+        query = query[:match.end()] + " ..."
+    return " ".join(query.split())[:60]
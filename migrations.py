@@ -0,0 +1,333 @@
+"""CSC343 Assignment 2
+
+=== Module Description ===
+
+This file contains the versioned migrations that are applied on top of
+waste_wrangler_schema.sql, and a check that the statements run by the
+WasteWrangler class use the indexes that these migrations add.
+"""
+
+import datetime as dt
+import json
+import psycopg2.extensions as pg_ext
+
+
+# The migrations, as (version, description, statements) triples in ascending
+# order of version. A migration must never be changed once it has been
+# applied somewhere; add a new one instead.
+MIGRATIONS = [
+    (1, "indexes for the Trip and Maintenance access patterns", """
+        -- workmate_sphere and driver availability look up the trips of a
+        -- driver, who may be either of the two drivers of a trip
+        create index trip_eid1_idx on Trip (eID1) include (eID2);
+        create index trip_eid2_idx on Trip (eID2) include (eID1);
+
+        -- availability checks and day loads scan the trips in a time range;
+        -- per-truck lookups are served by unique (tID, tTime)
+        create index trip_ttime_idx on Trip (tTime);
+
+        -- reroute_waste looks up the trips to a facility in a time range
+        create index trip_fid_ttime_idx on Trip (fID, tTime);
+
+        -- technician occupancy is read for a set of days or every day after
+        -- a date; per-truck lookups are served by the primary key
+        create index maintenance_mdate_idx on Maintenance (mDate)
+            include (tID, eID);
+    """),
+    (2, "busy interval of each trip, with overlap exclusion", """
+        -- A trip keeps its truck and drivers busy from its start until 30
+        -- minutes after its end (at 5 kph), so two trips of the same truck
+        -- or driver conflict iff their busy intervals overlap. The length
+        -- of a trip lives in Route, which a generated column can't refer
+        -- to, so busy is maintained by triggers instead.
+        alter table Trip add column busy tsrange;
+
+        create function trip_busy() returns trigger as $$
+        begin
+            select tsrange(new.tTime, new.tTime
+                                      + interval '1 hour' * r.length / 5
+                                      + interval '30 minutes')
+            into new.busy
+            from Route r
+            where r.rID = new.rID;
+            return new;
+        end;
+        $$ language plpgsql;
+
+        create trigger trip_busy
+            before insert or update of rID, tTime on Trip
+            for each row execute function trip_busy();
+
+        create function route_length_changed() returns trigger as $$
+        begin
+            update Trip
+            set busy = tsrange(tTime, tTime
+                                      + interval '1 hour' * new.length / 5
+                                      + interval '30 minutes')
+            where rID = new.rID;
+            return null;
+        end;
+        $$ language plpgsql;
+
+        create trigger route_length_changed
+            after update of length on Route
+            for each row execute function route_length_changed();
+
+        update Trip
+        set busy = tsrange(Trip.tTime, Trip.tTime
+                                       + interval '1 hour' * r.length / 5
+                                       + interval '30 minutes')
+        from Route r
+        where Trip.rID = r.rID;
+
+        alter table Trip alter column busy set not null;
+
+        -- reject double-booking of a truck; ranges of integers have
+        -- built-in GiST support, so no extension is needed
+        alter table Trip add constraint trip_truck_free
+            exclude using gist (int4range(tID, tID, '[]') with &&,
+                                busy with &&)
+            where (tID is not null);
+
+        -- a trip occupies both of its drivers, and an exclusion constraint
+        -- only compares a column with the same column of another row, so
+        -- the busy interval of each driver is kept in a table of its own
+        create table TripDriver (
+            rID integer,
+            tTime timestamp,
+            eID integer,
+            busy tsrange not null,
+            primary key (rID, tTime, eID),
+            constraint trip_driver_free
+                exclude using gist (int4range(eID, eID, '[]') with &&,
+                                    busy with &&)
+        );
+
+        create function trip_drivers() returns trigger as $$
+        begin
+            if tg_op <> 'INSERT' then
+                delete from TripDriver
+                where rID = old.rID and tTime = old.tTime;
+            end if;
+            if tg_op <> 'DELETE' then
+                insert into TripDriver
+                select distinct new.rID, new.tTime, e.eID, new.busy
+                from (values (new.eID1), (new.eID2)) e(eID);
+            end if;
+            return null;
+        end;
+        $$ language plpgsql;
+
+        create trigger trip_drivers
+            after insert or delete or update of rID, tTime, eID1, eID2, busy
+            on Trip
+            for each row execute function trip_drivers();
+
+        insert into TripDriver
+        select rID, tTime, eID1, busy from Trip
+        union
+        select rID, tTime, eID2, busy from Trip;
+
+        -- availability probes look for any trip overlapping an interval
+        create index trip_busy_idx on Trip using gist (busy);
+    """),
+    (3, "notify changes to the reference tables", """
+        -- a2.ReferenceCache listens on this channel, and drops what it has
+        -- read from the table named in the payload; notifications are only
+        -- delivered once the change commits
+        create function reference_changed() returns trigger as $$
+        begin
+            perform pg_notify('waste_wrangler_reference',
+                              lower(tg_table_name));
+            return null;
+        end;
+        $$ language plpgsql;
+
+        create trigger route_changed
+            after insert or update or delete or truncate on Route
+            for each statement execute function reference_changed();
+        create trigger facility_changed
+            after insert or update or delete or truncate on Facility
+            for each statement execute function reference_changed();
+        create trigger trucktype_changed
+            after insert or update or delete or truncate on TruckType
+            for each statement execute function reference_changed();
+        create trigger truck_changed
+            after insert or update or delete or truncate on Truck
+            for each statement execute function reference_changed();
+    """),
+    (4, "lowest and second lowest facility of each waste type", """
+        -- trips go to the facility with the lowest fID that takes their
+        -- waste, and are rerouted from it to the second lowest; Facility is
+        -- small and rarely changes, so the view is simply refreshed after
+        -- every statement that changes it
+        create materialized view FacilityChoice as
+        select wasteType,
+               min(fID) as first_fID,
+               (array_agg(fID order by fID))[2] as second_fID
+        from Facility
+        group by wasteType;
+
+        create unique index facility_choice_pkey
+            on FacilityChoice (wasteType);
+
+        create function refresh_facility_choice() returns trigger as $$
+        begin
+            refresh materialized view FacilityChoice;
+            return null;
+        end;
+        $$ language plpgsql;
+
+        create trigger facility_choice_refresh
+            after insert or update or delete or truncate on Facility
+            for each statement execute function refresh_facility_choice();
+    """),
+    (5, "refresh FacilityChoice without blocking its readers", """
+        -- a plain refresh holds an access exclusive lock on FacilityChoice
+        -- until the transaction that changed Facility ends, stalling every
+        -- scheduler that reads it; a concurrent refresh (which the unique
+        -- index allows) only excludes other refreshes and writes
+        create or replace function refresh_facility_choice()
+            returns trigger as $$
+        begin
+            refresh materialized view concurrently FacilityChoice;
+            return null;
+        end;
+        $$ language plpgsql;
+    """),
+    (6, "refresh FacilityChoice from the application", """
+        -- refreshing FacilityChoice in a trigger makes every statement that
+        -- changes Facility wait for the refresh, and requires its role to
+        -- own the view; the statements now only log that Facility changed,
+        -- and WasteWrangler.refresh_facility_choice refreshes the view once
+        -- for all the changes logged since the last refresh
+        drop trigger facility_choice_refresh on Facility;
+        drop function refresh_facility_choice();
+
+        create table FacilityChange (
+            changed timestamp not null default now()
+        );
+
+        create function facility_changed() returns trigger as $$
+        begin
+            insert into FacilityChange default values;
+            return null;
+        end;
+        $$ language plpgsql;
+
+        create trigger facility_choice_stale
+            after insert or update or delete or truncate on Facility
+            for each statement execute function facility_changed();
+    """),
+]
+
+
+def migrate(connection: pg_ext.connection) -> int:
+    """Apply every migration in MIGRATIONS that has not been applied yet to
+    the database of <connection>, and commit.
+
+    The applied versions are recorded in the table schema_migrations, which is
+    created if it does not exist. Concurrent callers are serialized on that
+    table, so each migration is applied once.
+
+    Return the number of migrations that were applied.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        create table if not exists schema_migrations (
+            version int primary key,
+            description text not null,
+            applied timestamp not null default now()
+        );
+    """)
+    cursor.execute("lock table schema_migrations in share row exclusive mode;")
+    cursor.execute("select version from schema_migrations;")
+    applied = {row[0] for row in cursor.fetchall()}
+
+    count = 0
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        cursor.execute(statements)
+        cursor.execute("""
+            insert into schema_migrations (version, description)
+            values (%s, %s);
+        """, [version, description])
+        count = count + 1
+    connection.commit()
+    cursor.close()
+    return count
+
+
+def missing(applied: set[int]) -> list[tuple[int, str]]:
+    """Return the version and description of each migration in MIGRATIONS
+    whose version is not in <applied>, in ascending order of version.
+    """
+    return [(version, description)
+            for version, description, _ in MIGRATIONS
+            if version not in applied]
+
+
+def check_index_usage(connection: pg_ext.connection) -> dict[str, bool]:
+    """Return, for each hot-path statement of WasteWrangler, whether its plan
+    on the database of <connection> uses every index it is expected to use.
+
+    Sequential scans are disabled while planning, so that the result tells
+    whether an index can serve the statement rather than whether a scan of a
+    small table is cheaper. Plans still depend on table statistics, so run
+    this against a database with representative (and analyzed) data. The
+    statements are only planned, never executed.
+    """
+    # imported here, since a2 imports this module
+    import a2
+
+    day = dt.date(2023, 5, 3)
+    time = dt.datetime(2023, 5, 3, 8, 0)
+    checks = [
+        ("schedule_trip", a2.SCHEDULE_TRIP_SQL,
+         {"rid": 1, "time": time}, {"trip_busy_idx"}),
+        ("workmate_sphere", a2.WORKMATE_SPHERE_SQL,
+         {"eid": 1}, {"trip_eid1_idx", "trip_eid2_idx"}),
+        ("reroute_waste",
+         a2.REROUTE_WASTE_SQL.replace("%s", "(0, %s, %s::date, %s::date)"),
+         [1, day, day], {"trip_fid_ttime_idx"}),
+        ("free_routes", a2.FREE_ROUTES_SQL,
+         {"truck_type": "A", "day": day}, {"trip_ttime_idx"}),
+        ("day_trips", a2.DAY_TRIPS_SQL,
+         {"first": day, "last": day, "days": [day]}, {"trip_ttime_idx"}),
+        ("day_maintenance", a2.DAY_MAINTENANCE_SQL,
+         [[day]], {"maintenance_mdate_idx"}),
+        ("future_maintenance", a2.FUTURE_MAINTENANCE_SQL,
+         [day], {"maintenance_mdate_idx"}),
+    ]
+
+    result = {}
+    cursor = connection.cursor()
+    try:
+        cursor.execute("set local enable_seqscan = off;")
+        for name, statement, params, expected in checks:
+            cursor.execute("explain (format json) " + statement, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            result[name] = expected <= _plan_indexes(plan)
+    finally:
+        connection.rollback()
+        cursor.close()
+    return result
+
+
+def _plan_indexes(plan: object) -> set[str]:
+    """Helper for check_index_usage. Return the names of all indexes used
+    anywhere in the JSON query plan <plan>.
+    """
+    names = set()
+    if isinstance(plan, dict):
+        if "Index Name" in plan:
+            names.add(plan["Index Name"])
+        for value in plan.values():
+            names.update(_plan_indexes(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            names.update(_plan_indexes(value))
+    return names
@@ -0,0 +1,1062 @@
+"""CSC343 Assignment 2
+
+=== Module Description ===
+
+This file contains tests of the WasteWrangler helpers that don't need a
+database, and tests of the WasteWrangler methods against a database, which
+run only if one is given.
+
+Run them with
+    python -m pytest -q
+
+To run the database tests as well, set WW_TEST_DBNAME (and WW_TEST_USER and
+WW_TEST_PASSWORD, if needed) to a database that may be overwritten.
+"""
+
+import asyncio
+import datetime as dt
+import io
+import os
+import random
+import threading
+from time import sleep
+import psycopg2 as pg
+import psycopg2.errors as pg_errors
+import psycopg2.extras as pg_extras
+import pytest
+from typing import Iterator
+
+import a2
+import datagen
+import migrations
+from a2 import DayAvailability, ReferenceCache, WasteWrangler, WorkmateIndex
+
+DAY = dt.date(2023, 5, 1)
+
+
+def at(hour: int, minute: int = 0) -> dt.datetime:
+    """Return the time <hour>:<minute> on DAY."""
+    return dt.datetime.combine(DAY, dt.time(hour, minute))
+
+
+# --------------------------- DayAvailability ------------------------------- #
+
+def test_day_availability_empty() -> None:
+    day = DayAvailability(DAY)
+    assert day.truck_free(1, at(8), at(9))
+    assert day.driver_free(1, at(8), at(9))
+    assert not day.truck_booked(1)
+    assert not day.driver_has_trip(1)
+    assert not day.route_scheduled(1)
+
+
+def test_day_availability_buffer_edges() -> None:
+    day = DayAvailability(DAY)
+    day.book_trip(1, 10, 2, 1, at(10), at(11))
+
+    # exactly BUFFER before or after the booked trip is allowed
+    assert day.truck_free(10, at(8), at(9, 30))
+    assert day.truck_free(10, at(11, 30), at(12))
+    # one minute less is not
+    assert not day.truck_free(10, at(8), at(9, 31))
+    assert not day.truck_free(10, at(11, 29), at(12))
+    # nor is any overlap
+    assert not day.truck_free(10, at(10, 30), at(10, 45))
+    assert not day.truck_free(10, at(9), at(12))
+
+    # both drivers are booked, other drivers and trucks are not
+    assert day.driver_free(2, at(11, 30), at(12))
+    assert not day.driver_free(1, at(11, 29), at(12))
+    assert day.driver_free(3, at(10), at(11))
+    assert day.truck_free(11, at(10), at(11))
+    assert day.route_scheduled(1)
+    assert day.truck_booked(10)
+    assert day.driver_has_trip(1) and day.driver_has_trip(2)
+
+
+def test_day_availability_between_trips() -> None:
+    day = DayAvailability(DAY)
+    # booked out of order, to check that the trips stay sorted
+    day.book_trip(2, 10, 2, 1, at(13), at(14))
+    day.book_trip(1, 10, 2, 1, at(8), at(9))
+
+    assert day.truck_free(10, at(9, 30), at(12, 30))
+    assert not day.truck_free(10, at(9, 30), at(12, 31))
+    assert not day.truck_free(10, at(9, 29), at(12, 30))
+    assert day.truck_free(10, at(14, 30), at(16))
+    assert day.truck_free(10, at(6), at(7, 30))
+
+
+def test_day_availability_maintenance() -> None:
+    day = DayAvailability(DAY)
+    day.book_maintenance(10, 5)
+    assert not day.truck_free(10, at(8), at(9))
+    assert day.truck_booked(10)
+    assert not day.technician_free(5)
+    assert day.technician_free(6)
+
+
+# ---------------------------- WorkmateIndex -------------------------------- #
+
+def test_workmate_index() -> None:
+    index = WorkmateIndex()
+    assert index.sphere(1) == []
+
+    index.add_pair(1, 2)
+    index.add_pair(3, 4)
+    assert set(index.sphere(1)) == {2}
+    assert set(index.sphere(4)) == {3}
+
+    index.add_pair(2, 3)
+    assert set(index.sphere(1)) == {2, 3, 4}
+    assert set(index.sphere(4)) == {1, 2, 3}
+
+    # pairs already in the same component change nothing
+    index.add_pair(4, 1)
+    index.add_pair(5, 5)
+    assert set(index.sphere(3)) == {1, 2, 4}
+    assert index.sphere(5) == []
+
+
+# -------------------------- _server_statement ------------------------------ #
+
+def test_server_statement_named() -> None:
+    statement, keys = a2._server_statement(
+        "select * from Trip where tID = %(tid)s and rID = %(rid)s "
+        "and eID1 = %(tid)s;")
+    assert statement == "select * from Trip where tID = $1 and rID = $2 " \
+                        "and eID1 = $1;"
+    assert keys == ["tid", "rid"]
+
+
+def test_server_statement_positional() -> None:
+    statement, keys = a2._server_statement(
+        "select * from Trip where tID = %s and rID = %s;")
+    assert statement == "select * from Trip where tID = $1 and rID = $2;"
+    assert keys == [0, 1]
+
+
+def test_server_statement_without_parameters() -> None:
+    assert a2._server_statement("select 1;") == ("select 1;", [])
+
+
+def test_prepared_statements_have_placeholders_of_one_kind() -> None:
+    for statement in a2.PREPARED_STATEMENTS.values():
+        _, keys = a2._server_statement(statement)
+        assert all(isinstance(key, str) for key in keys) \
+            or all(isinstance(key, int) for key in keys)
+
+
+# --------------------------- Planning helpers ------------------------------ #
+
+# (eID, hireDate, truck types), by priority
+DRIVERS = [
+    (4, dt.date(2010, 1, 1), {"B"}),
+    (2, dt.date(2015, 1, 1), set()),
+    (7, dt.date(2018, 1, 1), {"A"}),
+    (1, dt.date(2030, 1, 1), {"A", "B"}),
+]
+
+
+def test_pick_day_drivers() -> None:
+    day = DayAvailability(DAY)
+    # the first driver can drive B, so the next one is enough
+    assert WasteWrangler._pick_day_drivers(DRIVERS, day, "B") == (4, 2)
+    # neither 4 nor 2 can drive A, but 7 can
+    assert WasteWrangler._pick_day_drivers(DRIVERS, day, "A") == (7, 4)
+    # driver 1 isn't hired yet, and nobody else can drive C
+    assert WasteWrangler._pick_day_drivers(DRIVERS, day, "C") is None
+
+
+def test_pick_day_drivers_skips_busy_drivers() -> None:
+    day = DayAvailability(DAY)
+    day.book_trip(1, 10, 4, 3, at(8), at(9))
+    assert WasteWrangler._pick_day_drivers(DRIVERS, day, "B") is None
+    assert WasteWrangler._pick_day_drivers(DRIVERS, day, "A") == (7, 2)
+
+
+def test_plan_truck_routes() -> None:
+    # 10 km take 2 hours at 5 kph
+    routes = [(1, 10.0, 5), (2, 10.0, 6), (3, 10.0, 7), (4, 1.0, 8)]
+    trips = WasteWrangler._plan_truck_routes(DAY, routes)
+    assert trips == [(1, at(8), at(10), 5),
+                     (2, at(10, 30), at(12, 30), 6),
+                     (3, at(13), at(15), 7),
+                     (4, at(15, 30), at(15, 42), 8)]
+
+
+def test_plan_truck_routes_stops_at_closing() -> None:
+    # the second trip would end after 4 p.m., so the third isn't tried
+    routes = [(1, 25.0, 5), (2, 15.0, 6), (3, 1.0, 7)]
+    trips = WasteWrangler._plan_truck_routes(DAY, routes)
+    assert trips == [(1, at(8), at(13), 5)]
+
+    # a trip may end at 4 p.m. exactly
+    assert WasteWrangler._plan_truck_routes(DAY, [(1, 40.0, 5)]) \
+        == [(1, at(8), at(16), 5)]
+    assert WasteWrangler._plan_truck_routes(DAY, [(1, 40.1, 5)]) == []
+
+
+def test_plan_truck_day() -> None:
+    day = DayAvailability(DAY)
+    day.book_trip(2, 11, 7, 1, at(8), at(9))
+    rows = WasteWrangler._plan_truck_day(
+        10, "B", [(1, 10.0, 5), (2, 10.0, 6), (3, 10.0, 7)], DRIVERS, day)
+    # route 2 is taken, and drivers 4 and 2 are free all day
+    assert rows == [(1, 10, at(8), 4, 2, 5), (3, 10, at(10, 30), 4, 2, 7)]
+    assert day.route_scheduled(3)
+    assert day.truck_booked(10)
+
+    # the truck is booked now, so a second plan adds nothing
+    assert WasteWrangler._plan_truck_day(
+        10, "B", [(4, 1.0, 5)], DRIVERS, day) == []
+
+    # nor is a truck that has maintenance
+    day = DayAvailability(DAY)
+    day.book_maintenance(10, 8)
+    assert WasteWrangler._plan_truck_day(
+        10, "B", [(4, 10.0, 5)], DRIVERS, day) == []
+
+
+def test_plan_partition() -> None:
+    routes = {"A": [(1, 15.0, 5), (2, 15.0, 5), (3, 15.0, 5)],
+              "B": [(2, 15.0, 5), (4, 15.0, 6)]}
+    plans = WasteWrangler._plan_partition(
+        DAY, [(10, "A"), (11, "B"), (12, "A")], routes)
+    # each truck has time for two 3-hour trips, so truck 10 takes routes 1
+    # and 2, truck 11 is left with route 4 and truck 12 with route 3
+    assert [trip[0] for trip in plans[10]] == [1, 2]
+    assert [trip[0] for trip in plans[11]] == [4]
+    assert [trip[0] for trip in plans[12]] == [3]
+
+
+def test_partition_truck_types() -> None:
+    routes = {"A": [(1, 1.0, 5)], "B": [(2, 1.0, 5)],
+              "C": [(3, 1.0, 5), (1, 1.0, 5)], "D": [(2, 1.0, 5)],
+              "E": []}
+    partitions = WasteWrangler._partition_truck_types(routes)
+    assert sorted(sorted(types) for types in partitions) \
+        == [["A", "C"], ["B", "D"], ["E"]]
+
+
+def test_partition_truck_types_merges_chains() -> None:
+    # C shares a route with A and with B, so all three are one partition
+    routes = {"A": [(1, 1.0, 5)], "B": [(2, 1.0, 5)],
+              "C": [(1, 1.0, 5), (2, 1.0, 5)]}
+    assert WasteWrangler._partition_truck_types(routes) == [{"A", "B", "C"}]
+
+
+def test_plan_maintenance_skips_booked_days() -> None:
+    tomorrow = DAY + dt.timedelta(days=1)
+    availability = {DAY: DayAvailability(DAY),
+                    tomorrow: DayAvailability(tomorrow)}
+    availability[DAY].book_trip(1, 10, 2, 1, at(8), at(9))
+    availability[tomorrow].book_maintenance(20, 5)
+    rows = WasteWrangler._plan_maintenance(
+        [(10, "A"), (11, "A"), (12, "B")], {"A": [5, 6]}, availability, DAY)
+    # truck 10 has a trip on DAY, and technician 5 is busy the day after;
+    # nobody is qualified for truck 12
+    assert rows == [(10, 6, tomorrow), (11, 5, DAY)]
+    assert availability[tomorrow].truck_booked(10)
+
+
+# ---------------------------- ReferenceCache ------------------------------- #
+
+class Loader:
+    """A load function for ReferenceCache.get that counts its calls."""
+
+    def __init__(self, result: object) -> None:
+        self.result = result
+        self.calls = 0
+
+    def __call__(self) -> object:
+        self.calls += 1
+        return self.result
+
+
+def test_reference_cache_hit() -> None:
+    cache = ReferenceCache()
+    load = Loader([(1, "A")])
+    assert cache.get(("truck", 1), ("truck",), load) == [(1, "A")]
+    assert cache.get(("truck", 1), ("truck",), load) == [(1, "A")]
+    assert load.calls == 1
+
+
+def test_reference_cache_ttl() -> None:
+    cache = ReferenceCache(ttl=0.05)
+    load = Loader(1)
+    cache.get(("truck", 1), ("truck",), load)
+    sleep(0.1)
+    cache.get(("truck", 1), ("truck",), load)
+    assert load.calls == 2
+
+
+def test_reference_cache_evicts_least_recently_used() -> None:
+    cache = ReferenceCache(max_entries=2)
+    loads = {key: Loader(key) for key in "abc"}
+    cache.get(("a",), ("truck",), loads["a"])
+    cache.get(("b",), ("truck",), loads["b"])
+    # use a again, so that b is the least recently used
+    cache.get(("a",), ("truck",), loads["a"])
+    cache.get(("c",), ("truck",), loads["c"])
+
+    cache.get(("a",), ("truck",), loads["a"])
+    cache.get(("b",), ("truck",), loads["b"])
+    assert loads["a"].calls == 1
+    assert loads["b"].calls == 2
+
+
+def test_reference_cache_invalidate() -> None:
+    cache = ReferenceCache()
+    truck, route = Loader(1), Loader(2)
+    cache.get(("truck",), ("truck", "trucktype"), truck)
+    cache.get(("route",), ("route",), route)
+
+    cache.invalidate("trucktype")
+    cache.get(("truck",), ("truck", "trucktype"), truck)
+    cache.get(("route",), ("route",), route)
+    assert (truck.calls, route.calls) == (2, 1)
+
+    cache.invalidate()
+    cache.get(("truck",), ("truck", "trucktype"), truck)
+    cache.get(("route",), ("route",), route)
+    assert (truck.calls, route.calls) == (3, 2)
+
+
+# ---------------------------- Qualifications ------------------------------- #
+
+def test_iter_qualifications_file() -> None:
+    file = io.StringIO("Mr. Bertholt Brecht\nA\nClara Zetkin\nB\n")
+    entries = WasteWrangler._iter_qualifications_file(file)
+    assert next(entries) == ("Bertholt", "Brecht", "A")
+    # the rest of the file is not read until it is needed
+    assert file.tell() < len(file.getvalue())
+    assert list(entries) == [("Clara", "Zetkin", "B")]
+
+
+# ------------------------------ Database ----------------------------------- #
+
+DBNAME = os.environ.get("WW_TEST_DBNAME")
+USER = os.environ.get("WW_TEST_USER", os.environ.get("PGUSER", "postgres"))
+PASSWORD = os.environ.get("WW_TEST_PASSWORD", "")
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch) -> str:
+    """Return the directory of the CSV files of a small generated dataset,
+    and skip the test if no database is given or it can't be reached.
+    """
+    if not DBNAME:
+        pytest.skip("WW_TEST_DBNAME is not set")
+    try:
+        pg.connect(dbname=DBNAME, user=USER, password=PASSWORD).close()
+    except pg.Error as ex:
+        pytest.skip(f"can't connect to {DBNAME}: {ex}")
+    # a2.setup reads the schema from the current directory
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def sample(database: str) -> Iterator[WasteWrangler]:
+    """Load the sample data of the handout into the database, and return a
+    WasteWrangler connected to it.
+    """
+    a2.setup(DBNAME, USER, PASSWORD, "./waste_wrangler_data.sql")
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    yield ww
+    ww.disconnect()
+
+
+def query(ww: WasteWrangler, statement: str,
+          params: dict | list | None = None) -> list[tuple]:
+    """Return the rows of <statement> with <params>, read through <ww>."""
+    with ww._lease() as connection:
+        cursor = connection.cursor()
+        cursor.execute(statement, params)
+        rows = cursor.fetchall()
+        connection.rollback()
+        return rows
+
+
+def execute(ww: WasteWrangler, statement: str,
+            params: dict | list | None = None) -> None:
+    """Run <statement> with <params> through <ww>, and commit."""
+    with ww._lease() as connection:
+        try:
+            connection.cursor().execute(statement, params)
+            connection.commit()
+        except pg.Error:
+            connection.rollback()
+            raise
+
+
+def generate(directory: str, seed: int) -> dict[str, list[tuple]]:
+    """Write the CSV files of a small dataset generated with <seed>, whose
+    trip history ends on DAY, to <directory>, and return its tables.
+    """
+    tables = datagen.generate(employees=60, trucks=20, routes=40, days=5,
+                              end=DAY, seed=seed)
+    datagen.write_csv(tables, directory)
+    return tables
+
+
+def scheduled_trips(ww: WasteWrangler, day: dt.date) -> list[tuple]:
+    """Return the trips on <day>, ordered by truck and time."""
+    return query(ww, "select rID, tID, tTime, eID1, eID2, fID from Trip "
+                     "where tTime >= %s and tTime < %s "
+                     "order by tID, tTime;",
+                 [day, day + dt.timedelta(days=1)])
+
+
+def test_lease_ends_transaction(sample: WasteWrangler) -> None:
+    with sample._lease() as connection:
+        connection.cursor().execute("select * from Trip;")
+    assert sample.connection.get_transaction_status() \
+        == pg.extensions.TRANSACTION_STATUS_IDLE
+
+
+@pytest.mark.parametrize("reconnect", [False, True])
+def test_lease_across_reconnect(database: str, reconnect: bool) -> None:
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD, 0, 2)
+    with ww._lease() as connection:
+        connection.cursor().execute("select 1;")
+        # as another thread would, while this connection is leased
+        if reconnect:
+            assert ww.connect(DBNAME, USER, PASSWORD, 0, 2)
+        else:
+            assert ww.disconnect()
+    if reconnect:
+        # the old lease gave nothing back to the new pool, which still has
+        # both of its connections to lease
+        with ww._lease() as first, ww._lease() as second:
+            assert first is not second
+        assert ww.disconnect()
+
+
+def test_schedule_trip_sample(sample: WasteWrangler) -> None:
+    time = dt.datetime(2023, 5, 4, 8, 0)
+    assert sample.schedule_trip(1, time)
+    # the biggest truck that carries plastic recycling, the two most
+    # experienced drivers, one of whom can drive it, and the lowest facility
+    assert query(sample, "select rID, tID, volume, eID1, eID2, fID "
+                         "from Trip where tTime = %s;", [time]) \
+        == [(1, 1, None, 2, 1, 1)]
+
+    # the route already has a trip that day
+    assert not sample.schedule_trip(1, dt.datetime(2023, 5, 4, 13, 0))
+    # the 3-hour trip must start at 8 a.m. or later and end by 4 p.m.
+    assert not sample.schedule_trip(1, dt.datetime(2023, 5, 5, 7, 59))
+    assert not sample.schedule_trip(1, dt.datetime(2023, 5, 5, 13, 1))
+    assert sample.schedule_trip(1, dt.datetime(2023, 5, 5, 13, 0))
+    # there is no such route
+    assert not sample.schedule_trip(99, dt.datetime(2023, 5, 6, 8, 0))
+    assert len(query(sample, "select * from Trip;")) == 3
+
+
+def reference_sphere(ww: WasteWrangler, eid: int) -> set[int]:
+    """Return the workmate sphere of <eid>, found by a breadth-first search
+    over the driver pairs of every trip read through <ww>.
+    """
+    workmates = {}
+    for eid1, eid2 in query(ww, "select eID1, eID2 from Trip;"):
+        workmates.setdefault(eid1, set()).add(eid2)
+        workmates.setdefault(eid2, set()).add(eid1)
+    sphere, frontier = {eid}, [eid]
+    while frontier:
+        frontier = [other for current in frontier
+                    for other in workmates.get(current, ())
+                    if other not in sphere]
+        sphere.update(frontier)
+    return sphere - {eid}
+
+
+def test_schedule_trips_sample(sample: WasteWrangler) -> None:
+    assert sample.schedule_trip(1, dt.datetime(2023, 5, 4, 8, 0))
+    # truck 1 already has a trip on 5/4, and route 1 is the only route
+    assert sample.schedule_trips(1, dt.date(2023, 5, 4)) == 0
+    assert sample.schedule_trips(1, dt.date(2023, 5, 5)) == 1
+    assert sample.schedule_trips(1, dt.date(2023, 5, 5)) == 0
+    assert scheduled_trips(sample, dt.date(2023, 5, 5)) \
+        == [(1, 1, dt.datetime(2023, 5, 5, 8, 0), 2, 1, 1)]
+    assert sample.schedule_trips(2023, dt.date(2023, 5, 6)) == 0
+
+
+def test_reference_cache_notified(sample: WasteWrangler) -> None:
+    assert sample.enable_reference_cache(listen=True)
+
+    def truck_info() -> tuple:
+        with sample._lease() as connection:
+            return sample._truck_info(connection.cursor(), 2)
+
+    assert truck_info() == ("B", 20)
+    # a change made by another client is seen on the next lookup
+    other = WasteWrangler()
+    assert other.connect(DBNAME, USER, PASSWORD)
+    try:
+        execute(other, "update Truck set capacity = 25 where tID = 2;")
+    finally:
+        other.disconnect()
+    # the notification reaches the listener shortly after the commit, far
+    # sooner than the results expire
+    for _ in range(100):
+        if truck_info() == ("B", 25):
+            break
+        sleep(0.01)
+    assert truck_info() == ("B", 25)
+
+
+def facility_choice(ww: WasteWrangler) -> list[tuple]:
+    """Return the rows of FacilityChoice read through <ww>, and check that
+    they are the lowest and second lowest fID of each waste type in Facility.
+    """
+    facilities = {}
+    for fid, waste_type in query(ww, "select fID, wasteType from Facility "
+                                     "order by fID;"):
+        facilities.setdefault(waste_type, []).append(fid)
+    rows = query(ww, "select wasteType, first_fID, second_fID "
+                     "from FacilityChoice order by wasteType;")
+    assert rows == [(waste_type, fids[0], fids[1] if len(fids) > 1 else None)
+                    for waste_type, fids in sorted(facilities.items())]
+    return rows
+
+
+def test_facility_choice_sample(sample: WasteWrangler) -> None:
+    assert ("plastic recycling", 1, 8) in facility_choice(sample)
+    execute(sample, "insert into Facility values "
+                    "(9, '1 Bay Street, M5J 2R8', 'compost'), "
+                    "(0, '2 Bay Street, M5J 2R8', 'compost');")
+    execute(sample, "update Facility set wasteType = 'landfill' "
+                    "where fID = 8;")
+    assert sample.refresh_facility_choice()
+    rows = facility_choice(sample)
+    assert ("compost", 0, 3) in rows
+    assert ("landfill", 4, 8) in rows
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_facility_choice_matches_facility(database: str, seed: int) -> None:
+    tables = generate(database, seed)
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        assert facility_choice(ww)
+        fids = [row[0] for row in tables["Facility"]]
+        execute(ww, "update Facility set wasteType = 'compost' "
+                    "where fID = any(%s);", [fids[::3]])
+        assert ww.refresh_facility_choice()
+        facility_choice(ww)
+        assert query(ww, "select count(*) from FacilityChange;") == [(0,)]
+    finally:
+        ww.disconnect()
+
+
+def test_facility_choice_refreshed_periodically(sample: WasteWrangler,
+                                                monkeypatch) -> None:
+    monkeypatch.setattr(WasteWrangler, "FACILITY_CHOICE_INTERVAL", 0.2)
+    sample.refresh_facility_choice()
+    execute(sample, "insert into Facility values "
+                    "(0, '1 Bay Street, M5J 2R8', 'plastic recycling');")
+    # changing Facility only logs the change
+    assert ("plastic recycling", 1, 8) in query(
+        sample, "select * from FacilityChoice;")
+    assert query(sample, "select count(*) from FacilityChange;") == [(1,)]
+    sleep(0.2)
+    # the next call to lease a connection refreshes the view
+    assert sample.schedule_trip(1, dt.datetime(2023, 5, 4, 8, 0))
+    assert [row[5] for row in scheduled_trips(sample, dt.date(2023, 5, 4))] \
+        == [0]
+
+
+def test_connect_warns_of_missing_migrations(sample: WasteWrangler,
+                                             caplog) -> None:
+    ww = WasteWrangler()
+    with caplog.at_level("WARNING", logger="a2"):
+        assert ww.connect(DBNAME, USER, PASSWORD)
+    ww.disconnect()
+    assert not caplog.records
+
+    version, description, _ = migrations.MIGRATIONS[-1]
+    execute(sample, "delete from schema_migrations where version = %s;",
+            [version])
+    for max_connections in [0, 2]:
+        caplog.clear()
+        with caplog.at_level("WARNING", logger="a2"):
+            assert ww.connect(DBNAME, USER, PASSWORD, 0, max_connections)
+        ww.disconnect()
+        assert [record.getMessage() for record in caplog.records] \
+            == [f"migration {version} ({description}) has not been applied; "
+                f"run migrations.migrate"]
+
+
+def test_workmate_sphere_sample(sample: WasteWrangler) -> None:
+    # drivers 3 and 1 share the sample trip, and 2 and 1 share this one
+    assert sample.schedule_trip(1, dt.datetime(2023, 5, 4, 8, 0))
+    for eid in range(1, 10):
+        sphere = sample.workmate_sphere(eid)
+        assert len(sphere) == len(set(sphere))
+        assert set(sphere) == reference_sphere(sample, eid)
+    assert set(sample.workmate_sphere(3)) == {1, 2}
+    assert sample.workmate_sphere(2023) == []
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_workmate_sphere_matches_search(database: str, seed: int) -> None:
+    tables = generate(database, seed)
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        spheres = [ww.workmate_sphere(row[0]) for row in tables["Employee"]]
+        assert any(spheres), "the dataset should have some trips"
+        for row, sphere in zip(tables["Employee"], spheres):
+            assert len(sphere) == len(set(sphere))
+            assert set(sphere) == reference_sphere(ww, row[0])
+    finally:
+        ww.disconnect()
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_workmate_index_matches_workmate_sphere(database: str,
+                                                seed: int) -> None:
+    tables = generate(database, seed)
+    eids = [row[0] for row in tables["Employee"]]
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        assert ww.build_workmate_index()
+        # the index is kept up to date with the trips scheduled after it
+        # was built
+        assert ww.schedule_fleet(DAY)
+        index = ww.workmate_index
+        ww.workmate_index = None
+        for eid in eids:
+            assert set(index.sphere(eid)) == set(ww.workmate_sphere(eid))
+    finally:
+        ww.disconnect()
+
+
+def test_schedule_maintenance_skips_trip_days(
+        sample: WasteWrangler) -> None:
+    # truck 1 is due for maintenance, and has a trip on the first day after
+    assert sample.schedule_trip(1, dt.datetime(2023, 5, 6, 8, 0))
+    assert query(sample, "select tID from Trip where tTime = %s;",
+                 [dt.datetime(2023, 5, 6, 8, 0)]) == [(1,)]
+    assert sample.schedule_maintenance(dt.date(2023, 5, 5)) == 7
+    assert query(sample, "select tID, eID, mDate from Maintenance "
+                         "where mDate > %s and tID <= 2 order by tID;",
+                 [dt.date(2023, 5, 5)]) \
+        == [(1, 5, dt.date(2023, 5, 7)), (2, 5, dt.date(2023, 5, 6))]
+
+
+def test_migrations_sample(sample: WasteWrangler) -> None:
+    with sample._lease() as connection:
+        # setup has applied every migration already
+        assert migrations.migrate(connection) == 0
+    assert query(sample, "select version from schema_migrations "
+                         "order by version;") \
+        == [(version,) for version, _, _ in migrations.MIGRATIONS]
+    indexes = {row[0] for row in query(sample, "select indexname "
+                                               "from pg_indexes;")}
+    assert {"trip_eid1_idx", "trip_eid2_idx", "trip_ttime_idx",
+            "trip_fid_ttime_idx", "maintenance_mdate_idx",
+            "trip_busy_idx"} <= indexes
+
+
+def schema_state(ww: WasteWrangler) -> dict[str, object]:
+    """Return the rows of every table and materialized view of the schema,
+    and the definitions of its constraints and indexes, read through <ww>.
+    """
+    state = {
+        "constraints": query(ww, """
+            select conrelid::regclass::text, conname,
+                   pg_get_constraintdef(oid)
+            from pg_constraint
+            where connamespace = current_schema()::regnamespace
+            order by 1, 2;
+        """),
+        "indexes": query(ww, "select indexname, indexdef from pg_indexes "
+                             "where schemaname = current_schema() "
+                             "order by indexname;"),
+    }
+    # the tables and materialized views, except for the times at which the
+    # migrations were applied
+    for (table,) in query(ww, """
+        select relname from pg_class
+        where relnamespace = current_schema()::regnamespace
+          and relkind in ('r', 'm')
+          and relname <> 'schema_migrations';
+    """):
+        state[table] = sorted(query(ww, f"select * from {table};"), key=str)
+    return state
+
+
+def test_setup_from_csv_matches_sql(sample: WasteWrangler,
+                                    tmp_path) -> None:
+    expected = schema_state(sample)
+    assert expected["trip"] and expected["facilitychoice"]
+    tables = {table: query(sample, f"select {', '.join(columns)} "
+                                   f"from {table};")
+              for table, columns in datagen.COLUMNS.items()}
+    datagen.write_csv(tables, str(tmp_path))
+
+    a2.setup(DBNAME, USER, PASSWORD, str(tmp_path))
+    assert schema_state(sample) == expected
+
+
+def test_foreign_key_order(sample: WasteWrangler) -> None:
+    with sample._lease() as connection:
+        order = a2._foreign_key_order(connection.cursor())
+    assert sorted(order) == sorted(
+        row[0] for row in query(sample, "select tablename from pg_tables "
+                                        "where schemaname = current_schema();"))
+    for table, referenced in query(sample, """
+        select conrelid::regclass::text, confrelid::regclass::text
+        from pg_constraint
+        where connamespace = current_schema()::regnamespace
+          and contype = 'f';
+    """):
+        assert order.index(referenced.lower()) <= order.index(table.lower())
+
+
+def test_check_index_usage(database: str) -> None:
+    # the plans depend on the statistics, so the dataset can't be too small
+    tables = datagen.generate(employees=300, trucks=100, routes=200, days=60,
+                              end=DAY, seed=0)
+    datagen.write_csv(tables, database)
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        with ww._lease() as connection:
+            usage = migrations.check_index_usage(connection)
+    finally:
+        ww.disconnect()
+    assert usage and all(usage.values()), usage
+
+
+def test_trip_busy_sample(sample: WasteWrangler) -> None:
+    def time(hour: int, minute: int = 0) -> dt.datetime:
+        return dt.datetime(2023, 5, 4, hour, minute)
+
+    # route 1 takes 3 hours, and route 2 one hour
+    execute(sample, "insert into Route values (2, 'plastic recycling', 5);")
+    execute(sample, "insert into Trip values (1, 1, %s, null, 2, 1, 1);",
+            [time(8)])
+    assert query(sample, "select busy from Trip where tTime = %s;",
+                 [time(8)])[0][0] == pg_extras.DateTimeRange(
+                     time(8), time(11, 30), "[)")
+
+    # the truck and each of the drivers are busy until 11:30
+    for row in [(2, 1, time(11, 29), None, 4, 3, 1),
+                (2, 2, time(11, 29), None, 3, 2, 1),
+                (2, 2, time(11, 29), None, 3, 1, 1)]:
+        with pytest.raises(pg_errors.ExclusionViolation):
+            execute(sample, "insert into Trip values %s;", [row])
+    execute(sample, "insert into Trip values (2, 1, %s, null, 2, 1, 1);",
+            [time(11, 30)])
+
+    # a longer route makes its trips busy for longer, which must still not
+    # overlap
+    execute(sample, "update Route set length = 10 where rID = 2;")
+    with pytest.raises(pg_errors.ExclusionViolation):
+        execute(sample, "update Route set length = 20 where rID = 1;")
+
+    # the busy interval of every trip, and of both of its drivers, is the
+    # trip plus the 30 minutes after it
+    assert query(sample, """
+        select tr.rID, tr.tTime
+        from Trip tr join Route r on tr.rID = r.rID
+        where tr.busy <> tsrange(tr.tTime, tr.tTime
+                                           + interval '1 hour' * r.length / 5
+                                           + interval '30 minutes')
+           or (select count(*) from TripDriver d
+               where d.rID = tr.rID and d.tTime = tr.tTime
+                 and d.eID in (tr.eID1, tr.eID2) and d.busy = tr.busy)
+              <> 2;
+    """) == []
+
+
+def reference_technicians(ww: WasteWrangler,
+                          text: str) -> tuple[int, set[tuple]]:
+    """Return the number of valid entries in the qualifications file <text>,
+    and the rows Technician should have once they are recorded, applying the
+    rules of update_technicians to the tables read through <ww>.
+    """
+    eids = {name: eid for eid, name in
+            query(ww, "select eID, name from Employee;")}
+    drivers = {row[0] for row in query(ww, "select eID from Driver;")}
+    truck_types = {row[0] for row in
+                   query(ww, "select truckType from TruckType;")}
+    technicians = set(query(ww, "select eID, truckType from Technician;"))
+    lines = text.splitlines()
+    valid = 0
+    for name, truck_type in zip(lines[::2], lines[1::2]):
+        # the name may have a title, which is not part of Employee.name
+        eid = eids.get(" ".join(name.split()[-2:]))
+        if eid is not None and eid not in drivers \
+                and truck_type in truck_types \
+                and (eid, truck_type) not in technicians:
+            technicians.add((eid, truck_type))
+            valid = valid + 1
+    return valid, technicians
+
+
+def test_update_technicians_sample(sample: WasteWrangler) -> None:
+    with open("qualifications.txt") as file:
+        text = file.read()
+    expected = reference_technicians(sample, text)
+    assert sample.update_technicians(io.StringIO(text)) == expected[0]
+    assert set(query(sample, "select eID, truckType from Technician;")) \
+        == expected[1]
+    # every entry is now already recorded
+    assert sample.update_technicians(io.StringIO(text)) == 0
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_update_technicians_matches_rules(database: str, seed: int) -> None:
+    tables = generate(database, seed)
+    file = io.StringIO()
+    datagen.write_qualifications(tables, file, 500, seed)
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        expected = reference_technicians(ww, file.getvalue())
+        assert expected[0], "the file should have some valid entries"
+        file.seek(0)
+        assert ww.update_technicians(file) == expected[0]
+        assert set(query(ww, "select eID, truckType from Technician;")) \
+            == expected[1]
+    finally:
+        ww.disconnect()
+
+
+def test_update_technicians_in_small_chunks(database: str,
+                                            monkeypatch) -> None:
+    # with chunks this small, an entry and its repeats are mostly in
+    # different chunks
+    monkeypatch.setattr(WasteWrangler, "QUALIFICATIONS_CHUNK", 7)
+    tables = generate(database, 0)
+    file = io.StringIO()
+    datagen.write_qualifications(tables, file, 500, 0)
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        expected = reference_technicians(ww, file.getvalue())
+        file.seek(0)
+        assert ww.update_technicians(file) == expected[0]
+        assert set(query(ww, "select eID, truckType from Technician;")) \
+            == expected[1]
+    finally:
+        ww.disconnect()
+
+
+def reference_reroutes(ww: WasteWrangler,
+                       reroutes: list[tuple[int, dt.date, dt.date]]) \
+        -> tuple[list[int], dict[tuple, int]]:
+    """Return the counts reroute_waste_many should return for <reroutes>,
+    and the fID each trip read through <ww> should then have, by (rID,
+    tTime), rerouting each trip for the first entry that covers it.
+    """
+    facilities = query(ww, "select fID, wasteType from Facility;")
+    replacements = {}
+    for fid, waste_type in facilities:
+        others = [other for other, other_type in facilities
+                  if other_type == waste_type and other != fid]
+        if others:
+            replacements[fid] = min(others)
+
+    counts = [0] * len(reroutes)
+    fids = {}
+    for rid, time, fid in query(ww, "select rID, tTime, fID from Trip;"):
+        fids[(rid, time)] = fid
+        for i, (reroute_fid, first_day, last_day) in enumerate(reroutes):
+            if fid == reroute_fid and fid in replacements \
+                    and first_day <= time.date() <= last_day:
+                counts[i] = counts[i] + 1
+                fids[(rid, time)] = replacements[fid]
+                break
+    return counts, fids
+
+
+def test_reroute_waste_many_overlapping(sample: WasteWrangler) -> None:
+    # facility 1 takes the sample trip on 5/3 and this one on 5/4
+    assert sample.schedule_trip(1, dt.datetime(2023, 5, 4, 8, 0))
+    rerouted = sample.reroute_waste_many([
+        (1, dt.date(2023, 5, 3), dt.date(2023, 5, 4)),
+        (1, dt.date(2023, 5, 4), dt.date(2023, 5, 5)),
+        (1, dt.date(2023, 5, 3), dt.date(2023, 5, 3))])
+    # each trip is rerouted once, for the first entry that covers it
+    assert rerouted == [2, 0, 0]
+    assert query(sample, "select fID from Trip;") == [(8,), (8,)]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_reroute_waste_many_matches_reroute(database: str,
+                                            seed: int) -> None:
+    tables = generate(database, seed)
+    rng = random.Random(seed)
+    # entries over a few of the days with trips, some of which overlap
+    reroutes = []
+    for fid in rng.choices([row[0] for row in tables["Facility"]], k=20):
+        first_day = DAY - dt.timedelta(days=rng.randint(0, 5))
+        last_day = first_day + dt.timedelta(days=rng.randint(0, 3))
+        reroutes.append((fid, first_day, last_day))
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        counts, fids = reference_reroutes(ww, reroutes)
+        assert any(counts), "some trips should be rerouted"
+        assert ww.reroute_waste_many(reroutes) == counts
+        assert {(rid, time): fid for rid, time, fid in
+                query(ww, "select rID, tTime, fID from Trip;")} == fids
+    finally:
+        ww.disconnect()
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_schedule_fleet_matches_schedule_trips(database: str,
+                                               seed: int) -> None:
+    tables = generate(database, seed)
+    tids = sorted(row[0] for row in tables["Truck"])
+
+    results = {}
+    for method in ["schedule_trips", "schedule_fleet", "schedule_fleet_pool"]:
+        a2.setup(DBNAME, USER, PASSWORD, database)
+        ww = WasteWrangler()
+        assert ww.connect(DBNAME, USER, PASSWORD)
+        try:
+            if method == "schedule_trips":
+                count = sum(ww.schedule_trips(tid, DAY) for tid in tids)
+            elif method == "schedule_fleet":
+                count = ww.schedule_fleet(DAY)
+            else:
+                count = ww.schedule_fleet(DAY, workers=2)
+            trips = scheduled_trips(ww, DAY)
+        finally:
+            ww.disconnect()
+        assert count == len(trips)
+        results[method] = trips
+
+    assert results["schedule_trips"], "the dataset should allow some trips"
+    assert results["schedule_fleet"] == results["schedule_trips"]
+    assert results["schedule_fleet_pool"] == results["schedule_trips"]
+
+
+@pytest.mark.parametrize("serializable", [False, True])
+def test_schedule_trip_concurrently(database: str, serializable: bool) -> None:
+    tables = generate(database, 0)
+    rids = [row[0] for row in tables["Route"]]
+    time = dt.datetime.combine(DAY + dt.timedelta(days=1), dt.time(9, 0))
+    a2.setup(DBNAME, USER, PASSWORD, database)
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD, 0, 10)
+    ww.serializable = serializable
+    try:
+        # every call competes for the same trucks and drivers, which there
+        # aren't enough of for every route
+        results = {}
+        barrier = threading.Barrier(len(rids))
+
+        def schedule(rid: int) -> None:
+            barrier.wait()
+            results[rid] = ww.schedule_trip(rid, time)
+
+        threads = [threading.Thread(target=schedule, args=[rid])
+                   for rid in rids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        scheduled = [rid for rid in rids if results[rid]]
+        assert scheduled, "some trips should be scheduled"
+        assert len(scheduled) < len(rids), "some trips should be refused"
+        assert sorted(row[0] for row in scheduled_trips(ww, time.date())) \
+            == sorted(scheduled)
+        # a call that failed did so because nothing was left for it, rather
+        # than because it lost a race, so it fails again on its own
+        for rid in rids:
+            if not results[rid]:
+                assert not ww.schedule_trip(rid, time)
+        assert ww.retry_counts()["exhausted"] == 0
+    finally:
+        ww.disconnect()
+
+
+def test_async_schedule_trip_concurrently(database: str) -> None:
+    a2_async = pytest.importorskip("a2_async")
+    tables = generate(database, 0)
+    rids = [row[0] for row in tables["Route"]]
+    time = dt.datetime.combine(DAY + dt.timedelta(days=1), dt.time(9, 0))
+    a2.setup(DBNAME, USER, PASSWORD, database)
+
+    async def schedule() -> list[bool]:
+        ww = a2_async.AsyncWasteWrangler()
+        assert await ww.connect(DBNAME, USER, PASSWORD)
+        first = ww.pool
+        assert await ww.connect(DBNAME, USER, PASSWORD)
+        assert first.closed and not ww.pool.closed
+        try:
+            return await asyncio.gather(*[ww.schedule_trip(rid, time)
+                                          for rid in rids])
+        finally:
+            await ww.disconnect()
+
+    results = dict(zip(rids, asyncio.run(schedule())))
+    ww = WasteWrangler()
+    assert ww.connect(DBNAME, USER, PASSWORD)
+    try:
+        scheduled = [rid for rid in rids if results[rid]]
+        assert 0 < len(scheduled) < len(rids)
+        assert sorted(row[0] for row in scheduled_trips(ww, time.date())) \
+            == sorted(scheduled)
+        for rid in rids:
+            if not results[rid]:
+                assert not ww.schedule_trip(rid, time)
+    finally:
+        ww.disconnect()
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_schedule_trip_many_matches_schedule_trip(database: str,
+                                                  seed: int) -> None:
+    tables = generate(database, seed)
+    rng = random.Random(seed)
+    # some requests are for a route that doesn't exist, or outside working
+    # hours, and many compete for the same routes, trucks and drivers
+    rids = [row[0] for row in tables["Route"]] + [999]
+    requests = []
+    for _ in range(60):
+        day = DAY + dt.timedelta(days=rng.randint(0, 1))
+        time = dt.time(rng.randint(7, 15), rng.choice([0, 30]))
+        requests.append((rng.choice(rids), dt.datetime.combine(day, time)))
+
+    results = {}
+    for method in ["schedule_trip", "schedule_trip_many"]:
+        a2.setup(DBNAME, USER, PASSWORD, database)
+        ww = WasteWrangler()
+        assert ww.connect(DBNAME, USER, PASSWORD)
+        try:
+            if method == "schedule_trip":
+                scheduled = [ww.schedule_trip(rid, time)
+                             for rid, time in requests]
+            else:
+                scheduled = ww.schedule_trip_many(requests)
+            trips = query(ww, "select rID, tID, tTime, eID1, eID2, fID "
+                              "from Trip where tTime >= %s "
+                              "order by tTime, rID;", [DAY])
+        finally:
+            ww.disconnect()
+        results[method] = (scheduled, trips)
+
+    assert any(results["schedule_trip"][0]), \
+        "the requests should allow some trips"
+    assert results["schedule_trip_many"] == results["schedule_trip"]
@@ -0,0 +1,189 @@
+"""CSC343 Assignment 2
+
+=== Module Description ===
+
+This file contains tests of the metrics sinks, the instrumented decorator and
+the statement labels, none of which need a database.
+
+Run them with
+    python -m pytest -q
+"""
+
+import logging
+import pytest
+
+import metrics
+from metrics import CallSample, InMemorySink, LoggingSink, instrumented
+
+
+def sample(method: str, seconds: float,
+           statements: list[tuple[str, float]]) -> CallSample:
+    """Return a sample of a call of <method> that took <seconds> and issued
+    <statements>, fetching one row per statement and committing once.
+    """
+    call = CallSample(method)
+    call.seconds = seconds
+    call.statements = len(statements)
+    call.rows = len(statements)
+    call.commits = 1
+    call.statement_seconds = list(statements)
+    return call
+
+
+# ----------------------------- InMemorySink -------------------------------- #
+
+def test_in_memory_sink_totals() -> None:
+    sink = InMemorySink()
+    sink.record(sample("schedule_trips", 0.5, [("a", 0.1), ("b", 0.2)]))
+    sink.record(sample("schedule_trips", 0.25, [("a", 0.1)]))
+    sink.record(sample("reroute_waste", 0.1, []))
+
+    assert sink.methods() == {
+        "schedule_trips": {"calls": 2, "seconds": 0.75, "statements": 3,
+                           "rows": 3, "commits": 2, "rollbacks": 0},
+        "reroute_waste": {"calls": 1, "seconds": 0.1, "statements": 0,
+                          "rows": 0, "commits": 1, "rollbacks": 0},
+    }
+
+
+def test_in_memory_sink_histograms() -> None:
+    sink = InMemorySink()
+    # 0.001 is on a bucket bound, so it falls into that bucket
+    sink.record(sample("m", 1.0, [("a", 0.001), ("a", 0.003), ("a", 20.0)]))
+
+    counts, total = sink.histograms()["a"]
+    assert counts[metrics.BUCKETS.index(0.001)] == 1
+    assert counts[metrics.BUCKETS.index(0.005)] == 1
+    assert counts[-1] == 1
+    assert sum(counts) == 3
+    assert total == pytest.approx(20.004)
+
+
+def test_in_memory_sink_copies_and_reset() -> None:
+    sink = InMemorySink()
+    sink.record(sample("m", 1.0, [("a", 0.1)]))
+    sink.methods()["m"]["calls"] = 10
+    sink.histograms()["a"][0][0] = 10
+    assert sink.methods()["m"]["calls"] == 1
+    assert sum(sink.histograms()["a"][0]) == 1
+
+    sink.reset()
+    assert sink.methods() == {}
+    assert sink.histograms() == {}
+
+
+def test_prometheus_text() -> None:
+    sink = InMemorySink()
+    sink.record(sample("schedule_trips", 0.5, [('say "hi"', 0.003)]))
+    text = sink.prometheus_text(prefix="ww")
+    lines = text.splitlines()
+
+    assert text.endswith("\n")
+    assert "# TYPE ww_method_calls_total counter" in lines
+    assert 'ww_method_calls_total{method="schedule_trips"} 1' in lines
+    assert "# TYPE ww_statement_seconds histogram" in lines
+    # buckets are cumulative, and quotes in labels are escaped
+    assert 'ww_statement_seconds_bucket{statement="say \\"hi\\"",le="0.001"} 0' \
+        in lines
+    assert 'ww_statement_seconds_bucket{statement="say \\"hi\\"",le="0.005"} 1' \
+        in lines
+    assert 'ww_statement_seconds_bucket{statement="say \\"hi\\"",le="+Inf"} 1' \
+        in lines
+    assert 'ww_statement_seconds_count{statement="say \\"hi\\""} 1' in lines
+
+
+# ------------------------------ LoggingSink -------------------------------- #
+
+def test_logging_sink(caplog) -> None:
+    logger = logging.getLogger("test_metrics")
+    sink = LoggingSink(logger, logging.WARNING)
+    with caplog.at_level(logging.WARNING, logger="test_metrics"):
+        sink.record(sample("schedule_trips", 0.5,
+                           [("fast", 0.01), ("slow", 0.3)]))
+        sink.record(sample("reroute_waste", 0.1, []))
+
+    first, second = caplog.records
+    assert first.levelno == logging.WARNING
+    assert first.getMessage() == "schedule_trips: 0.500s, 2 statements, " \
+        "2 rows, 1 commits, 0 rollbacks; slowest slow (0.300s)"
+    assert "slowest - (0.000s)" in second.getMessage()
+
+
+# ------------------------------ instrumented ------------------------------- #
+
+class Recorder:
+    """A sink that keeps the samples of the calls."""
+
+    def __init__(self) -> None:
+        self.samples = []
+
+    def record(self, call: CallSample) -> None:
+        self.samples.append(call)
+
+
+class Service:
+    """A class with instrumented methods, one of which calls the other."""
+
+    def __init__(self, sink: object) -> None:
+        self.metrics = sink
+
+    @instrumented
+    def inner(self, value: int) -> int:
+        return value + 1
+
+    @instrumented
+    def outer(self, value: int) -> int:
+        return self.inner(value) * 2
+
+
+def test_instrumented_records_outer_calls_only() -> None:
+    sink = Recorder()
+    service = Service(sink)
+    assert service.outer(1) == 4
+    assert service.inner(1) == 2
+    assert [call.method for call in sink.samples] == ["outer", "inner"]
+    assert all(call.seconds >= 0 for call in sink.samples)
+
+
+def test_instrumented_without_sink() -> None:
+    assert Service(None).outer(1) == 4
+
+
+def test_instrumented_records_failed_calls() -> None:
+    sink = Recorder()
+    service = Service(sink)
+    try:
+        service.outer(None)
+    except TypeError:
+        pass
+    assert [call.method for call in sink.samples] == ["outer"]
+
+
+# ---------------------------- _statement_label ----------------------------- #
+
+def test_statement_label_prepared() -> None:
+    assert metrics._statement_label("prepare free_routes as select 1") \
+        == "free_routes"
+    assert metrics._statement_label(b"  EXECUTE free_routes ($1, $2);") \
+        == "free_routes"
+
+
+def test_statement_label_plain() -> None:
+    query = "select   eID1,\n  eID2 from Trip where tTime >= %s " \
+            "order by tTime, tID, rID, eID1, eID2;"
+    label = metrics._statement_label(query)
+    # whitespace is collapsed before the label is cut to 60 characters
+    assert label == " ".join(query.split())[:60]
+    assert label.startswith("select eID1, eID2 from Trip where")
+    assert len(label) == 60
+
+
+def test_statement_label_execute_values() -> None:
+    # execute_values renders the rows into the statement, but every batch
+    # must still get the same label
+    first = metrics._statement_label(
+        b"insert into Trip values (1, 2, '2023-05-01 08:00', NULL, 3, 4, 5)")
+    second = metrics._statement_label(
+        "insert into Trip values (6, 7, '2023-05-02 08:00', NULL, 8, 9, 10),"
+        " (11, 12, '2023-05-02 10:00', NULL, 8, 9, 10)")
+    assert first == second == "insert into Trip values ..."